@@ -1,14 +1,17 @@
 """
 Telegram Bot с обработчиками команд и сообщений
 """
+import asyncio
 import logging
+import time
 from pathlib import Path
 from typing import Optional
 
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 
-from shared.config import TELEGRAM_BOT_TOKEN, TELEGRAM_WEBHOOK_URL, SUPPORT_URL
+from shared.config import TELEGRAM_BOT_TOKEN, TELEGRAM_WEBHOOK_URL, SUPPORT_URL, ADMIN_IDS
 from bot_api.handlers import commands, callbacks, messages, cancel, referrals, admin
 
 logger = logging.getLogger(__name__)
@@ -17,66 +20,193 @@ logger = logging.getLogger(__name__)
 _bot: Optional[Bot] = None
 _application: Optional[Application] = None
 
+# Очередь исходящих уведомлений: Telegram даёт ~30 msg/s глобально,
+# поэтому рассылки идут через один фоновый consumer с паузой между отправками
+NOTIFY_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10000)
+_NOTIFY_SEND_DELAY = 1 / 25  # ~25 msg/s, с запасом до лимита
+_NOTIFY_SEND_TIMEOUT = 3.0  # не держим слот пула дольше этого
+_NOTIFY_BATCH_WINDOW = 0.05  # окно коалесценции уведомлений (секунды)
+_NOTIFY_MERGE_SEP = "\n---\n"
+_notify_consumer_task: Optional[asyncio.Task] = None
+
+# Пользователи, до которых не удалось достучаться (заблокировали бота,
+# удалили аккаунт): не тратим отправки на них ближайшие N секунд
+_UNREACHABLE_TTL = 600.0
+_UNREACHABLE_MAX = 10000
+_unreachable_until: dict[int, float] = {}
+
+# Таблицы регистрации команд: (имя команды, обработчик)
+_USER_COMMANDS = (
+    ("start", commands.start_command),
+    ("help", commands.help_command),
+    ("balance", commands.balance_command),
+    ("topup", commands.topup_command),
+    ("prompt", commands.prompt_command),
+    ("generate", commands.generate_command),
+    ("settings", commands.settings_command),
+    ("refs", commands.refs_command),
+    ("clear", commands.clear_command),
+    ("history", commands.history_command),
+    ("support", commands.support_command),
+    ("cancel", cancel.cancel_generation_command),
+    ("ref", referrals.ref_command),
+)
+
+_ADMIN_COMMANDS = (
+    ("admin", admin.admin_command),
+    ("add_credits", admin.add_credits_command),
+    ("set_credits", admin.set_credits_command),
+    ("user", admin.user_command),
+    ("ban", admin.ban_command),
+    ("unban", admin.unban_command),
+)
+
 
 async def setup_bot():
     """
     Настройка бота и webhook
     """
-    global _bot, _application
+    global _bot, _application, _notify_consumer_task
     
     # Создаем приложение
-    _application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Увеличенный HTTPX пул: массовые админ-рассылки не должны
+    # исчерпывать соединения и сериализовать отправку.
+    # pool_timeout короткий - лучше быстрый отказ, чем висящий handler;
+    # getUpdates не используется (webhook), ему хватает 1 соединения
+    _application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(256)
+        .pool_timeout(5)
+        .get_updates_connection_pool_size(1)
+        .build()
+    )
     _bot = _application.bot
     
-    # Регистрируем обработчики команд
-    _application.add_handler(CommandHandler("start", commands.start_command))
-    _application.add_handler(CommandHandler("help", commands.help_command))
-    _application.add_handler(CommandHandler("balance", commands.balance_command))
-    _application.add_handler(CommandHandler("topup", commands.topup_command))
-    _application.add_handler(CommandHandler("prompt", commands.prompt_command))
-    _application.add_handler(CommandHandler("generate", commands.generate_command))
-    _application.add_handler(CommandHandler("settings", commands.settings_command))
-    _application.add_handler(CommandHandler("refs", commands.refs_command))
-    _application.add_handler(CommandHandler("clear", commands.clear_command))
-    _application.add_handler(CommandHandler("history", commands.history_command))
-    _application.add_handler(CommandHandler("support", commands.support_command))
-    _application.add_handler(CommandHandler("cancel", cancel.cancel_generation_command))
-    _application.add_handler(CommandHandler("ref", referrals.ref_command))
-    
-    # Админ-команды
-    _application.add_handler(CommandHandler("admin", admin.admin_command))
-    _application.add_handler(CommandHandler("add_credits", admin.add_credits_command))
-    _application.add_handler(CommandHandler("set_credits", admin.set_credits_command))
-    _application.add_handler(CommandHandler("user", admin.user_command))
-    _application.add_handler(CommandHandler("ban", admin.ban_command))
-    _application.add_handler(CommandHandler("unban", admin.unban_command))
-    
+    # Регистрируем обработчики команд по таблицам
+    add_handler = _application.add_handler
+
+    for name, handler_fn in _USER_COMMANDS:
+        add_handler(CommandHandler(name, handler_fn))
+
+    # Админ-команды: фильтр на уровне диспетчера отсекает чужие вызовы
+    # до создания Context
+    admin_filter = filters.User(user_id=ADMIN_IDS)
+    for name, handler_fn in _ADMIN_COMMANDS:
+        add_handler(CommandHandler(name, handler_fn, filters=admin_filter))
+
     # Регистрируем обработчики сообщений
-    _application.add_handler(MessageHandler(filters.PHOTO, messages.handle_photo))
-    _application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, messages.handle_text))
-    
+    add_handler(MessageHandler(filters.PHOTO, messages.handle_photo))
+    add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, messages.handle_text))
+
     # Регистрируем обработчики callback кнопок
-    _application.add_handler(CallbackQueryHandler(callbacks.handle_callback))
+    add_handler(CallbackQueryHandler(callbacks.handle_callback))
     
-    # Устанавливаем webhook
+    # Устанавливаем webhook параллельно с инициализацией приложения:
+    # drop_pending_updates может долго ждать ответа Telegram, незачем
+    # сериализовать его с initialize(). allowed_updates режет входящий
+    # трафик - edited_message, chat_member и т.п. нам не нужны
     if TELEGRAM_WEBHOOK_URL:
-        await _bot.set_webhook(
-            url=TELEGRAM_WEBHOOK_URL,
-            drop_pending_updates=True
+        await asyncio.gather(
+            _application.initialize(),
+            _bot.set_webhook(
+                url=TELEGRAM_WEBHOOK_URL,
+                drop_pending_updates=True,
+                allowed_updates=["message", "callback_query"]
+            )
         )
         logger.info(f"✅ Webhook set to: {TELEGRAM_WEBHOOK_URL}")
     else:
+        await _application.initialize()
         logger.warning("⚠️ TELEGRAM_WEBHOOK_URL not set, webhook not configured")
     
+    # Кэшируем username бота: initialize() уже сделал getMe,
+    # обработчикам (/ref и т.п.) не нужен шанс повторного HTTP-вызова
+    _application.bot_data["bot_username"] = _bot.username
+
+    # Запускаем consumer очереди уведомлений
+    _notify_consumer_task = asyncio.create_task(_notify_consumer())
+
     logger.info("✅ Bot handlers registered")
 
 
+def _mark_unreachable(user_id: int):
+    """Пометить пользователя как недоступного на _UNREACHABLE_TTL секунд"""
+    if len(_unreachable_until) >= _UNREACHABLE_MAX:
+        now = time.monotonic()
+        for uid in [uid for uid, until in _unreachable_until.items() if until < now]:
+            del _unreachable_until[uid]
+    _unreachable_until[user_id] = time.monotonic() + _UNREACHABLE_TTL
+
+
+async def _notify_consumer():
+    """
+    Фоновый consumer очереди уведомлений с ограничением скорости
+
+    Отправка ограничена таймаутом, а недоступные получатели кэшируются,
+    чтобы зависшие send_message не занимали слоты HTTPX-пула.
+
+    Уведомления, пришедшие в пределах короткого окна, группируются по
+    получателю и склеиваются в одно сообщение: при всплеске пользователь
+    получает один вызов Telegram API вместо нескольких
+    """
+    while True:
+        batch = [await NOTIFY_QUEUE.get()]
+        NOTIFY_QUEUE.task_done()
+
+        # Добираем уведомления, пришедшие в ближайшие ~50мс
+        deadline = time.monotonic() + _NOTIFY_BATCH_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(
+                    await asyncio.wait_for(NOTIFY_QUEUE.get(), timeout=remaining)
+                )
+                NOTIFY_QUEUE.task_done()
+            except asyncio.TimeoutError:
+                break
+
+        # Группируем по получателю, сохраняя порядок текстов
+        grouped: dict[int, list] = {}
+        for user_id, text in batch:
+            grouped.setdefault(user_id, []).append(text)
+
+        for user_id, texts in grouped.items():
+            if _unreachable_until.get(user_id, 0.0) > time.monotonic():
+                continue
+
+            merged = _NOTIFY_MERGE_SEP.join(texts)
+            try:
+                await asyncio.wait_for(
+                    send_message(user_id, merged), timeout=_NOTIFY_SEND_TIMEOUT
+                )
+            except (asyncio.TimeoutError, Forbidden) as e:
+                _mark_unreachable(user_id)
+                logger.warning(f"User {user_id} unreachable, skipping notifications: {e}")
+            except Exception as e:
+                logger.error(f"Failed to deliver notification to {user_id}: {e}")
+            await asyncio.sleep(_NOTIFY_SEND_DELAY)
+
+
+async def enqueue_notify(user_id: int, text: str):
+    """
+    Поставить уведомление в очередь рассылки
+    """
+    await NOTIFY_QUEUE.put((user_id, text))
+
+
 async def shutdown_bot():
     """
     Остановка бота
     """
-    global _bot, _application
-    
+    global _bot, _application, _notify_consumer_task
+
+    if _notify_consumer_task:
+        _notify_consumer_task.cancel()
+        _notify_consumer_task = None
+
     if _bot:
         await _bot.delete_webhook()
         logger.info("✅ Webhook deleted")
@@ -117,30 +247,42 @@ async def send_message(user_id: int, text: str, **kwargs):
 async def send_photo(user_id: int, photo_path: Path, caption: str = None, **kwargs):
     """
     Отправить фото пользователю
+
+    Файл читается в thread pool, чтобы не блокировать event loop на диске
     """
     bot = get_bot()
-    with open(photo_path, "rb") as photo_file:
-        await bot.send_photo(
-            chat_id=user_id,
-            photo=photo_file,
-            caption=caption,
-            **kwargs
-        )
+    photo_data = await asyncio.to_thread(Path(photo_path).read_bytes)
+    await bot.send_photo(
+        chat_id=user_id,
+        photo=photo_data,
+        caption=caption,
+        **kwargs
+    )
 
 
-async def send_document(user_id: int, document_path: Path, caption: str = None, filename: str = None, **kwargs):
+async def send_document(user_id: int, document, caption: str = None, filename: str = None, **kwargs):
     """
     Отправить файл пользователю
+
+    Принимает путь или готовые bytes: вызывающий, у которого данные
+    уже в памяти, не гоняет их через диск. Путь читается в thread
+    pool, чтобы не блокировать event loop на диске
     """
     bot = get_bot()
-    with open(document_path, "rb") as doc_file:
-        await bot.send_document(
-            chat_id=user_id,
-            document=doc_file,
-            caption=caption,
-            filename=filename or document_path.name,
-            **kwargs
-        )
+    if isinstance(document, (bytes, bytearray, memoryview)):
+        document_data = bytes(document)
+    else:
+        document_path = Path(document)
+        document_data = await asyncio.to_thread(document_path.read_bytes)
+        if filename is None:
+            filename = document_path.name
+    await bot.send_document(
+        chat_id=user_id,
+        document=document_data,
+        caption=caption,
+        filename=filename,
+        **kwargs
+    )
 
 
 def create_keyboard(buttons: list[list[dict]]) -> InlineKeyboardMarkup:
@@ -0,0 +1,64 @@
+"""
+Коалесцирование edit_message_text
+
+Под шквалом нажатий один экран редактируется многократно подряд и бот
+упирается в лимит ~30 запросов/с (flood-wait). Правки одного сообщения
+отправляются не чаще раза в _MIN_INTERVAL, причём при наложении
+уезжает только последнее состояние (last-write-wins), а глобальный
+семафор держит потолок одновременных вызовов API
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_MIN_INTERVAL = 0.8  # сек между правками одного сообщения
+_GLOBAL_LIMIT = asyncio.Semaphore(30)
+
+# Незавершённые правки и время последней правки по (chat_id, message_id)
+_pending: dict[tuple, asyncio.Task] = {}
+_last_edit: dict[tuple, float] = {}
+_LAST_EDIT_MAX = 10000
+
+
+async def submit_edit(query, text: str, **kwargs):
+    """
+    Запланировать правку сообщения callback-запроса
+
+    Если по этому сообщению уже ждёт правка - она отменяется,
+    отправится только самое свежее состояние
+    """
+    key = (query.message.chat_id, query.message.message_id)
+
+    prev = _pending.pop(key, None)
+    if prev is not None and not prev.done():
+        prev.cancel()
+
+    _pending[key] = asyncio.create_task(_edit_when_allowed(key, query, text, kwargs))
+
+
+async def _edit_when_allowed(key, query, text: str, kwargs: dict):
+    try:
+        # Без недавней правки шлём сразу, иначе ждём до разрешённого слота
+        last = _last_edit.get(key)
+        if last is not None:
+            wait = _MIN_INTERVAL - (time.monotonic() - last)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        if len(_last_edit) >= _LAST_EDIT_MAX:
+            now = time.monotonic()
+            for k in [k for k, ts in _last_edit.items() if now - ts > _MIN_INTERVAL]:
+                del _last_edit[k]
+        _last_edit[key] = time.monotonic()
+
+        async with _GLOBAL_LIMIT:
+            await query.edit_message_text(text, **kwargs)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.warning(f"Coalesced edit failed for {key}: {e}")
+    finally:
+        if _pending.get(key) is asyncio.current_task():
+            _pending.pop(key, None)
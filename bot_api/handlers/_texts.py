@@ -0,0 +1,73 @@
+"""
+Общие тексты и клавиатуры команд и callback'ов
+
+Команда и её callback-двойник (/topup и "topup", /help и "help", ...)
+отправляют один и тот же экран - текст и InlineKeyboardMarkup собираются
+здесь один раз при импорте и разделяются обоими модулями.
+"""
+from shared.config import GENERATION_COST, SUPPORT_USERNAME
+
+from bot_api.bot import create_keyboard
+
+HELP_TEXT = (
+    "📚 **Список команд:**\n\n"
+    "**Основные:**\n"
+    "/start - Начать работу\n"
+    "/help - Показать эту справку\n"
+    "/balance - Проверить баланс\n"
+    "/topup - Пополнить баланс\n\n"
+    "**Генерация:**\n"
+    "/prompt <текст> - Установить промпт\n"
+    "/generate - Сгенерировать изображение\n"
+    "/settings - Настройки генерации\n"
+    "/refs - Управление референсами\n"
+    "/clear - Очистить референсы\n"
+    "/history - История генераций\n\n"
+    "**Поддержка:**\n"
+    f"/support - Связаться с поддержкой\n\n"
+    f"💰 **Стоимость:** {GENERATION_COST} кредитов за генерацию\n"
+    f"💳 **1 кредит = 1₽**"
+)
+
+TOPUP_TEXT = (
+    "💳 **Пополнение баланса**\n\n"
+    "🎨 1 генерация = 10 ₽ (10 кредитов)\n"
+    "💳 1 кредит = 1 ₽\n\n"
+    "💵 **Пополнение баланса:**\n"
+    "• 100 ₽ → 100 кредитов\n"
+    "• 200 ₽ → 200 кредитов\n"
+    "• 300 ₽ → 300 кредитов\n\n"
+    "⚙️ **Правила:**\n"
+    "• Доступна 1 активная генерация одновременно\n"
+    "• При ошибке или отмене кредиты возвращаются\n"
+    "• Очередь может быть временно ограничена при нагрузке\n\n"
+    f"🆘 Поддержка: @{SUPPORT_USERNAME}"
+)
+
+# Тарифы отличаются от пополнения только заголовком
+TARIFFS_TEXT = TOPUP_TEXT.replace("💳 **Пополнение баланса**", "💰 **Тарифы**", 1)
+
+TOPUP_KEYBOARD = create_keyboard([
+    [{"text": "💳 Пополнить 100 ₽", "callback_data": "topup_100"}],
+    [{"text": "💳 Пополнить 200 ₽", "callback_data": "topup_200"}],
+    [{"text": "💳 Пополнить 300 ₽", "callback_data": "topup_300"}],
+    [{"text": "📊 Баланс", "callback_data": "balance"}],
+    [{"text": "❌ Закрыть", "callback_data": "close"}]
+])
+
+BALANCE_KEYBOARD = create_keyboard([
+    [{"text": "💳 Пополнить", "callback_data": "topup"}],
+    [{"text": "📊 История", "callback_data": "history"}]
+])
+
+SETTINGS_TEXT = (
+    "⚙️ **Настройки генерации**\n\n"
+    "Выберите параметр для изменения:"
+)
+
+SETTINGS_KEYBOARD = create_keyboard([
+    [{"text": "🌡 Температура", "callback_data": "setting_temperature"}],
+    [{"text": "📐 Соотношение сторон", "callback_data": "setting_aspect"}],
+    [{"text": "📏 Размер изображения", "callback_data": "setting_size"}],
+    [{"text": "🎲 Seed", "callback_data": "setting_seed"}]
+])
@@ -2,70 +2,121 @@
 Админ-панель для управления ботом
 """
 import logging
+import time
+from html import escape
+from collections import namedtuple
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
-from sqlalchemy import select, func, and_, desc
+from sqlalchemy import select, update as sql_update, func, and_, desc
+from sqlalchemy.exc import IntegrityError
 
 from shared.database import User, Balance, Transaction, Generation, AsyncSessionLocal
 from shared.referral_model import Referral
 from shared.config import ADMIN_IDS
+# Модуль, а не имя: admin импортируется из bot.py, поэтому берём атрибуты
+# лениво через модуль, чтобы не упасть на циклическом импорте
+from bot_api import bot as _bot_mod
+from bot_api.middleware.ban_check import invalidate_ban_cache
 from bot_api.services.balance_service import BalanceService
 
 logger = logging.getLogger(__name__)
 
+# Кэш статистики админ-панели: агрегаты по всем таблицам дорогие,
+# а для дашборда достаточно данных с запозданием до TTL
+AdminStats = namedtuple("AdminStats", ["total_users", "banned_users", "total_generations", "total_credits"])
+
+_ADMIN_STATS_CACHE: dict = {"ts": 0.0, "value": None}
+_ADMIN_STATS_TTL = 30.0  # секунд
+
+# Эмодзи статусов генерации (один словарь на модуль, не на итерацию)
+_STATUS_EMOJI = {
+    "pending": "⏳",
+    "processing": "🔄",
+    "completed": "✅",
+    "failed": "❌"
+}
+
+# Клавиатура главного меню статична - собираем один раз при импорте
+_ADMIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("👥 Пользователи", callback_data="admin_users"),
+        InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")
+    ],
+    [
+        InlineKeyboardButton("💰 Баланс", callback_data="admin_balance"),
+        InlineKeyboardButton("🎨 Генерации", callback_data="admin_generations")
+    ],
+    [
+        InlineKeyboardButton("🚫 Баны", callback_data="admin_bans"),
+        InlineKeyboardButton("❌ Закрыть", callback_data="close")
+    ]
+])
+
 
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
     return user_id in ADMIN_IDS
 
 
+async def _notify(user_id: int, text: str):
+    """
+    Поставить уведомление пользователю в очередь рассылки
+    (доставка идёт фоновым consumer'ом с ограничением скорости)
+    """
+    try:
+        await _bot_mod.enqueue_notify(user_id, text)
+    except Exception as e:
+        logger.error(f"Error queueing notification: {e}")
+
+
+async def _fetch_admin_stats(session) -> AdminStats:
+    """
+    Собрать статистику для главного меню админ-панели
+
+    Все четыре агрегата собираются одним запросом (scalar subqueries),
+    чтобы не платить 4 round-trip до Postgres.
+    """
+    stmt = select(
+        select(func.count(User.id)).scalar_subquery().label("total_users"),
+        select(func.count(User.id)).where(User.is_banned == True).scalar_subquery().label("banned_users"),
+        select(func.count(Generation.id)).scalar_subquery().label("total_generations"),
+        select(func.coalesce(func.sum(Balance.credits_available), 0)).scalar_subquery().label("total_credits"),
+    )
+    row = (await session.execute(stmt)).one()
+
+    return AdminStats(row[0] or 0, row[1] or 0, row[2] or 0, row[3] or 0)
+
+
+async def _get_admin_stats() -> AdminStats:
+    """
+    Получить статистику с ленивым обновлением кэша (TTL)
+    """
+    now = time.monotonic()
+
+    if _ADMIN_STATS_CACHE["value"] is not None and now - _ADMIN_STATS_CACHE["ts"] < _ADMIN_STATS_TTL:
+        return _ADMIN_STATS_CACHE["value"]
+
+    async with AsyncSessionLocal() as session:
+        stats = await _fetch_admin_stats(session)
+
+    _ADMIN_STATS_CACHE["ts"] = now
+    _ADMIN_STATS_CACHE["value"] = stats
+
+    return stats
+
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /admin - главное меню админ-панели
     """
-    user_id = update.effective_user.id
-    
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к админ-панели")
-        return
-    
-    async with AsyncSessionLocal() as session:
-        # Статистика
-        result = await session.execute(select(func.count(User.id)))
-        total_users = result.scalar() or 0
-        
-        result = await session.execute(
-            select(func.count(User.id)).where(User.is_banned == True)
-        )
-        banned_users = result.scalar() or 0
-        
-        result = await session.execute(select(func.count(Generation.id)))
-        total_generations = result.scalar() or 0
-        
-        result = await session.execute(
-            select(func.sum(Balance.credits_available))
-        )
-        total_credits = result.scalar() or 0
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("👥 Пользователи", callback_data="admin_users"),
-            InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")
-        ],
-        [
-            InlineKeyboardButton("💰 Баланс", callback_data="admin_balance"),
-            InlineKeyboardButton("🎨 Генерации", callback_data="admin_generations")
-        ],
-        [
-            InlineKeyboardButton("🚫 Баны", callback_data="admin_bans"),
-            InlineKeyboardButton("❌ Закрыть", callback_data="close")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
+    # Статистика (кэшируется на _ADMIN_STATS_TTL секунд)
+    total_users, banned_users, total_generations, total_credits = await _get_admin_stats()
+
     text = (
-        f"🔧 **Админ-панель**\n\n"
+        f"🔧 <b>Админ-панель</b>\n\n"
         f"👥 Пользователей: {total_users}\n"
         f"🚫 Забанено: {banned_users}\n"
         f"🎨 Генераций: {total_generations}\n"
@@ -73,23 +124,20 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Выберите действие:"
     )
     
-    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.message.reply_text(text, reply_markup=_ADMIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
 
 
 async def add_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /add_credits <user_id> <amount>
     """
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к этой команде")
-        return
-    
     if len(context.args) != 2:
         await update.message.reply_text(
-            "❌ Использование: `/add_credits <user_id> <amount>`",
-            parse_mode="Markdown"
+            "❌ Использование: <code>/add_credits &lt;user_id&gt; &lt;amount&gt;</code>",
+            parse_mode=ParseMode.HTML
         )
         return
     
@@ -102,44 +150,30 @@ async def add_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         
         async with AsyncSessionLocal() as session:
-            # Проверяем существование пользователя
-            result = await session.execute(
-                select(User).where(User.telegram_id == target_user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if not user:
+            # Начисляем кредиты одним UPDATE ... RETURNING;
+            # несуществующий пользователь ловится FK-констрейнтом
+            try:
+                new_balance = await BalanceService.add_credits(
+                    session=session,
+                    user_id=target_user_id,
+                    amount=amount,
+                    reference_id=user_id,  # ID админа
+                    transaction_type="admin_adjust"
+                )
+            except IntegrityError:
                 await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
                 return
-            
-            # Начисляем кредиты
-            await BalanceService.add_credits(
-                session=session,
-                user_id=target_user_id,
-                amount=amount,
-                reference_id=user_id,  # ID админа
-                transaction_type="admin_adjust"
-            )
-            
-            await session.commit()
-            
-            # Получаем новый баланс
-            balance_info = await BalanceService.get_balance(session, target_user_id)
-        
+
         await update.message.reply_text(
             f"✅ Начислено {amount} кредитов пользователю {target_user_id}\n"
-            f"💳 Новый баланс: {balance_info['credits_available']} кредитов"
+            f"💳 Новый баланс: {new_balance} кредитов"
         )
         
-        # Уведомляем пользователя
-        try:
-            from bot_api.bot import send_message
-            await send_message(
-                target_user_id,
-                f"🎁 Вам начислено {amount} кредитов администратором!"
-            )
-        except Exception as e:
-            logger.error(f"Error sending notification: {e}")
+        # Ставим уведомление в очередь рассылки (не ждём доставки)
+        await _notify(
+            target_user_id,
+            f"🎁 Вам начислено {amount} кредитов администратором!"
+        )
     
     except ValueError:
         await update.message.reply_text("❌ Неверный формат. Используйте числа.")
@@ -152,16 +186,13 @@ async def set_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     Команда /set_credits <user_id> <amount>
     """
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к этой команде")
-        return
-    
     if len(context.args) != 2:
         await update.message.reply_text(
-            "❌ Использование: `/set_credits <user_id> <amount>`",
-            parse_mode="Markdown"
+            "❌ Использование: <code>/set_credits &lt;user_id&gt; &lt;amount&gt;</code>",
+            parse_mode=ParseMode.HTML
         )
         return
     
@@ -173,23 +204,31 @@ async def set_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ Сумма не может быть отрицательной")
             return
         
-        async with AsyncSessionLocal() as session:
-            # Получаем текущий баланс
-            result = await session.execute(
-                select(Balance).where(Balance.user_id == target_user_id)
+        # session.begin(): одна явная транзакция, commit на выходе из блока
+        async with AsyncSessionLocal() as session, session.begin():
+            # Один атомарный UPDATE вместо SELECT+UPDATE.
+            # Подзапрос в RETURNING видит снимок строки до обновления,
+            # поэтому возвращает старый баланс
+            old_balance = (
+                select(Balance.credits_available)
+                .where(Balance.user_id == target_user_id)
+                .scalar_subquery()
             )
-            balance = result.scalar_one_or_none()
-            
-            if not balance:
+            stmt = (
+                sql_update(Balance)
+                .where(Balance.user_id == target_user_id)
+                .values(credits_available=new_amount)
+                .returning(old_balance.label("old_amount"))
+            )
+            row = (await session.execute(stmt)).first()
+
+            if row is None:
                 await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
                 return
-            
-            old_amount = balance.credits_available
+
+            old_amount = row.old_amount
             difference = new_amount - old_amount
-            
-            # Устанавливаем новый баланс
-            balance.credits_available = new_amount
-            
+
             # Создаём транзакцию
             transaction = Transaction(
                 user_id=target_user_id,
@@ -199,23 +238,17 @@ async def set_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 description=f"Admin set balance: {old_amount} → {new_amount}"
             )
             session.add(transaction)
-            
-            await session.commit()
-        
+
         await update.message.reply_text(
             f"✅ Баланс пользователя {target_user_id} установлен на {new_amount} кредитов\n"
             f"📊 Было: {old_amount}, изменение: {difference:+d}"
         )
         
-        # Уведомляем пользователя
-        try:
-            from bot_api.bot import send_message
-            await send_message(
-                target_user_id,
-                f"💳 Ваш баланс изменён администратором: {new_amount} кредитов"
-            )
-        except Exception as e:
-            logger.error(f"Error sending notification: {e}")
+        # Ставим уведомление в очередь рассылки (не ждём доставки)
+        await _notify(
+            target_user_id,
+            f"💳 Ваш баланс изменён администратором: {new_amount} кредитов"
+        )
     
     except ValueError:
         await update.message.reply_text("❌ Неверный формат. Используйте числа.")
@@ -228,16 +261,13 @@ async def user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /user <user_id> - информация о пользователе
     """
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к этой команде")
-        return
-    
     if len(context.args) != 1:
         await update.message.reply_text(
-            "❌ Использование: `/user <user_id>`",
-            parse_mode="Markdown"
+            "❌ Использование: <code>/user &lt;user_id&gt;</code>",
+            parse_mode=ParseMode.HTML
         )
         return
     
@@ -245,31 +275,49 @@ async def user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id = int(context.args[0])
         
         async with AsyncSessionLocal() as session:
-            # Получаем пользователя
-            result = await session.execute(
-                select(User).where(User.telegram_id == target_user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if not user:
+            # Пользователь + баланс + агрегаты одним запросом (scalar subqueries)
+            # Только нужные колонки User - без гидрации ORM-модели
+            stmt = select(
+                User.username,
+                User.first_name,
+                User.registered_at,
+                User.is_banned,
+                User.referred_by,
+                select(func.coalesce(Balance.credits_available, 0)).where(
+                    Balance.user_id == target_user_id
+                ).scalar_subquery().label("credits_available"),
+                select(func.coalesce(Balance.credits_reserved, 0)).where(
+                    Balance.user_id == target_user_id
+                ).scalar_subquery().label("credits_reserved"),
+                select(func.count(Referral.id)).where(
+                    Referral.referrer_id == target_user_id
+                ).scalar_subquery().label("referrals_count"),
+                select(func.count(Generation.id)).where(
+                    Generation.user_id == target_user_id
+                ).scalar_subquery().label("generations_count"),
+                select(func.coalesce(func.sum(Transaction.amount), 0)).where(
+                    and_(
+                        Transaction.user_id == target_user_id,
+                        Transaction.transaction_type == "topup"
+                    )
+                ).scalar_subquery().label("total_topup"),
+            ).where(User.telegram_id == target_user_id)
+
+            row = (await session.execute(stmt)).one_or_none()
+
+            if not row:
                 await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
                 return
-            
-            # Баланс
-            balance_info = await BalanceService.get_balance(session, target_user_id)
-            
-            # Рефералы
-            result = await session.execute(
-                select(func.count(Referral.id)).where(Referral.referrer_id == target_user_id)
-            )
-            referrals_count = result.scalar() or 0
-            
-            # Генерации
-            result = await session.execute(
-                select(func.count(Generation.id)).where(Generation.user_id == target_user_id)
-            )
-            generations_count = result.scalar() or 0
-            
+
+            user = row
+            balance_info = {
+                "credits_available": row.credits_available or 0,
+                "credits_reserved": row.credits_reserved or 0,
+            }
+            referrals_count = row.referrals_count or 0
+            generations_count = row.generations_count or 0
+            total_topup = row.total_topup or 0
+
             # Последние генерации
             result = await session.execute(
                 select(Generation).where(
@@ -277,50 +325,39 @@ async def user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ).order_by(desc(Generation.created_at)).limit(5)
             )
             recent_generations = result.scalars().all()
-            
-            # Платежи
-            result = await session.execute(
-                select(func.sum(Transaction.amount)).where(
-                    and_(
-                        Transaction.user_id == target_user_id,
-                        Transaction.transaction_type == "topup"
-                    )
-                )
-            )
-            total_topup = result.scalar() or 0
         
         # Формируем ответ
+        # Пользовательские поля экранируем, чтобы HTML-парсер Telegram
+        # не падал на спецсимволах в имени/username
         text = (
-            f"👤 **Пользователь {target_user_id}**\n\n"
-            f"**Основная информация:**\n"
-            f"• Username: @{user.username or 'нет'}\n"
-            f"• Имя: {user.first_name or 'нет'}\n"
+            f"👤 <b>Пользователь {target_user_id}</b>\n\n"
+            f"<b>Основная информация:</b>\n"
+            f"• Username: @{escape(user.username or 'нет')}\n"
+            f"• Имя: {escape(user.first_name or 'нет')}\n"
             f"• Регистрация: {user.registered_at.strftime('%d.%m.%Y %H:%M')}\n"
             f"• Статус: {'🚫 Забанен' if user.is_banned else '✅ Активен'}\n\n"
-            f"**Баланс:**\n"
+            f"<b>Баланс:</b>\n"
             f"• Доступно: {balance_info['credits_available']} кредитов\n"
             f"• Зарезервировано: {balance_info['credits_reserved']} кредитов\n"
             f"• Всего пополнено: {total_topup} кредитов\n\n"
-            f"**Активность:**\n"
+            f"<b>Активность:</b>\n"
             f"• Генераций: {generations_count}\n"
             f"• Рефералов: {referrals_count}\n\n"
         )
         
         if user.referred_by:
-            text += f"**Реферал:**\n• Пригласил: {user.referred_by}\n\n"
+            text += f"<b>Реферал:</b>\n• Пригласил: {user.referred_by}\n\n"
         
         if recent_generations:
-            text += "**Последние генерации:**\n"
+            # Собираем строки списком - без повторной переаллокации text
+            parts = ["<b>Последние генерации:</b>\n"]
             for gen in recent_generations:
-                status_emoji = {
-                    "pending": "⏳",
-                    "processing": "🔄",
-                    "completed": "✅",
-                    "failed": "❌"
-                }.get(gen.status, "❓")
-                text += f"• {status_emoji} {gen.created_at.strftime('%d.%m %H:%M')} - {gen.status}\n"
+                parts.append(
+                    f"• {_STATUS_EMOJI.get(gen.status, '❓')} {gen.created_at:%d.%m %H:%M} - {gen.status}\n"
+                )
+            text += "".join(parts)
         
-        await update.message.reply_text(text, parse_mode="Markdown")
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     
     except ValueError:
         await update.message.reply_text("❌ Неверный формат user_id")
@@ -333,16 +370,13 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /ban <user_id> [причина]
     """
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к этой команде")
-        return
-    
     if len(context.args) < 1:
         await update.message.reply_text(
-            "❌ Использование: `/ban <user_id> [причина]`",
-            parse_mode="Markdown"
+            "❌ Использование: <code>/ban &lt;user_id&gt; [причина]</code>",
+            parse_mode=ParseMode.HTML
         )
         return
     
@@ -350,42 +384,43 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id = int(context.args[0])
         reason = " ".join(context.args[1:]) if len(context.args) > 1 else "Не указана"
         
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == target_user_id)
+        # session.begin(): одна явная транзакция, commit на выходе из блока
+        async with AsyncSessionLocal() as session, session.begin():
+            # Один атомарный UPDATE вместо SELECT+UPDATE (нет окна гонки)
+            stmt = (
+                sql_update(User)
+                .where(User.telegram_id == target_user_id, User.is_banned == False)
+                .values(is_banned=True, banned_at=datetime.now(), ban_reason=reason)
+                .returning(User.id)
             )
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
-                return
-            
-            if user.is_banned:
-                await update.message.reply_text(f"⚠️ Пользователь {target_user_id} уже забанен")
+            row = (await session.execute(stmt)).first()
+
+            if row is None:
+                # Отличаем "не найден" от "уже забанен"
+                result = await session.execute(
+                    select(User.id).where(User.telegram_id == target_user_id)
+                )
+                if result.scalar_one_or_none() is None:
+                    await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
+                else:
+                    await update.message.reply_text(f"⚠️ Пользователь {target_user_id} уже забанен")
                 return
-            
-            user.is_banned = True
-            user.banned_at = datetime.now()
-            user.ban_reason = reason
-            
-            await session.commit()
         
+        # Сбрасываем Redis-кэш статуса - бан применяется сразу
+        await invalidate_ban_cache(target_user_id)
+
         await update.message.reply_text(
             f"🚫 Пользователь {target_user_id} забанен\n"
             f"📝 Причина: {reason}"
         )
         
-        # Уведомляем пользователя
-        try:
-            from bot_api.bot import send_message
-            await send_message(
-                target_user_id,
-                f"🚫 Вы были заблокированы.\n\n"
-                f"Причина: {reason}\n\n"
-                f"Для разблокировки обратитесь в поддержку: @Bashirov1111"
-            )
-        except Exception as e:
-            logger.error(f"Error sending ban notification: {e}")
+        # Ставим уведомление в очередь рассылки (не ждём доставки)
+        await _notify(
+            target_user_id,
+            f"🚫 Вы были заблокированы.\n\n"
+            f"Причина: {reason}\n\n"
+            f"Для разблокировки обратитесь в поддержку: @Bashirov1111"
+        )
     
     except ValueError:
         await update.message.reply_text("❌ Неверный формат user_id")
@@ -398,53 +433,51 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /unban <user_id>
     """
+    # Доступ ограничен фильтром filters.User(ADMIN_IDS) при регистрации
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к этой команде")
-        return
-    
     if len(context.args) != 1:
         await update.message.reply_text(
-            "❌ Использование: `/unban <user_id>`",
-            parse_mode="Markdown"
+            "❌ Использование: <code>/unban &lt;user_id&gt;</code>",
+            parse_mode=ParseMode.HTML
         )
         return
     
     try:
         target_user_id = int(context.args[0])
         
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == target_user_id)
+        # session.begin(): одна явная транзакция, commit на выходе из блока
+        async with AsyncSessionLocal() as session, session.begin():
+            # Один атомарный UPDATE вместо SELECT+UPDATE (нет окна гонки)
+            stmt = (
+                sql_update(User)
+                .where(User.telegram_id == target_user_id, User.is_banned == True)
+                .values(is_banned=False, banned_at=None, ban_reason=None)
+                .returning(User.id)
             )
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
-                return
-            
-            if not user.is_banned:
-                await update.message.reply_text(f"⚠️ Пользователь {target_user_id} не забанен")
+            row = (await session.execute(stmt)).first()
+
+            if row is None:
+                # Отличаем "не найден" от "не забанен"
+                result = await session.execute(
+                    select(User.id).where(User.telegram_id == target_user_id)
+                )
+                if result.scalar_one_or_none() is None:
+                    await update.message.reply_text(f"❌ Пользователь {target_user_id} не найден")
+                else:
+                    await update.message.reply_text(f"⚠️ Пользователь {target_user_id} не забанен")
                 return
-            
-            user.is_banned = False
-            user.banned_at = None
-            user.ban_reason = None
-            
-            await session.commit()
         
+        # Сбрасываем Redis-кэш статуса - разбан применяется сразу
+        await invalidate_ban_cache(target_user_id)
+
         await update.message.reply_text(f"✅ Пользователь {target_user_id} разбанен")
         
-        # Уведомляем пользователя
-        try:
-            from bot_api.bot import send_message
-            await send_message(
-                target_user_id,
-                "✅ Вы были разблокированы. Можете продолжать пользоваться ботом!"
-            )
-        except Exception as e:
-            logger.error(f"Error sending unban notification: {e}")
+        # Ставим уведомление в очередь рассылки (не ждём доставки)
+        await _notify(
+            target_user_id,
+            "✅ Вы были разблокированы. Можете продолжать пользоваться ботом!"
+        )
     
     except ValueError:
         await update.message.reply_text("❌ Неверный формат user_id")
@@ -1,7 +1,9 @@
 """
 Обработчики callback кнопок
 """
+import asyncio
 import logging
+import re
 from telegram import Update
 from telegram.ext import ContextTypes
 
@@ -9,64 +11,171 @@ from shared.database import AsyncSessionLocal
 from shared.config import GENERATION_COST, SUPPORT_URL, TOPUP_PACKAGES
 from bot_api.services.balance_service import BalanceService
 from bot_api.services.payment_service import PaymentService
+from bot_api.services.user_state import UserStateStore
 from bot_api.bot import create_keyboard
+from bot_api.edit_coalescer import submit_edit
+from bot_api.handlers._texts import (
+    HELP_TEXT,
+    TOPUP_TEXT,
+    TARIFFS_TEXT,
+    TOPUP_KEYBOARD,
+    BALANCE_KEYBOARD,
+)
 from bot_api.handlers.cancel import handle_cancel_callback as cancel_callback_handler
 from bot_api.handlers.referrals import handle_referrals_callback
 
 logger = logging.getLogger(__name__)
 
+# Статичные тексты и клавиатуры собираются один раз при импорте
+# (общие с командами - в _texts): callback становится чистым
+# edit_message_text с готовым payload
+
+# Меню настроек: (текст, клавиатура) для каждого параметра
+_SETTING_MENUS = {
+    "temperature": (
+        "🌡 **Температура** (креативность)\n\nВыберите значение:",
+        create_keyboard([
+            [{"text": "0.0 (детерминированный)", "callback_data": "set_temp_0.0"}],
+            [{"text": "0.3 (низкая)", "callback_data": "set_temp_0.3"}],
+            [{"text": "0.5 (средняя)", "callback_data": "set_temp_0.5"}],
+            [{"text": "0.7 (высокая)", "callback_data": "set_temp_0.7"}],
+            [{"text": "0.85 (очень высокая)", "callback_data": "set_temp_0.85"}],
+            [{"text": "1.0 (максимальная)", "callback_data": "set_temp_1.0"}]
+        ])
+    ),
+    "aspect": (
+        "📐 **Соотношение сторон**\n\nВыберите формат:",
+        create_keyboard([
+            [{"text": "1:1 (квадрат)", "callback_data": "set_aspect_1:1"}],
+            [{"text": "16:9 (горизонтальное)", "callback_data": "set_aspect_16:9"}],
+            [{"text": "9:16 (вертикальное)", "callback_data": "set_aspect_9:16"}],
+            [{"text": "4:3", "callback_data": "set_aspect_4:3"}],
+            [{"text": "3:4", "callback_data": "set_aspect_3:4"}]
+        ])
+    ),
+    "size": (
+        "📏 **Размер изображения**\n\nВыберите качество:",
+        create_keyboard([
+            [{"text": "1K (быстро)", "callback_data": "set_size_1K"}],
+            [{"text": "2K (среднее)", "callback_data": "set_size_2K"}],
+            [{"text": "4K (максимальное)", "callback_data": "set_size_4K"}]
+        ])
+    ),
+    "seed": (
+        "🎲 **Seed** (воспроизводимость)\n\nВыберите вариант:",
+        create_keyboard([
+            [{"text": "-1 (случайный)", "callback_data": "set_seed_-1"}],
+            [{"text": "Ввести вручную", "callback_data": "set_seed_manual"}]
+        ])
+    ),
+}
+
+# Полностью статичные экраны: готовый набор kwargs для edit_message_text,
+# диспетчер отправляет их напрямую, без вызова обработчика
+_STATIC_RESPONSES = {
+    "topup": {"text": TOPUP_TEXT, "reply_markup": TOPUP_KEYBOARD, "parse_mode": "Markdown"},
+    "tariffs": {"text": TARIFFS_TEXT, "reply_markup": TOPUP_KEYBOARD, "parse_mode": "Markdown"},
+    "help": {"text": HELP_TEXT, "parse_mode": "Markdown"},
+}
+
+# Допустимые суммы пополнения перечислимы из конфига - парсить
+# callback_data в рантайме не нужно
+TOPUP_CBS = {f"topup_{p['rub']}": p["rub"] for p in TOPUP_PACKAGES}
+
+# Значения настроек тоже перечислимы из клавиатур выше:
+# callback -> (ключ настройки, готовое значение, текст ответа)
+_SET_VALUES = {
+    **{
+        f"set_temp_{t}": ("temperature", float(t), f"✅ Температура установлена: {t}")
+        for t in ("0.0", "0.3", "0.5", "0.7", "0.85", "1.0")
+    },
+    **{
+        f"set_aspect_{a}": ("aspect_ratio", a, f"✅ Соотношение установлено: {a}")
+        for a in ("1:1", "16:9", "9:16", "4:3", "3:4")
+    },
+    **{
+        f"set_size_{s}": ("output_image_size", s, f"✅ Размер установлен: {s}")
+        for s in ("1K", "2K", "4K")
+    },
+    "set_seed_-1": ("seed", -1, "✅ Seed установлен: -1"),
+}
+
+# Эмодзи статусов генерации (один словарь на модуль, не на итерацию)
+_STATUS_EMOJI = {
+    "pending": "⏳",
+    "processing": "🎨",
+    "completed": "✅",
+    "failed": "❌"
+}
+
+
+def _user_semaphore(context, user_id: int) -> asyncio.Semaphore:
+    """
+    Семафор на пользователя: фоновые ветки одного чата выполняются
+    по порядку, разные чаты - параллельно
+    """
+    sems = context.bot_data.setdefault("_callback_sems", {})
+    sem = sems.get(user_id)
+    if sem is None:
+        sem = sems[user_id] = asyncio.Semaphore(1)
+    return sem
+
+
+async def _guarded(coro, context, user_id: int):
+    """
+    Выполнить ветку callback в фоне: ошибки логируем, не роняя таску
+    """
+    async with _user_semaphore(context, user_id):
+        try:
+            await coro
+        except Exception as e:
+            logger.error("Error handling callback for user %s: %s", user_id, e, exc_info=True)
+
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработчик всех callback кнопок
+
+    Сначала подтверждаем нажатие (query.answer), а тяжёлую ветку
+    выполняем фоновой таской - webhook-обработчик завершается сразу,
+    не дожидаясь БД и Telegram API
     """
     query = update.callback_query
     await query.answer()
-    
+
     callback_data = query.data
     user_id = update.effective_user.id
-    
-    # Роутинг по callback_data
-    if callback_data == "balance":
-        await handle_balance_callback(query, context)
-    
-    elif callback_data == "topup":
-        await handle_topup_callback(query, context)
-    
-    elif callback_data.startswith("topup_"):
-        rub_amount = int(callback_data.split("_")[1])
-        await handle_topup_payment_callback(query, context, rub_amount)
-    
-    elif callback_data == "tariffs":
-        await handle_tariffs_callback(query, context)
-    
-    elif callback_data == "help":
-        await handle_help_callback(query, context)
-    
-    elif callback_data.startswith("setting_"):
-        setting_name = callback_data.split("_", 1)[1]
-        await handle_setting_callback(query, context, setting_name)
-    
-    elif callback_data.startswith("set_"):
-        await handle_set_value_callback(query, context, callback_data)
-    
-    elif callback_data.startswith("cancel_gen:") or callback_data == "cancel_no":
-        await cancel_callback_handler(update, context)
-    
-    elif callback_data == "clear_refs":
-        await handle_clear_refs_callback(query, context)
-    
-    elif callback_data == "history":
-        await handle_history_callback(query, context)
-    
-    elif callback_data == "referrals":
-        await handle_referrals_callback(query, context)
-    
+
+    def spawn(coro):
+        asyncio.create_task(_guarded(coro, context, user_id))
+
+    # Статичные экраны уходят сразу, минуя слой обработчиков
+    static_kwargs = _STATIC_RESPONSES.get(callback_data)
+    if static_kwargs is not None:
+        spawn(submit_edit(query, **static_kwargs))
+        return
+
+    # Роутинг по callback_data: dict-lookup вместо цепочки сравнений
+    handler = _EXACT_ROUTES.get(callback_data)
+    if handler is not None:
+        spawn(handler(query, context))
+        return
+
+    # Параметризованные callback'и матчит один скомпилированный regex
+    # (C-уровень) вместо цепочки startswith
+    m = _CB_RE.match(callback_data)
+    if m is not None:
+        spawn(_PREFIX_HANDLERS[m["kind"]](query, update, context, m))
+        return
+
+    if callback_data == "cancel_no":
+        spawn(cancel_callback_handler(update, context))
+
     elif callback_data == "close":
-        await query.delete_message()
-    
+        spawn(query.delete_message())
+
     else:
-        await query.edit_message_text("❓ Неизвестная команда")
+        spawn(submit_edit(query, "❓ Неизвестная команда"))
 
 
 async def handle_balance_callback(query, context):
@@ -76,8 +185,8 @@ async def handle_balance_callback(query, context):
     user_id = query.from_user.id
     
     async with AsyncSessionLocal() as session:
-        balance_info = await BalanceService.get_balance(session, user_id)
-        
+        balance_info = await BalanceService.get_balance_cached(session, user_id)
+
         balance_text = (
             f"💰 **Ваш баланс:**\n\n"
             f"✅ Доступно: {balance_info['credits_available']} кредитов\n"
@@ -86,42 +195,14 @@ async def handle_balance_callback(query, context):
             f"💡 {balance_info['credits_available'] // GENERATION_COST} генераций доступно"
         )
         
-        keyboard = create_keyboard([
-            [{"text": "💳 Пополнить", "callback_data": "topup"}],
-            [{"text": "📊 История", "callback_data": "history"}]
-        ])
-        
-        await query.edit_message_text(balance_text, reply_markup=keyboard, parse_mode="Markdown")
+        await submit_edit(query, balance_text, reply_markup=BALANCE_KEYBOARD, parse_mode="Markdown")
 
 
 async def handle_topup_callback(query, context):
     """
     Показать пакеты пополнения
     """
-    topup_text = (
-        "💳 **Пополнение баланса**\n\n"
-        "🎨 1 генерация = 10 ₽ (10 кредитов)\n"
-        "💳 1 кредит = 1 ₽\n\n"
-        "💵 **Пополнение баланса:**\n"
-        "• 100 ₽ → 100 кредитов\n"
-        "• 200 ₽ → 200 кредитов\n"
-        "• 300 ₽ → 300 кредитов\n\n"
-        "⚙️ **Правила:**\n"
-        "• Доступна 1 активная генерация одновременно\n"
-        "• При ошибке или отмене кредиты возвращаются\n"
-        "• Очередь может быть временно ограничена при нагрузке\n\n"
-        f"🆘 Поддержка: @{SUPPORT_USERNAME}"
-    )
-    
-    keyboard = create_keyboard([
-        [{"text": "💳 Пополнить 100 ₽", "callback_data": "topup_100"}],
-        [{"text": "💳 Пополнить 200 ₽", "callback_data": "topup_200"}],
-        [{"text": "💳 Пополнить 300 ₽", "callback_data": "topup_300"}],
-        [{"text": "📊 Баланс", "callback_data": "balance"}],
-        [{"text": "❌ Закрыть", "callback_data": "close"}]
-    ])
-    
-    await query.edit_message_text(topup_text, reply_markup=keyboard, parse_mode="Markdown")
+    await submit_edit(query, TOPUP_TEXT, reply_markup=TOPUP_KEYBOARD, parse_mode="Markdown")
 
 
 async def handle_topup_payment_callback(query, context, rub_amount: int):
@@ -148,11 +229,11 @@ async def handle_topup_payment_callback(query, context, rub_amount: int):
             [{"text": "💳 Оплатить", "url": payment_url}]
         ])
         
-        await query.edit_message_text(payment_text, reply_markup=keyboard, parse_mode="Markdown")
+        await submit_edit(query, payment_text, reply_markup=keyboard, parse_mode="Markdown")
         
     except Exception as e:
-        logger.error(f"Error creating payment: {e}")
-        await query.edit_message_text(
+        logger.error("Error creating payment: %s", e)
+        await submit_edit(query, 
             f"❌ Ошибка создания платежа.\n\n"
             f"Попробуйте позже или обратитесь в поддержку: {SUPPORT_URL}"
         )
@@ -162,103 +243,28 @@ async def handle_tariffs_callback(query, context):
     """
     Показать тарифы
     """
-    tariffs_text = (
-        "💰 **Тарифы**\n\n"
-        "🎨 1 генерация = 10 ₽ (10 кредитов)\n"
-        "💳 1 кредит = 1 ₽\n\n"
-        "💵 **Пополнение баланса:**\n"
-        "• 100 ₽ → 100 кредитов\n"
-        "• 200 ₽ → 200 кредитов\n"
-        "• 300 ₽ → 300 кредитов\n\n"
-        "⚙️ **Правила:**\n"
-        "• Доступна 1 активная генерация одновременно\n"
-        "• При ошибке или отмене кредиты возвращаются\n"
-        "• Очередь может быть временно ограничена при нагрузке\n\n"
-        f"🆘 Поддержка: @{SUPPORT_USERNAME}"
-    )
-    
-    keyboard = create_keyboard([
-        [{"text": "💳 Пополнить 100 ₽", "callback_data": "topup_100"}],
-        [{"text": "💳 Пополнить 200 ₽", "callback_data": "topup_200"}],
-        [{"text": "💳 Пополнить 300 ₽", "callback_data": "topup_300"}],
-        [{"text": "📊 Баланс", "callback_data": "balance"}],
-        [{"text": "❌ Закрыть", "callback_data": "close"}]
-    ])
-    
-    await query.edit_message_text(tariffs_text, reply_markup=keyboard, parse_mode="Markdown")
+    await submit_edit(query, TARIFFS_TEXT, reply_markup=TOPUP_KEYBOARD, parse_mode="Markdown")
 
 
 async def handle_help_callback(query, context):
     """
     Показать справку
     """
-    help_text = (
-        "📚 **Список команд:**\n\n"
-        "**Основные:**\n"
-        "/start - Начать работу\n"
-        "/help - Показать справку\n"
-        "/balance - Проверить баланс\n"
-        "/topup - Пополнить баланс\n\n"
-        "**Генерация:**\n"
-        "/prompt <текст> - Установить промпт\n"
-        "/generate - Сгенерировать изображение\n"
-        "/settings - Настройки генерации\n"
-        "/refs - Управление референсами\n"
-        "/clear - Очистить референсы\n"
-        "/history - История генераций\n\n"
-        "**Поддержка:**\n"
-        f"/support - Связаться с поддержкой"
-    )
-    
-    await query.edit_message_text(help_text, parse_mode="Markdown")
+    await submit_edit(query, HELP_TEXT, parse_mode="Markdown")
 
 
 async def handle_setting_callback(query, context, setting_name: str):
     """
     Показать варианты настройки
     """
-    if setting_name == "temperature":
-        text = "🌡 **Температура** (креативность)\n\nВыберите значение:"
-        buttons = [
-            [{"text": "0.0 (детерминированный)", "callback_data": "set_temp_0.0"}],
-            [{"text": "0.3 (низкая)", "callback_data": "set_temp_0.3"}],
-            [{"text": "0.5 (средняя)", "callback_data": "set_temp_0.5"}],
-            [{"text": "0.7 (высокая)", "callback_data": "set_temp_0.7"}],
-            [{"text": "0.85 (очень высокая)", "callback_data": "set_temp_0.85"}],
-            [{"text": "1.0 (максимальная)", "callback_data": "set_temp_1.0"}]
-        ]
-    
-    elif setting_name == "aspect":
-        text = "📐 **Соотношение сторон**\n\nВыберите формат:"
-        buttons = [
-            [{"text": "1:1 (квадрат)", "callback_data": "set_aspect_1:1"}],
-            [{"text": "16:9 (горизонтальное)", "callback_data": "set_aspect_16:9"}],
-            [{"text": "9:16 (вертикальное)", "callback_data": "set_aspect_9:16"}],
-            [{"text": "4:3", "callback_data": "set_aspect_4:3"}],
-            [{"text": "3:4", "callback_data": "set_aspect_3:4"}]
-        ]
-    
-    elif setting_name == "size":
-        text = "📏 **Размер изображения**\n\nВыберите качество:"
-        buttons = [
-            [{"text": "1K (быстро)", "callback_data": "set_size_1K"}],
-            [{"text": "2K (среднее)", "callback_data": "set_size_2K"}],
-            [{"text": "4K (максимальное)", "callback_data": "set_size_4K"}]
-        ]
-    
-    elif setting_name == "seed":
-        text = "🎲 **Seed** (воспроизводимость)\n\nВыберите вариант:"
-        buttons = [
-            [{"text": "-1 (случайный)", "callback_data": "set_seed_-1"}],
-            [{"text": "Ввести вручную", "callback_data": "set_seed_manual"}]
-        ]
-    
-    else:
-        await query.edit_message_text("❓ Неизвестная настройка")
+    menu = _SETTING_MENUS.get(setting_name)
+
+    if menu is None:
+        await submit_edit(query, "❓ Неизвестная настройка")
         return
-    
-    keyboard = create_keyboard(buttons)
-    await query.edit_message_text(text, reply_markup=keyboard, parse_mode="Markdown")
+
+    text, keyboard = menu
+    await submit_edit(query, text, reply_markup=keyboard, parse_mode="Markdown")
 
 
 async def handle_set_value_callback(query, context, callback_data: str):
@@ -266,52 +272,27 @@ async def handle_set_value_callback(query, context, callback_data: str):
     Установить значение настройки
     """
     user_id = query.from_user.id
-    
-    # Инициализируем данные пользователя
-    if "user_data" not in context.bot_data:
-        context.bot_data["user_data"] = {}
-    
-    if user_id not in context.bot_data["user_data"]:
-        context.bot_data["user_data"][user_id] = {
-            "reference_images": [],
-            "prompt": None,
-            "settings": {
-                "temperature": 1.0,
-                "aspect_ratio": "16:9",
-                "output_image_size": "1K",
-                "seed": -1
-            }
-        }
-    
-    settings = context.bot_data["user_data"][user_id]["settings"]
-    
-    # Парсим callback_data
-    parts = callback_data.split("_", 2)
-    setting_type = parts[1]
-    value = parts[2]
-    
-    # Устанавливаем значение
-    if setting_type == "temp":
-        settings["temperature"] = float(value)
-        await query.edit_message_text(f"✅ Температура установлена: {value}")
-    
-    elif setting_type == "aspect":
-        settings["aspect_ratio"] = value
-        await query.edit_message_text(f"✅ Соотношение установлено: {value}")
-    
-    elif setting_type == "size":
-        settings["output_image_size"] = value
-        await query.edit_message_text(f"✅ Размер установлен: {value}")
-    
-    elif setting_type == "seed":
-        if value == "manual":
-            await query.edit_message_text(
-                "✏️ Введите seed (целое число):\n\n"
-                "Отправьте число в чат или используйте -1 для случайного seed."
-            )
-        else:
-            settings["seed"] = int(value)
-            await query.edit_message_text(f"✅ Seed установлен: {value}")
+
+    if callback_data == "set_seed_manual":
+        await submit_edit(query, 
+            "✏️ Введите seed (целое число):\n\n"
+            "Отправьте число в чат или используйте -1 для случайного seed."
+        )
+        return
+
+    # Значение и текст ответа предвычислены при импорте
+    entry = _SET_VALUES.get(callback_data)
+    if entry is None:
+        await submit_edit(query, "❓ Неизвестная настройка")
+        return
+
+    setting_key, value, message = entry
+
+    state = await UserStateStore.get(user_id)
+    state["settings"][setting_key] = value
+    await UserStateStore.set(user_id, state)
+
+    await submit_edit(query, message)
 
 
 async def handle_clear_refs_callback(query, context):
@@ -319,11 +300,10 @@ async def handle_clear_refs_callback(query, context):
     Очистить референсы
     """
     user_id = query.from_user.id
-    
-    if user_id in context.bot_data.get("user_data", {}):
-        context.bot_data["user_data"][user_id]["reference_images"] = []
-    
-    await query.edit_message_text("🗑 Все референсные изображения удалены.")
+
+    await UserStateStore.update(user_id, reference_images=[])
+
+    await submit_edit(query, "🗑 Все референсные изображения удалены.")
 
 
 async def handle_history_callback(query, context):
@@ -335,26 +315,55 @@ async def handle_history_callback(query, context):
     user_id = query.from_user.id
     
     async with AsyncSessionLocal() as session:
-        generations = await JobService.get_user_generations(session, user_id, limit=5)
-        
+        generations = await JobService.get_user_history(session, user_id, limit=5)
+
         if not generations:
-            await query.edit_message_text("📊 История генераций пуста.")
+            await submit_edit(query, "📊 История генераций пуста.")
             return
-        
-        history_text = "📊 **Последние генерации:**\n\n"
-        
-        for gen in generations:
-            status_emoji = {
-                "pending": "⏳",
-                "processing": "🎨",
-                "completed": "✅",
-                "failed": "❌"
-            }.get(gen.status, "❓")
-            
-            history_text += (
-                f"{status_emoji} {gen.status.upper()}\n"
-                f"📝 {gen.prompt[:50]}...\n"
-                f"🕐 {gen.created_at.strftime('%d.%m.%Y %H:%M')}\n\n"
-            )
-        
-        await query.edit_message_text(history_text, parse_mode="Markdown")
+
+        # "".join вместо += : одна аллокация результирующей строки
+        parts = ["📊 **Последние генерации:**\n\n"]
+        parts.extend(
+            f"{_STATUS_EMOJI.get(gen.status, '❓')} {gen.status.upper()}\n"
+            f"📝 {gen.prompt[:50]}...\n"
+            f"🕐 {gen.created_str}\n\n"
+            for gen in generations
+        )
+
+        await submit_edit(query, "".join(parts), parse_mode="Markdown")
+
+
+# ========== Таблицы роутинга ==========
+# Определяются после обработчиков: O(1) поиск по точному совпадению
+# плюс короткий список префиксов с извлечением аргумента
+
+def _make_topup_handler(rub_amount: int):
+    """Обработчик topup_<N> со 'впечённой' суммой - без парсинга в рантайме"""
+    def _handler(query, context):
+        return handle_topup_payment_callback(query, context, rub_amount)
+    return _handler
+
+
+_EXACT_ROUTES = {
+    "balance": handle_balance_callback,
+    "topup": handle_topup_callback,
+    "tariffs": handle_tariffs_callback,
+    "help": handle_help_callback,
+    "clear_refs": handle_clear_refs_callback,
+    "history": handle_history_callback,
+    "referrals": handle_referrals_callback,
+    # Известные суммы пополнения уходят по exact-маршруту:
+    # regex-ветка остаётся только как fallback для нестандартных сумм
+    **{cb: _make_topup_handler(rub) for cb, rub in TOPUP_CBS.items()},
+}
+
+# Параметризованные маршруты: один regex-проход определяет вид callback'а
+# и извлекает аргумент. Порядок альтернатив важен: "setting" раньше "set"
+_CB_RE = re.compile(r"^(?P<kind>setting|set|topup|cancel_gen)[_:](?P<arg>.+)$")
+
+_PREFIX_HANDLERS = {
+    "topup": lambda q, u, c, m: handle_topup_payment_callback(q, c, int(m["arg"])),
+    "setting": lambda q, u, c, m: handle_setting_callback(q, c, m["arg"]),
+    "set": lambda q, u, c, m: handle_set_value_callback(q, c, m.string),
+    "cancel_gen": lambda q, u, c, m: cancel_callback_handler(u, c),
+}
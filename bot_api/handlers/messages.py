@@ -7,6 +7,10 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from shared.config import DATA_DIR, MAX_REFERENCE_IMAGES
+from shared.redis_client import get_redis
+from bot_api.http_client import get_http_session
+from bot_api.services.user_state import UserStateStore
+from bot_api.webhook_reply import queue_reply
 
 logger = logging.getLogger(__name__)
 
@@ -14,56 +18,66 @@ logger = logging.getLogger(__name__)
 REFS_DIR = DATA_DIR / "references"
 REFS_DIR.mkdir(exist_ok=True)
 
+# Redis-set уже скачанных file_id: повторная загрузка того же фото
+# не ходит в Telegram за файлом заново
+_REFS_KEY = "refs:{user_id}"
+_REFS_TTL = 7 * 86400  # как у состояния пользователя
+
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработка загруженных фото (референсные изображения)
     """
     user_id = update.effective_user.id
-    
-    # Инициализируем данные пользователя
-    if "user_data" not in context.bot_data:
-        context.bot_data["user_data"] = {}
-    
-    if user_id not in context.bot_data["user_data"]:
-        context.bot_data["user_data"][user_id] = {
-            "reference_images": [],
-            "prompt": None,
-            "settings": {
-                "temperature": 1.0,
-                "aspect_ratio": "16:9",
-                "output_image_size": "1K",
-                "seed": -1
-            }
-        }
-    
-    user_data = context.bot_data["user_data"][user_id]
-    reference_images = user_data.get("reference_images", [])
-    
+
+    state = await UserStateStore.get(user_id)
+    reference_images = state.get("reference_images", [])
+
     # Проверяем лимит
     if len(reference_images) >= MAX_REFERENCE_IMAGES:
-        await update.message.reply_text(
+        queue_reply(
+            update,
             f"⚠️ Достигнут лимит референсных изображений ({MAX_REFERENCE_IMAGES})!\n\n"
             f"Используйте /clear для очистки."
         )
         return
     
-    # Скачиваем фото
     photo = update.message.photo[-1]  # Берем самое большое разрешение
-    file = await context.bot.get_file(photo.file_id)
-    
-    # Сохраняем локально
     filename = f"{user_id}_{photo.file_id}.jpg"
     file_path = REFS_DIR / filename
-    await file.download_to_drive(file_path)
-    
-    # Добавляем в список референсов
-    reference_images.append(str(file_path))
-    user_data["reference_images"] = reference_images
+
+    # Повторная отправка того же фото: файл уже на диске, get_file
+    # и скачивание не нужны
+    redis = await get_redis()
+    refs_key = _REFS_KEY.format(user_id=user_id)
+    already_saved = await redis.sismember(refs_key, photo.file_id) and file_path.exists()
+
+    if not already_saved:
+        # Скачиваем фото: стримим чанками через общую aiohttp-сессию
+        # вместо download_to_drive - файл не буферизуется целиком в
+        # памяти, а TCP/TLS-соединение переиспользуется
+        file = await context.bot.get_file(photo.file_id)
+
+        session = await get_http_session()
+        async with session.get(file.file_path) as resp:
+            resp.raise_for_status()
+            with open(file_path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(65536):
+                    f.write(chunk)
+
+        await redis.sadd(refs_key, photo.file_id)
+        await redis.expire(refs_key, _REFS_TTL)
     
-    logger.info(f"User {user_id} uploaded reference image: {filename}")
+    # Добавляем в список референсов (без дублей при повторной загрузке)
+    if str(file_path) not in reference_images:
+        reference_images.append(str(file_path))
+        await UserStateStore.update(user_id, reference_images=reference_images)
+
+    logger.info("User %s uploaded reference image: %s", user_id, filename)
     
-    await update.message.reply_text(
+    # Единственный ответ на апдейт - уезжает в теле webhook-ответа
+    queue_reply(
+        update,
         f"✅ Референсное изображение добавлено!\n\n"
         f"📊 Всего: {len(reference_images)}/{MAX_REFERENCE_IMAGES}\n\n"
         f"💡 Загрузите еще фото или установите промпт: /prompt ваш текст"
@@ -76,27 +90,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     user_id = update.effective_user.id
     text = update.message.text
-    
-    # Инициализируем данные пользователя
-    if "user_data" not in context.bot_data:
-        context.bot_data["user_data"] = {}
-    
-    if user_id not in context.bot_data["user_data"]:
-        context.bot_data["user_data"][user_id] = {
-            "reference_images": [],
-            "prompt": None,
-            "settings": {
-                "temperature": 1.0,
-                "aspect_ratio": "16:9",
-                "output_image_size": "1K",
-                "seed": -1
-            }
-        }
-    
+
     # Устанавливаем промпт
-    context.bot_data["user_data"][user_id]["prompt"] = text
-    
-    logger.info(f"User {user_id} set prompt: {text[:50]}...")
+    await UserStateStore.update(user_id, prompt=text)
+
+    logger.info("User %s set prompt: %.50s...", user_id, text)
     
     await update.message.reply_text(
         f"✅ Промпт установлен!\n\n"
@@ -2,6 +2,8 @@
 Обработчики реферальной системы
 """
 import logging
+from html import escape
+
 from telegram import Update
 from telegram.ext import ContextTypes
 
@@ -10,44 +12,63 @@ from shared.config import TELEGRAM_BOT_TOKEN
 from bot_api.services.referral_service_v2 import ReferralServiceV2, WELCOME_BONUS, REFERRAL_BONUS, REFERRER_REWARD
 from shared.config import REFERRAL_ACTIVATION_REQUIRED
 from bot_api.bot import create_keyboard
+from bot_api.webhook_reply import queue_reply
 
 logger = logging.getLogger(__name__)
 
+# Шаблон и клавиатуры собираются один раз при импорте: бонусные
+# константы впечатаны f-строкой, runtime-значения подставляет .format.
+# HTML вместо легаси-Markdown: парсится быстрее и не требует
+# экранирования "_" в username'ах
+_REF_TEMPLATE = (
+    "👥 <b>Реферальная программа</b>\n\n"
+    f"🎁 <b>Ваши бонусы:</b>\n"
+    f"• Новый пользователь: {WELCOME_BONUS} кредитов\n"
+    f"• По вашей ссылке: {REFERRAL_BONUS} кредитов\n"
+    f"• Вы получаете: {REFERRER_REWARD} кредитов за каждого реферала\n\n"
+    "📊 <b>Ваша статистика:</b>\n"
+    "• Приглашено: {referrals_count} человек\n"
+    "• Заработано: {total_earned} кредитов\n\n"
+    "🔗 <b>Ваша реферальная ссылка:</b>\n"
+    "<code>{ref_link}</code>\n\n"
+)
+
+_REF_FOOTER = (
+    f"📋 Отправьте эту ссылку друзьям!\n"
+    f"Они получат {REFERRAL_BONUS} кредитов, а вы {REFERRER_REWARD} кредитов за каждого!"
+)
+
+_REF_KEYBOARD_MAIN = create_keyboard([
+    [{"text": "📊 Мои рефералы", "callback_data": "referrals"}],
+    [{"text": "❌ Закрыть", "callback_data": "close"}]
+])
+
+_REF_KEYBOARD_CLOSE = create_keyboard([
+    [{"text": "❌ Закрыть", "callback_data": "close"}]
+])
+
 
 async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Команда /ref - реферальная система
     """
     user_id = update.effective_user.id
-    
+
     async with AsyncSessionLocal() as session:
         stats = await ReferralServiceV2.get_referral_stats(session, user_id)
-    
-    # Формируем реферальную ссылку
-    bot_username = context.bot.username
+
+    # Формируем реферальную ссылку (username закэширован при старте)
+    bot_username = context.bot_data.get("bot_username") or context.bot.username
     ref_link = f"https://t.me/{bot_username}?start={stats['referral_code']}"
-    
-    ref_text = (
-        "👥 **Реферальная программа**\n\n"
-        f"🎁 **Ваши бонусы:**\n"
-        f"• Новый пользователь: {NEW_USER_BONUS} кредитов\n"
-        f"• По вашей ссылке: {REFERRAL_USER_BONUS} кредитов\n"
-        f"• Вы получаете: {REFERRER_BONUS} кредитов за каждого реферала\n\n"
-        f"📊 **Ваша статистика:**\n"
-        f"• Приглашено: {stats['referrals_count']} человек\n"
-        f"• Заработано: {stats['total_earned']} кредитов\n\n"
-        f"🔗 **Ваша реферальная ссылка:**\n"
-        f"`{ref_link}`\n\n"
-        f"📋 Отправьте эту ссылку друзьям!\n"
-        f"Они получат {REFERRAL_USER_BONUS} кредитов, а вы {REFERRER_BONUS} кредитов за каждого!"
-    )
-    
-    keyboard = create_keyboard([
-        [{"text": "📊 Мои рефералы", "callback_data": "referrals"}],
-        [{"text": "❌ Закрыть", "callback_data": "close"}]
-    ])
-    
-    await update.message.reply_text(ref_text, reply_markup=keyboard, parse_mode="Markdown")
+
+    ref_text = _REF_TEMPLATE.format(
+        referrals_count=stats['referrals_count'],
+        total_earned=stats['total_earned'],
+        ref_link=ref_link
+    ) + _REF_FOOTER
+
+    # Единственный ответ на апдейт - уезжает в теле webhook-ответа
+    queue_reply(update, ref_text, reply_markup=_REF_KEYBOARD_MAIN, parse_mode="HTML")
 
 
 async def handle_referrals_callback(query, context):
@@ -59,36 +80,25 @@ async def handle_referrals_callback(query, context):
     async with AsyncSessionLocal() as session:
         stats = await ReferralServiceV2.get_referral_stats(session, user_id)
     
-    # Формируем реферальную ссылку
-    bot_username = context.bot.username
+    # Формируем реферальную ссылку (username закэширован при старте)
+    bot_username = context.bot_data.get("bot_username") or context.bot.username
     ref_link = f"https://t.me/{bot_username}?start={stats['referral_code']}"
     
-    ref_text = (
-        "👥 **Реферальная программа**\n\n"
-        f"🎁 **Ваши бонусы:**\n"
-        f"• Новый пользователь: {NEW_USER_BONUS} кредитов\n"
-        f"• По вашей ссылке: {REFERRAL_USER_BONUS} кредитов\n"
-        f"• Вы получаете: {REFERRER_BONUS} кредитов за каждого реферала\n\n"
-        f"📊 **Ваша статистика:**\n"
-        f"• Приглашено: {stats['referrals_count']} человек\n"
-        f"• Заработано: {stats['total_earned']} кредитов\n\n"
-        f"🔗 **Ваша реферальная ссылка:**\n"
-        f"`{ref_link}`\n\n"
+    ref_text = _REF_TEMPLATE.format(
+        referrals_count=stats['referrals_count'],
+        total_earned=stats['total_earned'],
+        ref_link=ref_link
     )
-    
+
     # Добавляем список последних рефералов
     if stats['referrals']:
-        ref_text += "📋 **Последние рефералы:**\n"
+        ref_text += "📋 <b>Последние рефералы:</b>\n"
         for i, ref in enumerate(stats['referrals'][:5], 1):
-            username = f"@{ref['username']}" if ref['username'] else ref['first_name']
+            username = f"@{escape(ref['username'])}" if ref['username'] else escape(ref['first_name'] or '')
             date = ref['registered_at'].strftime('%d.%m.%Y')
             ref_text += f"{i}. {username} - {date}\n"
-        
+
         if stats['referrals_count'] > 5:
             ref_text += f"\n...и ещё {stats['referrals_count'] - 5} человек\n"
-    
-    keyboard = create_keyboard([
-        [{"text": "❌ Закрыть", "callback_data": "close"}]
-    ])
-    
-    await query.edit_message_text(ref_text, reply_markup=keyboard, parse_mode="Markdown")
+
+    await query.edit_message_text(ref_text, reply_markup=_REF_KEYBOARD_CLOSE, parse_mode="HTML")
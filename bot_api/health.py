@@ -1,25 +1,37 @@
 """
 Health check endpoints
 """
+import asyncio
+import json
 import logging
 from fastapi import APIRouter, Response
 from sqlalchemy import text
 
 from shared.database import AsyncSessionLocal
-from shared.redis_client import redis_client
+from shared.redis_client import get_redis
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/health", tags=["health"])
 
+# Тело базового health check сериализуется один раз при импорте:
+# пробы балансировщика бьют сюда каждые пару секунд, JSON-энкодер
+# на каждый запрос не нужен. Cache-Control страхует от штормов проб
+_HEALTHY_BODY = json.dumps({
+    "status": "healthy",
+    "service": "Nano Banana Pro Bot API"
+}).encode()
+_HEALTHY_HEADERS = {"Cache-Control": "max-age=1"}
+
 
 @router.get("/")
 async def health_check():
     """Базовый health check"""
-    return {
-        "status": "healthy",
-        "service": "Nano Banana Pro Bot API"
-    }
+    return Response(
+        content=_HEALTHY_BODY,
+        media_type="application/json",
+        headers=_HEALTHY_HEADERS
+    )
 
 
 @router.get("/db")
@@ -53,8 +65,9 @@ async def health_check_redis(response: Response):
     Health check для Redis
     """
     try:
-        await redis_client.ping()
-        
+        client = await get_redis()
+        await client.ping()
+
         return {
             "status": "healthy",
             "service": "redis"
@@ -74,29 +87,35 @@ async def health_check_redis(response: Response):
 async def health_check_all(response: Response):
     """
     Полный health check всех сервисов
+
+    Проверки идут параллельно (gather): латентность эндпоинта -
+    max(pg, redis), а не их сумма
     """
+    async def pg_probe() -> tuple[str, str]:
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(text("SELECT 1"))
+            return "postgresql", "healthy"
+        except Exception as e:
+            return "postgresql", f"unhealthy: {str(e)}"
+
+    async def redis_probe() -> tuple[str, str]:
+        try:
+            client = await get_redis()
+            await client.ping()
+            return "redis", "healthy"
+        except Exception as e:
+            return "redis", f"unhealthy: {str(e)}"
+
+    probes = await asyncio.gather(pg_probe(), redis_probe())
+
     results = {
         "status": "healthy",
-        "services": {}
+        "services": dict(probes)
     }
-    
-    # PostgreSQL
-    try:
-        async with AsyncSessionLocal() as session:
-            await session.execute(text("SELECT 1"))
-        results["services"]["postgresql"] = "healthy"
-    except Exception as e:
-        results["services"]["postgresql"] = f"unhealthy: {str(e)}"
+    if any(state != "healthy" for _, state in probes):
         results["status"] = "unhealthy"
-    
-    # Redis
-    try:
-        await redis_client.ping()
-        results["services"]["redis"] = "healthy"
-    except Exception as e:
-        results["services"]["redis"] = f"unhealthy: {str(e)}"
-        results["status"] = "unhealthy"
-    
+
     # Устанавливаем код ответа
     if results["status"] == "unhealthy":
         response.status_code = 503
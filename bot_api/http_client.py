@@ -0,0 +1,35 @@
+"""
+Общая aiohttp-сессия процесса
+
+Одна ClientSession на процесс переиспользует TCP/TLS-соединения
+между запросами (скачивание файлов Telegram и т.п.) вместо
+рукопожатия на каждый вызов
+"""
+import logging
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Получить общую aiohttp-сессию (ленивая инициализация)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+        logger.info("HTTP session created")
+    return _session
+
+
+async def close_http_session():
+    """Закрыть общую сессию при остановке приложения"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("HTTP session closed")
+    _session = None
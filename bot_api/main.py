@@ -2,28 +2,41 @@
 FastAPI приложение для Bot API
 Обрабатывает Telegram webhook и ЮКасса webhook
 """
+import json
 import logging
+import queue
 from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.responses import JSONResponse
 
-from shared.database import init_db, close_db
+from shared.database import init_db, close_db, warm_db_pool
 from shared.redis_client import close_redis
 from shared.config import LOG_LEVEL, LOG_FORMAT, DATA_DIR
 from bot_api.webhooks.telegram import router as telegram_router
 from bot_api.webhooks.yookassa import router as yookassa_router
 from bot_api.health import router as health_router
 from bot_api.bot import setup_bot, shutdown_bot
+from bot_api.http_client import close_http_session
+
+# Настройка логирования: записи уходят в очередь, а блокирующие
+# write() в файл/stderr делает фоновый QueueListener-поток - event
+# loop не останавливается на дисковом I/O при каждом logger.info
+_log_queue = queue.Queue(-1)
+_log_formatter = logging.Formatter(LOG_FORMAT)
+
+_file_handler = logging.FileHandler(DATA_DIR / "logs" / "bot_api.log")
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_log_formatter)
+
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
 
-# Настройка логирования
 logging.basicConfig(
     level=LOG_LEVEL,
-    format=LOG_FORMAT,
-    handlers=[
-        logging.FileHandler(DATA_DIR / "logs" / "bot_api.log"),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -38,6 +51,7 @@ async def lifespan(app: FastAPI):
     
     # Инициализация БД
     await init_db()
+    await warm_db_pool()
     logger.info("✅ Database initialized")
     
     # Настройка бота
@@ -49,9 +63,12 @@ async def lifespan(app: FastAPI):
     # Shutdown
     logger.info("🛑 Shutting down Bot API...")
     await shutdown_bot()
+    await close_http_session()
     await close_db()
     await close_redis()
     logger.info("✅ Bot API stopped")
+    # Дописываем хвост очереди логов и останавливаем listener
+    _log_listener.stop()
 
 
 # Создание FastAPI приложения
@@ -69,14 +86,23 @@ app.include_router(telegram_router)
 app.include_router(yookassa_router)
 
 
+# Тело корневого health check сериализуется один раз при импорте
+_ROOT_BODY = json.dumps({
+    "status": "ok",
+    "service": "Nano Banana Pro Bot API",
+    "version": "2.0.0"
+}).encode()
+_ROOT_HEADERS = {"Cache-Control": "max-age=1"}
+
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
-    return {
-        "status": "ok",
-        "service": "Nano Banana Pro Bot API",
-        "version": "2.0.0"
-    }
+    return Response(
+        content=_ROOT_BODY,
+        media_type="application/json",
+        headers=_ROOT_HEADERS
+    )
 
 
 @app.get("/health")
@@ -98,13 +124,21 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 
 if __name__ == "__main__":
+    import os
+
     import uvicorn
     from shared.config import API_HOST, API_PORT
-    
+
+    # uvloop + httptools (идут в составе uvicorn[standard]) заметно
+    # быстрее дефолтных asyncio/h11 на webhook-нагрузке; несколько
+    # воркеров допустимы - состояние пользователей живёт в Redis
     uvicorn.run(
         "bot_api.main:app",
         host=API_HOST,
         port=API_PORT,
         reload=False,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "2")),
         log_level=LOG_LEVEL.lower()
     )
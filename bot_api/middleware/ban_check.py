@@ -7,45 +7,79 @@ from telegram.ext import ContextTypes
 from sqlalchemy import select
 
 from shared.database import User, AsyncSessionLocal
+from shared.redis_client import cache
 
 logger = logging.getLogger(__name__)
 
+# Статус бана кэшируется в Redis: проверка идёт перед КАЖДЫМ апдейтом,
+# и без кэша это лишний запрос к Postgres на каждое сообщение.
+# Короткий TTL ограничивает задержку применения бана
+_BAN_KEY = "ban:{user_id}"
+_BAN_TTL = 60
+
+
+def _ban_cache_key(user_id: int) -> str:
+    return _BAN_KEY.format(user_id=user_id)
+
+
+async def invalidate_ban_cache(user_id: int):
+    """Сбросить кэш бана (вызывается из /ban и /unban)"""
+    await cache.delete(_ban_cache_key(user_id))
+
+
+async def _get_ban_status(user_id: int) -> dict:
+    """
+    Статус бана: Redis-кэш, при промахе - две колонки из БД
+    """
+    cached = await cache.get(_ban_cache_key(user_id))
+    if isinstance(cached, dict):
+        return cached
+
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(User.is_banned, User.ban_reason).where(User.telegram_id == user_id)
+        )
+        row = result.first()
+
+    status = {
+        "is_banned": bool(row and row.is_banned),
+        "ban_reason": row.ban_reason if row else None
+    }
+    await cache.set(_ban_cache_key(user_id), status, ttl=_BAN_TTL)
+    return status
+
 
 async def check_user_banned(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     Проверка, забанен ли пользователь
-    
+
     Returns:
         bool: True если пользователь забанен
     """
     if not update.effective_user:
         return False
-    
+
     user_id = update.effective_user.id
-    
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == user_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user and user.is_banned:
-            logger.warning(f"Banned user {user_id} tried to use bot")
-            
-            # Отправляем сообщение о бане
-            if update.message:
-                await update.message.reply_text(
-                    f"🚫 **Вы заблокированы**\n\n"
-                    f"Причина: {user.ban_reason or 'Не указана'}\n\n"
-                    f"Для разблокировки обратитесь в поддержку: @Bashirov1111",
-                    parse_mode="Markdown"
-                )
-            elif update.callback_query:
-                await update.callback_query.answer(
-                    "🚫 Вы заблокированы. Обратитесь в поддержку.",
-                    show_alert=True
-                )
-            
-            return True
-    
+
+    status = await _get_ban_status(user_id)
+
+    if status["is_banned"]:
+        logger.warning(f"Banned user {user_id} tried to use bot")
+
+        # Отправляем сообщение о бане
+        if update.message:
+            await update.message.reply_text(
+                f"🚫 **Вы заблокированы**\n\n"
+                f"Причина: {status['ban_reason'] or 'Не указана'}\n\n"
+                f"Для разблокировки обратитесь в поддержку: @Bashirov1111",
+                parse_mode="Markdown"
+            )
+        elif update.callback_query:
+            await update.callback_query.answer(
+                "🚫 Вы заблокированы. Обратитесь в поддержку.",
+                show_alert=True
+            )
+
+        return True
+
     return False
@@ -0,0 +1,26 @@
+"""
+Middleware для request-scoped сессии БД
+"""
+import logging
+from functools import wraps
+
+from shared.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def with_session(handler):
+    """
+    Декоратор: одна сессия БД на Update
+
+    Обработчик получает готовую сессию третьим аргументом вместо
+    собственного `async with AsyncSessionLocal()` - все запросы внутри
+    одного апдейта идут через одно соединение пула.
+    (В context её не положить: у CallbackContext объявлены __slots__)
+    """
+    @wraps(handler)
+    async def wrapper(update, context):
+        async with AsyncSessionLocal() as session:
+            return await handler(update, context, session)
+
+    return wrapper
@@ -3,17 +3,83 @@
 Реализует систему Reserve/Commit/Release
 """
 import logging
+import time
 from typing import Optional
 from uuid import UUID
 
-from sqlalchemy import select, update
+from sqlalchemy import func, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from shared.database import Balance, User, Transaction
+from shared.database import Balance
 from shared.config import GENERATION_COST
 
 logger = logging.getLogger(__name__)
 
+# Кэш баланса для UI-отображения: 5 секунд устаревания на экране
+# не заметны, а повторные нажатия "Баланс" не ходят в БД
+_BALANCE_CACHE: dict[int, tuple[float, dict]] = {}
+_BALANCE_CACHE_TTL = 5.0
+_BALANCE_CACHE_MAX = 10000
+
+
+def _invalidate_balance_cache(user_id: int):
+    """Сбросить кэшированный баланс после изменения"""
+    _BALANCE_CACHE.pop(user_id, None)
+
+
+# CTE: списание с баланса и запись транзакции одним запросом -
+# один round-trip к БД вместо UPDATE + INSERT по отдельности.
+# Пустой результат означает, что условие WHERE не прошло
+_COMMIT_CREDITS_SQL = text("""
+    WITH upd AS (
+        UPDATE balances
+           SET credits_reserved = credits_reserved - :amount
+         WHERE user_id = :user_id
+           AND credits_reserved >= :amount
+     RETURNING credits_available, credits_reserved
+    )
+    INSERT INTO transactions
+        (user_id, transaction_type, amount, balance_before, balance_after, reference_id, created_at)
+    SELECT :user_id, 'generation', -:amount,
+           upd.credits_available + upd.credits_reserved + :amount,
+           upd.credits_available + upd.credits_reserved,
+           :reference_id, now()
+      FROM upd
+    RETURNING (SELECT credits_available FROM upd) AS credits_available,
+              (SELECT credits_reserved FROM upd) AS credits_reserved
+""")
+
+# То же для пополнения: UPSERT баланса + транзакция одним запросом
+_ADD_CREDITS_SQL = text("""
+    WITH upd AS (
+        INSERT INTO balances (user_id, credits_available, credits_reserved)
+        VALUES (:user_id, :amount, 0)
+        ON CONFLICT (user_id) DO UPDATE
+           SET credits_available = balances.credits_available + :amount
+     RETURNING credits_available, credits_reserved
+    )
+    INSERT INTO transactions
+        (user_id, transaction_type, amount, balance_before, balance_after, reference_id, created_at)
+    SELECT :user_id, :transaction_type, :amount,
+           upd.credits_available + upd.credits_reserved - :amount,
+           upd.credits_available + upd.credits_reserved,
+           :reference_id, now()
+      FROM upd
+    RETURNING (SELECT credits_available FROM upd) AS credits_available,
+              (SELECT credits_reserved FROM upd) AS credits_reserved
+""")
+
+
+# Текст отказа собирается один раз при импорте, runtime-значение
+# подставляет дешёвый %-оператор
+_MSG_INSUFFICIENT_TMPL = (
+    "❌ Недостаточно кредитов!\n\n"
+    "💰 Доступно: %d кредитов\n"
+    f"💳 Требуется: {GENERATION_COST} кредитов\n\n"
+    "Пополните баланс через /topup"
+)
+
 
 class InsufficientCreditsError(Exception):
     """Недостаточно кредитов"""
@@ -27,23 +93,22 @@ class BalanceService:
     async def get_or_create_balance(session: AsyncSession, user_id: int) -> Balance:
         """
         Получить или создать баланс пользователя
+
+        Один UPSERT вместо SELECT + INSERT + REFRESH: ON CONFLICT
+        DO UPDATE с no-op присваиванием заставляет RETURNING вернуть
+        строку и когда она уже существовала
         """
-        result = await session.execute(
-            select(Balance).where(Balance.user_id == user_id)
-        )
-        balance = result.scalar_one_or_none()
-        
-        if not balance:
-            balance = Balance(
-                user_id=user_id,
-                credits_available=0,
-                credits_reserved=0
+        stmt = (
+            pg_insert(Balance)
+            .values(user_id=user_id, credits_available=0, credits_reserved=0)
+            .on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={"user_id": user_id}
             )
-            session.add(balance)
-            await session.commit()
-            await session.refresh(balance)
-            logger.info(f"Created balance for user {user_id}")
-        
+            .returning(Balance)
+        )
+        balance = (await session.scalars(stmt)).one()
+        await session.commit()
         return balance
     
     @staticmethod
@@ -57,65 +122,85 @@ class BalanceService:
             "credits_reserved": balance.credits_reserved,
             "credits_total": balance.credits_available + balance.credits_reserved
         }
+
+    @staticmethod
+    async def get_balance_cached(session: AsyncSession, user_id: int) -> dict:
+        """
+        Баланс для отображения в UI с коротким TTL-кэшем
+
+        Для решений о списании использовать get_balance/reserve_credits -
+        кэш может отставать до _BALANCE_CACHE_TTL секунд
+        """
+        now = time.monotonic()
+        hit = _BALANCE_CACHE.get(user_id)
+        if hit is not None and now - hit[0] < _BALANCE_CACHE_TTL:
+            return hit[1]
+
+        info = await BalanceService.get_balance(session, user_id)
+
+        if len(_BALANCE_CACHE) >= _BALANCE_CACHE_MAX:
+            _BALANCE_CACHE.clear()
+        _BALANCE_CACHE[user_id] = (now, info)
+
+        return info
     
     @staticmethod
     async def reserve_credits(
         session: AsyncSession,
         user_id: int,
-        amount: int = GENERATION_COST
+        amount: int = GENERATION_COST,
+        commit: bool = True
     ) -> bool:
         """
         АТОМАРНО резервировать кредиты перед генерацией
-        Использует SELECT FOR UPDATE для блокировки строки
-        
+
+        Один условный UPDATE ... RETURNING: проверка достаточности
+        выполняется прямо в WHERE, без SELECT FOR UPDATE и блокировки
+        строки - БД сама сериализует конкурирующие UPDATE.
+
+        commit=False оставляет commit вызывающему коду: резерв и
+        создание задачи уезжают одной транзакцией
+
         Returns:
             True если резервирование успешно, False если недостаточно кредитов
         """
         try:
-            # АТОМАРНОЕ резервирование с SELECT FOR UPDATE
-            # Блокируем строку для избежания race condition
-            result = await session.execute(
-                select(Balance)
-                .where(Balance.user_id == user_id)
-                .with_for_update()
-            )
-            balance = result.scalar_one_or_none()
-            
-            # Создаём баланс если не существует
-            if not balance:
-                balance = Balance(
-                    user_id=user_id,
-                    credits_available=0,
-                    credits_reserved=0
+            stmt = (
+                update(Balance)
+                .where(
+                    Balance.user_id == user_id,
+                    Balance.credits_available >= amount
+                )
+                .values(
+                    credits_available=Balance.credits_available - amount,
+                    credits_reserved=Balance.credits_reserved + amount
                 )
-                session.add(balance)
-                await session.flush()  # Сохраняем без commit
-            
-            # Проверяем достаточность кредитов
-            if balance.credits_available < amount:
+                .returning(Balance.credits_available, Balance.credits_reserved)
+            )
+            row = (await session.execute(stmt)).first()
+
+            if row is None:
+                # Либо баланса нет (создаём лениво), либо кредитов мало
+                await BalanceService.get_or_create_balance(session, user_id)
                 logger.warning(
-                    f"Insufficient credits for user {user_id}: "
-                    f"available={balance.credits_available}, required={amount}"
+                    "Insufficient credits for user %s: required=%s", user_id, amount
                 )
-                await session.rollback()
                 return False
-            
-            # Резервируем атомарно
-            balance.credits_available -= amount
-            balance.credits_reserved += amount
-            
-            await session.commit()
-            
+
+            if commit:
+                await session.commit()
+            _invalidate_balance_cache(user_id)
+
             logger.info(
-                f"Reserved {amount} credits for user {user_id}. "
-                f"Available: {balance.credits_available}, Reserved: {balance.credits_reserved}"
+                "Reserved %s credits for user %s. Available: %s, Reserved: %s",
+                amount, user_id, row.credits_available, row.credits_reserved
             )
-            
+
             return True
-            
+
         except Exception as e:
             await session.rollback()
-            logger.error(f"Error reserving credits for user {user_id}: {e}", exc_info=True)
+            logger.error("Error reserving credits for user %s: %s", user_id, e, exc_info=True)
             raise
     
     @staticmethod
@@ -123,84 +208,89 @@ class BalanceService:
         session: AsyncSession,
         user_id: int,
         amount: int,
-        reference_id: UUID
+        reference_id: UUID,
+        commit: bool = True
     ):
         """
         Окончательно списать зарезервированные кредиты после успешной генерации
+
+        Один CTE-запрос: условный UPDATE баланса и INSERT транзакции
+        в том же round-trip'е; пустой результат - рассинхрон резерва.
+        С commit=False списание остаётся в открытой транзакции -
+        вызывающий коммитит сам вместе со своими изменениями
         """
         try:
-            balance = await BalanceService.get_or_create_balance(session, user_id)
-            
-            if balance.credits_reserved < amount:
+            row = (await session.execute(
+                _COMMIT_CREDITS_SQL,
+                {"user_id": user_id, "amount": amount, "reference_id": reference_id}
+            )).first()
+
+            if row is None:
                 logger.error(
-                    f"Cannot commit {amount} credits for user {user_id}: "
-                    f"reserved={balance.credits_reserved}"
+                    "Cannot commit %s credits for user %s: insufficient reserved",
+                    amount, user_id
                 )
                 raise ValueError("Insufficient reserved credits")
-            
-            balance_before = balance.credits_available + balance.credits_reserved
-            
-            # Списываем из резерва
-            balance.credits_reserved -= amount
-            
-            balance_after = balance.credits_available + balance.credits_reserved
-            
-            # Записываем транзакцию
-            transaction = Transaction(
-                user_id=user_id,
-                type="generation",
-                amount=-amount,
-                balance_before=balance_before,
-                balance_after=balance_after,
-                reference_id=reference_id
-            )
-            session.add(transaction)
-            
-            await session.commit()
-            
+
+            if commit:
+                await session.commit()
+            _invalidate_balance_cache(user_id)
+
             logger.info(
-                f"Committed {amount} credits for user {user_id}. "
-                f"Available: {balance.credits_available}, Reserved: {balance.credits_reserved}"
+                "Committed %s credits for user %s. Available: %s, Reserved: %s",
+                amount, user_id, row.credits_available, row.credits_reserved
             )
-            
+
         except Exception as e:
             await session.rollback()
-            logger.error(f"Error committing credits for user {user_id}: {e}")
+            logger.error("Error committing credits for user %s: %s", user_id, e)
             raise
     
     @staticmethod
     async def release_credits(
         session: AsyncSession,
         user_id: int,
-        amount: int
+        amount: int,
+        commit: bool = True
     ):
         """
         Вернуть зарезервированные кредиты при ошибке генерации
+
+        Один UPDATE: LEAST(reserved, amount) сохраняет прежнюю
+        семантику "вернуть сколько есть", не уводя резерв в минус.
+
+        commit=False оставляет commit вызывающему коду: возврат
+        уезжает одной транзакцией вместе с его изменениями
         """
         try:
-            balance = await BalanceService.get_or_create_balance(session, user_id)
-            
-            if balance.credits_reserved < amount:
-                logger.warning(
-                    f"Cannot release {amount} credits for user {user_id}: "
-                    f"reserved={balance.credits_reserved}. Releasing what's available."
+            released = func.least(Balance.credits_reserved, amount)
+            stmt = (
+                update(Balance)
+                .where(Balance.user_id == user_id)
+                .values(
+                    credits_available=Balance.credits_available + released,
+                    credits_reserved=Balance.credits_reserved - released
                 )
-                amount = balance.credits_reserved
-            
-            # Возвращаем из резерва в доступные
-            balance.credits_reserved -= amount
-            balance.credits_available += amount
-            
-            await session.commit()
-            
+                .returning(Balance.credits_available, Balance.credits_reserved)
+            )
+            row = (await session.execute(stmt)).first()
+
+            if row is None:
+                logger.warning("No balance row to release credits for user %s", user_id)
+                return
+
+            if commit:
+                await session.commit()
+            _invalidate_balance_cache(user_id)
+
             logger.info(
-                f"Released {amount} credits for user {user_id}. "
-                f"Available: {balance.credits_available}, Reserved: {balance.credits_reserved}"
+                "Released %s credits for user %s. Available: %s, Reserved: %s",
+                amount, user_id, row.credits_available, row.credits_reserved
             )
-            
+
         except Exception as e:
             await session.rollback()
-            logger.error(f"Error releasing credits for user {user_id}: {e}")
+            logger.error("Error releasing credits for user %s: %s", user_id, e)
             raise
     
     @staticmethod
@@ -210,40 +300,68 @@ class BalanceService:
         amount: int,
         reference_id: Optional[UUID] = None,
         transaction_type: str = "topup"
-    ):
+    ) -> int:
         """
         Добавить кредиты на баланс (пополнение)
+
+        Returns:
+            Новое значение credits_available
         """
         try:
-            balance = await BalanceService.get_or_create_balance(session, user_id)
-            
-            balance_before = balance.credits_available + balance.credits_reserved
-            balance.credits_available += amount
-            balance_after = balance.credits_available + balance.credits_reserved
-            
-            # Записываем транзакцию
-            transaction = Transaction(
-                user_id=user_id,
-                type=transaction_type,
-                amount=amount,
-                balance_before=balance_before,
-                balance_after=balance_after,
-                reference_id=reference_id
-            )
-            session.add(transaction)
-            
+            # Один CTE-запрос: UPSERT баланса (создаёт строку, если её
+            # ещё нет) и INSERT транзакции в том же round-trip'е
+            row = (await session.execute(
+                _ADD_CREDITS_SQL,
+                {
+                    "user_id": user_id,
+                    "amount": amount,
+                    "transaction_type": transaction_type,
+                    "reference_id": reference_id
+                }
+            )).first()
+
             await session.commit()
-            
+            _invalidate_balance_cache(user_id)
+
             logger.info(
-                f"Added {amount} credits to user {user_id}. "
-                f"Available: {balance.credits_available}, Reserved: {balance.credits_reserved}"
+                "Added %s credits to user %s. Available: %s, Reserved: %s",
+                amount, user_id, row.credits_available, row.credits_reserved
             )
-            
+
+            return row.credits_available
+
         except Exception as e:
             await session.rollback()
-            logger.error(f"Error adding credits for user {user_id}: {e}")
+            logger.error("Error adding credits for user %s: %s", user_id, e)
             raise
     
+    @staticmethod
+    async def add_credits_bulk(
+        session: AsyncSession,
+        entries: list[tuple[int, int, Optional[UUID], str]]
+    ):
+        """
+        Начислить кредиты нескольким получателям без commit'а
+
+        Тот же CTE, что и в add_credits, но commit остаётся за
+        вызывающим кодом: несколько начислений при регистрации уезжают
+        одной транзакцией вместо commit'а на каждое.
+
+        Args:
+            entries: [(user_id, amount, reference_id, transaction_type), ...]
+        """
+        for user_id, amount, reference_id, transaction_type in entries:
+            await session.execute(
+                _ADD_CREDITS_SQL,
+                {
+                    "user_id": user_id,
+                    "amount": amount,
+                    "transaction_type": transaction_type,
+                    "reference_id": reference_id
+                }
+            )
+            _invalidate_balance_cache(user_id)
+
     @staticmethod
     async def can_generate(session: AsyncSession, user_id: int) -> tuple[bool, str]:
         """
@@ -252,14 +370,14 @@ class BalanceService:
         Returns:
             (can_generate, message)
         """
-        balance = await BalanceService.get_or_create_balance(session, user_id)
-        
-        if balance.credits_available < GENERATION_COST:
-            return False, (
-                f"❌ Недостаточно кредитов!\n\n"
-                f"💰 Доступно: {balance.credits_available} кредитов\n"
-                f"💳 Требуется: {GENERATION_COST} кредитов\n\n"
-                f"Пополните баланс через /topup"
-            )
-        
+        # Одна колонка одним SELECT: ни полной ORM-строки, ни UPSERT'а
+        # ради чтения - отсутствие баланса означает 0 кредитов
+        result = await session.execute(
+            select(Balance.credits_available).where(Balance.user_id == user_id)
+        )
+        available = result.scalar_one_or_none() or 0
+
+        if available < GENERATION_COST:
+            return False, _MSG_INSUFFICIENT_TMPL % available
+
         return True, "OK"
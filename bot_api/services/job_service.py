@@ -1,15 +1,17 @@
 """
 Сервис управления задачами генерации
 """
+import asyncio
 import logging
+import time
 import uuid
 from typing import List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.database import Generation
-from shared.redis_client import generation_queue, cache
+from shared.redis_client import generation_queue, cache, get_redis
 from shared.config import (
     GENERATION_COST,
     MAX_CONCURRENT_GENERATIONS,
@@ -20,6 +22,124 @@ from bot_api.services.balance_service import BalanceService
 
 logger = logging.getLogger(__name__)
 
+# Счётчик rate limit: один атомарный INCR + условный EXPIRE вместо
+# GET + SET - одна RTT к Redis и нет гонки read-modify-write.
+# TTL ставится только первому инкременту окна
+_RATE_LIMIT_LUA = """
+local n = redis.call('INCR', KEYS[1])
+if n == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return n
+"""
+_rate_limit_script = None
+
+# Приёмка задачи одним скриптом: длина очереди + rate limit проверяются
+# и счётчик инкрементируется атомарно на стороне Redis - один round-trip
+# вместо трёх и нет TOCTOU-гонки между проверкой и инкрементом.
+# При отказе по лимиту инкремент откатывается: неудачные попытки
+# не сжигают слоты, как и раньше
+_ADMISSION_LUA = """
+local qlen = redis.call('LLEN', KEYS[2])
+if qlen >= tonumber(ARGV[2]) then
+    return {0, 'queue', qlen}
+end
+local n = redis.call('INCR', KEYS[1])
+if n == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+if n > tonumber(ARGV[1]) then
+    redis.call('DECR', KEYS[1])
+    return {0, 'rate', qlen}
+end
+return {1, 'ok', qlen}
+"""
+_admission_script = None
+
+
+async def _admit_generation(user_id: int, ttl: int = 3600) -> tuple[bool, str, int]:
+    """
+    Атомарная приёмка: очередь не переполнена и лимит не превышен
+
+    Успешная приёмка сразу занимает слот rate limit'а;
+    при последующем отказе (баланс, активная генерация) слот
+    возвращается через _release_rate_limit_slot
+
+    Returns:
+        (admitted, verdict, queue_size), verdict: 'ok' | 'queue' | 'rate'
+    """
+    global _admission_script
+    client = await get_redis()
+    if _admission_script is None:
+        _admission_script = client.register_script(_ADMISSION_LUA)
+    admitted, verdict, qlen = await _admission_script(
+        keys=[f"rate_limit:generation:{user_id}", generation_queue.queue_name],
+        args=[RATE_LIMIT_GENERATIONS_PER_HOUR, MAX_QUEUE_SIZE, ttl]
+    )
+    return bool(admitted), verdict, int(qlen)
+
+
+async def _release_rate_limit_slot(user_id: int):
+    """Вернуть слот rate limit'а, занятый приёмкой, при откате задачи"""
+    client = await get_redis()
+    await client.decr(f"rate_limit:generation:{user_id}")
+
+
+# Тексты отказов собираются один раз при импорте: статичные части
+# впечатаны, runtime-значения подставляет дешёвый %-оператор
+_MSG_QUEUE_FULL_TMPL = (
+    "⚠️ Очередь переполнена!\n\n"
+    f"В очереди: %d/{MAX_QUEUE_SIZE} задач\n"
+    "Попробуйте позже."
+)
+_MSG_ACTIVE_EXISTS = (
+    "⚠️ У вас уже есть активная генерация!\n\n"
+    "Дождитесь её завершения перед запуском новой."
+)
+_MSG_RATE_LIMIT = (
+    "⚠️ Превышен лимит генераций!\n\n"
+    f"Максимум: {RATE_LIMIT_GENERATIONS_PER_HOUR} генераций в час\n"
+    "Попробуйте позже."
+)
+
+# Кэш длины очереди для экрана статуса: короткий TTL, display-only
+_QUEUE_SIZE_CACHE = {"ts": 0.0, "val": 0}
+_QUEUE_SIZE_TTL = 0.5
+
+# Кэш недавних отказов: при шторме ретраев от одного пользователя
+# исход детерминирован ~секунду, незачем заново гонять Redis и БД.
+# TTL сильно меньше реальных окон лимитов - на корректность не влияет
+_REJECT_CACHE: dict[int, tuple[float, str]] = {}
+_REJECT_CACHE_TTL = 1.5
+_REJECT_CACHE_MAX = 10000
+
+
+def _cached_rejection(user_id: int):
+    """Недавний отказ для пользователя (или None)"""
+    hit = _REJECT_CACHE.get(user_id)
+    if hit is not None and time.monotonic() - hit[0] < _REJECT_CACHE_TTL:
+        return hit[1]
+    return None
+
+
+def _cache_rejection(user_id: int, message: str):
+    """Запомнить отказ на _REJECT_CACHE_TTL секунд"""
+    if len(_REJECT_CACHE) >= _REJECT_CACHE_MAX:
+        _REJECT_CACHE.clear()
+    _REJECT_CACHE[user_id] = (time.monotonic(), message)
+
+
+async def _incr_rate_limit_counter(user_id: int, ttl: int = 3600) -> int:
+    """Атомарно увеличить счётчик генераций, вернуть новое значение"""
+    global _rate_limit_script
+    client = await get_redis()
+    if _rate_limit_script is None:
+        _rate_limit_script = client.register_script(_RATE_LIMIT_LUA)
+    return int(await _rate_limit_script(
+        keys=[f"rate_limit:generation:{user_id}"],
+        args=[ttl]
+    ))
+
 
 class JobService:
     """Сервис управления задачами генерации"""
@@ -38,40 +158,49 @@ class JobService:
         Returns:
             (success, message, generation_id)
         """
+        # 0. Недавний отказ по лимитам: отвечаем из кэша, не трогая
+        # Redis и БД (шторм повторных нажатий кнопки)
+        rejection = _cached_rejection(user_id)
+        if rejection is not None:
+            return False, rejection, None
+
+        slot_held = False
         try:
-            # 1. Проверяем глобальный лимит очереди
-            queue_size = await generation_queue.size()
-            if queue_size >= MAX_QUEUE_SIZE:
-                return False, (
-                    f"⚠️ Очередь переполнена!\n\n"
-                    f"В очереди: {queue_size}/{MAX_QUEUE_SIZE} задач\n"
-                    f"Попробуйте позже."
-                ), None
-            
+            # 1. Лимит очереди и rate limit одним Lua-вызовом: проверка
+            # и инкремент счётчика атомарны на стороне Redis, слот
+            # занят сразу - нет гонки "проверили, потом посчитали"
+            admitted, verdict, queue_size = await _admit_generation(user_id)
+            if not admitted:
+                if verdict == "queue":
+                    message = _MSG_QUEUE_FULL_TMPL % queue_size
+                else:
+                    message = _MSG_RATE_LIMIT
+                _cache_rejection(user_id, message)
+                return False, message, None
+
+            slot_held = True
+
             # 2. Проверяем лимит параллельных генераций (ЖЁСТКИЙ: 1 на пользователя)
             active_count = await JobService.get_active_generations_count(session, user_id)
             if active_count >= MAX_CONCURRENT_GENERATIONS:
-                return False, (
-                    f"⚠️ У вас уже есть активная генерация!\n\n"
-                    f"Дождитесь её завершения перед запуском новой."
-                ), None
-            
-            # 3. Проверяем rate limit (генераций в час) - ТОЛЬКО ПРОВЕРКА
-            rate_limit_ok, rate_message = await JobService.check_rate_limit(user_id, increment=False)
-            if not rate_limit_ok:
-                return False, rate_message, None
-            
-            # 4. Проверяем баланс
-            can_generate, message = await BalanceService.can_generate(session, user_id)
-            if not can_generate:
-                return False, message, None
-            
-            # 5. Резервируем кредиты
-            reserved = await BalanceService.reserve_credits(session, user_id, GENERATION_COST)
+                await _release_rate_limit_slot(user_id)
+                _cache_rejection(user_id, _MSG_ACTIVE_EXISTS)
+                return False, _MSG_ACTIVE_EXISTS, None
+
+            # 3. Резервируем кредиты: условный UPDATE сам проверяет
+            # достаточность (предварительный SELECT баланса не нужен),
+            # commit отложен - резерв и INSERT задачи уедут одной
+            # транзакцией
+            reserved = await BalanceService.reserve_credits(
+                session, user_id, GENERATION_COST, commit=False
+            )
             if not reserved:
-                return False, "❌ Не удалось зарезервировать кредиты", None
-            
-            # 6. Создаем запись генерации
+                await _release_rate_limit_slot(user_id)
+                # Редкая ветка: SELECT только ради текста с балансом
+                _, message = await BalanceService.can_generate(session, user_id)
+                return False, message, None
+
+            # 4. Создаем запись генерации
             generation = Generation(
                 user_id=user_id,
                 prompt=prompt,
@@ -84,7 +213,7 @@ class JobService:
             
             generation_id = str(generation.id)
             
-            # 7. Ставим задачу в очередь Redis
+            # 5. Ставим задачу в очередь Redis
             job_data = {
                 "job_id": generation_id,
                 "generation_id": generation_id,
@@ -94,14 +223,39 @@ class JobService:
                 "settings": settings
             }
             
-            await generation_queue.enqueue(job_data)
-            
             generation.job_id = generation_id
-            await session.commit()
-            
-            # 8. Увеличиваем rate limit ТОЛЬКО ПОСЛЕ успешного reserve + создания job
-            await JobService.increment_rate_limit(user_id)
+
+            # Enqueue в Redis и COMMIT в Postgres - независимые RTT к
+            # разным бэкендам: перекрываем их вместо последовательного
+            # ожидания (прежний порядок enqueue -> commit и так не
+            # давал гарантии видимости строки воркеру).
+            # return_exceptions: исходы разбираем по отдельности -
+            # какие действия откатывать, зависит от того, что упало
+            enqueue_err, commit_err = await asyncio.gather(
+                generation_queue.enqueue(job_data),
+                session.commit(),
+                return_exceptions=True
+            )
+
+            if isinstance(commit_err, BaseException):
+                # Резерв не зафиксирован - rollback в except вернёт всё
+                raise commit_err
+
+            if isinstance(enqueue_err, BaseException):
+                # Commit прошёл, но в очередь ничего не попало:
+                # помечаем задачу failed и возвращаем кредиты
+                logger.error(
+                    "Enqueue failed for generation %s: %s", generation_id, enqueue_err
+                )
+                await JobService.update_generation_status(
+                    session, generation_id, "failed", error="Queue error"
+                )
+                await BalanceService.release_credits(session, user_id, GENERATION_COST)
+                await _release_rate_limit_slot(user_id)
+                return False, "❌ Ошибка создания задачи, кредиты возвращены", None
             
+            # Слот rate limit'а уже занят атомарной приёмкой (шаг 1) -
+            # отдельный инкремент в конце больше не нужен
             logger.info(
                 f"Created generation job for user {user_id}: "
                 f"generation_id={generation_id}, prompt='{prompt[:50]}...'"
@@ -112,38 +266,67 @@ class JobService:
         except Exception as e:
             await session.rollback()
             logger.error(f"Error creating generation job for user {user_id}: {e}")
-            
-            # Возвращаем кредиты при ошибке
-            try:
-                await BalanceService.release_credits(session, user_id, GENERATION_COST)
-            except:
-                pass
-            
+
+            # Резерв кредитов до commit'а не доехал - rollback уже
+            # вернул его; release_credits здесь раньше мог ошибочно
+            # освободить чужой резерв из параллельной задачи.
+            # Возвращаем только слот rate limit'а
+            if slot_held:
+                try:
+                    await _release_rate_limit_slot(user_id)
+                except:
+                    pass
+
             return False, f"❌ Ошибка создания задачи: {str(e)}", None
     
     @staticmethod
     async def get_active_generations_count(session: AsyncSession, user_id: int) -> int:
         """
         Получить количество активных генераций пользователя
+
+        COUNT(*) на стороне БД: по частичному индексу
+        idx_generation_user_active это index-only scan, без вытягивания
+        и гидрации строк ради len()
         """
         result = await session.execute(
-            select(Generation).where(
+            select(func.count())
+            .select_from(Generation)
+            .where(
                 Generation.user_id == user_id,
                 Generation.status.in_(["pending", "processing"])
             )
         )
-        generations = result.scalars().all()
-        return len(generations)
+        return result.scalar_one()
     
     @staticmethod
-    async def get_generation(session: AsyncSession, generation_id: str) -> Optional[Generation]:
+    async def get_active_generation(session: AsyncSession, user_id: int) -> Optional[Generation]:
         """
-        Получить генерацию по ID
+        Получить последнюю активную генерацию пользователя (или None)
+
+        Фильтр по статусу выполняет БД по частичному индексу -
+        не вытягиваем 10 строк ради одной
         """
         result = await session.execute(
-            select(Generation).where(Generation.id == uuid.UUID(generation_id))
+            select(Generation)
+            .where(
+                Generation.user_id == user_id,
+                Generation.status.in_(["pending", "processing"])
+            )
+            .order_by(Generation.created_at.desc())
+            .limit(1)
         )
         return result.scalar_one_or_none()
+
+    @staticmethod
+    async def get_generation(session: AsyncSession, generation_id: str) -> Optional[Generation]:
+        """
+        Получить генерацию по ID
+
+        session.get: сначала identity map, SELECT по первичному ключу
+        только при промахе - для повторных обращений в одном
+        unit-of-work это нулевая стоимость
+        """
+        return await session.get(Generation, uuid.UUID(generation_id))
     
     @staticmethod
     async def update_generation_status(
@@ -154,47 +337,104 @@ class JobService:
     ):
         """
         Обновить статус генерации
+
+        Один UPDATE ... RETURNING вместо SELECT + присваивания + COMMIT:
+        без гидрации строки и без синхронизации identity map - в цикле
+        воркера это каждый переход статуса
         """
-        generation = await JobService.get_generation(session, generation_id)
-        
-        if not generation:
-            logger.error(f"Generation not found: {generation_id}")
+        values = {k: v for k, v in kwargs.items() if hasattr(Generation, k)}
+        values["status"] = status
+
+        stmt = (
+            update(Generation)
+            .where(Generation.id == uuid.UUID(generation_id))
+            .values(**values)
+            .returning(Generation.id)
+            .execution_options(synchronize_session=False)
+        )
+        row = (await session.execute(stmt)).first()
+
+        if row is None:
+            await session.rollback()
+            logger.error("Generation not found: %s", generation_id)
             return
-        
-        generation.status = status
-        
-        # Обновляем дополнительные поля
-        for key, value in kwargs.items():
-            if hasattr(generation, key):
-                setattr(generation, key, value)
-        
+
         await session.commit()
-        
-        logger.info(f"Updated generation {generation_id}: status={status}")
+
+        logger.info("Updated generation %s: status=%s", generation_id, status)
     
     @staticmethod
     async def get_user_generations(
         session: AsyncSession,
         user_id: int,
         limit: int = 10
-    ) -> List[Generation]:
+    ):
         """
         Получить последние генерации пользователя
+
+        Возвращает Row-кортежи нужных колонок вместо полных
+        ORM-объектов: без JSONB-настроек, identity map и
+        инструментирования атрибутов на каждую строку
         """
         result = await session.execute(
-            select(Generation)
+            select(
+                Generation.id,
+                Generation.status,
+                Generation.prompt,
+                Generation.cost,
+                Generation.image_url,
+                Generation.created_at
+            )
             .where(Generation.user_id == user_id)
             .order_by(Generation.created_at.desc())
             .limit(limit)
         )
-        return result.scalars().all()
+        return result.all()
     
+    @staticmethod
+    async def get_user_history(
+        session: AsyncSession,
+        user_id: int,
+        limit: int = 5
+    ):
+        """
+        Последние генерации для экрана истории
+
+        Возвращает только нужные колонки (status, prompt, created_str) -
+        без гидрации полных ORM-объектов с JSONB-настройками.
+        Дату форматирует Postgres (to_char) - Python получает
+        готовую строку вместо strftime на каждую строку
+        """
+        result = await session.execute(
+            select(
+                Generation.status,
+                Generation.prompt,
+                func.to_char(Generation.created_at, "DD.MM.YYYY HH24:MI").label("created_str")
+            )
+            .where(Generation.user_id == user_id)
+            .order_by(Generation.created_at.desc())
+            .limit(limit)
+        )
+        return result.all()
+
     @staticmethod
     async def get_queue_size() -> int:
         """
         Получить размер очереди генераций
+
+        Значение для отображения в статусе: полсекунды устаревания
+        незаметны, а повторные запросы не ходят в Redis.
+        Приёмка задач читает длину очереди сама, внутри атомарного
+        Lua-скрипта - этот кэш на неё не влияет
         """
-        return await generation_queue.size()
+        now = time.monotonic()
+        if now - _QUEUE_SIZE_CACHE["ts"] < _QUEUE_SIZE_TTL:
+            return _QUEUE_SIZE_CACHE["val"]
+
+        size = await generation_queue.size()
+        _QUEUE_SIZE_CACHE["ts"] = now
+        _QUEUE_SIZE_CACHE["val"] = size
+        return size
     
     @staticmethod
     async def check_rate_limit(user_id: int, increment: bool = False) -> tuple[bool, str]:
@@ -208,27 +448,21 @@ class JobService:
         Returns:
             (is_allowed, message)
         """
-        cache_key = f"rate_limit:generation:{user_id}"
-        
-        # Получаем текущий счётчик
-        count = await cache.get(cache_key)
-        
-        if count is None:
-            count = 0
-        else:
-            count = int(count)
-        
-        if count >= RATE_LIMIT_GENERATIONS_PER_HOUR:
-            return False, (
-                f"⚠️ Превышен лимит генераций!\n\n"
-                f"Максимум: {RATE_LIMIT_GENERATIONS_PER_HOUR} генераций в час\n"
-                f"Попробуйте позже."
-            )
-        
-        # Увеличиваем счётчик ТОЛЬКО если increment=True
         if increment:
-            await cache.set(cache_key, count + 1, ttl=3600)  # TTL 1 час
-        
+            # Атомарный INCR + условный EXPIRE: TTL окна ставится один
+            # раз и не сбрасывается каждым инкрементом (иначе активный
+            # пользователь никогда не выходил из окна)
+            count = await _incr_rate_limit_counter(user_id)
+            # count уже включает текущую попытку
+            exceeded = count > RATE_LIMIT_GENERATIONS_PER_HOUR
+        else:
+            cached = await cache.get(f"rate_limit:generation:{user_id}")
+            count = int(cached) if cached is not None else 0
+            exceeded = count >= RATE_LIMIT_GENERATIONS_PER_HOUR
+
+        if exceeded:
+            return False, _MSG_RATE_LIMIT
+
         return True, "OK"
     
     @staticmethod
@@ -237,13 +471,8 @@ class JobService:
         Увеличить rate limit счётчик
         Вызывается ТОЛЬКО после успешного reserve + создания job
         """
-        cache_key = f"rate_limit:generation:{user_id}"
-        
-        count = await cache.get(cache_key)
-        if count is None:
-            count = 0
-        else:
-            count = int(count)
-        
-        await cache.set(cache_key, count + 1, ttl=3600)  # TTL 1 час
-        logger.info(f"Incremented rate limit for user {user_id}: {count + 1}/{RATE_LIMIT_GENERATIONS_PER_HOUR}")
+        count = await _incr_rate_limit_counter(user_id)
+        logger.info(
+            "Incremented rate limit for user %s: %s/%s",
+            user_id, count, RATE_LIMIT_GENERATIONS_PER_HOUR
+        )
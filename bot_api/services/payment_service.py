@@ -1,6 +1,7 @@
 """
 Сервис интеграции с ЮКасса
 """
+import asyncio
 import logging
 import uuid
 from typing import Optional
@@ -72,7 +73,11 @@ class PaymentService:
                 }
             }
             
-            yoo_payment = YooPayment.create(payment_data, idempotence_key)
+            # SDK ЮКассы синхронный (requests): уводим вызов в тред,
+            # чтобы медленный ответ платёжки не замораживал event loop
+            yoo_payment = await asyncio.to_thread(
+                YooPayment.create, payment_data, idempotence_key
+            )
             
             # 3. Сохраняем информацию о платеже
             payment = Payment(
@@ -137,7 +142,8 @@ class PaymentService:
         Проверить статус платежа в ЮКасса
         """
         try:
-            yoo_payment = YooPayment.find_one(payment_id)
+            # Синхронный SDK - в тред, не блокируя event loop
+            yoo_payment = await asyncio.to_thread(YooPayment.find_one, payment_id)
             return {
                 "id": yoo_payment.id,
                 "status": yoo_payment.status,
@@ -2,13 +2,13 @@
 Улучшенный сервис реферальной системы с анти-абузом
 """
 import logging
-import hashlib
 from datetime import datetime, timedelta
 from typing import Optional, Dict
 from sqlalchemy import select, func, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.database import User, Balance, Transaction, AsyncSessionLocal
+from shared.redis_client import get_redis
 from shared.referral_model import Referral, ReferralStatus
 from shared.config import REFERRAL_REWARD_CAP_PER_DAY, REFERRAL_ACTIVATION_REQUIRED
 from bot_api.services.balance_service import BalanceService
@@ -20,6 +20,13 @@ WELCOME_BONUS = 20  # Кредитов новому пользователю (б
 REFERRAL_BONUS = 30  # Кредитов новому пользователю по реф-ссылке
 REFERRER_REWARD = 30  # Кредитов рефереру за активированного реферала
 
+# Счётчик наград реферера за день живёт в Redis: проверка дневного
+# лимита не ходит в Postgres за COUNT(*) на каждую активацию.
+# TTL 26 часов переживает границу суток; при промахе (холодный кэш)
+# счётчик пересобирается из БД
+_REFCAP_KEY = "refcap:{referrer_id}:{day}"
+_REFCAP_TTL = 93600
+
 
 class ReferralServiceV2:
     """Улучшенный сервис для работы с реферальной системой"""
@@ -28,9 +35,11 @@ class ReferralServiceV2:
     def generate_referral_code(telegram_id: int) -> str:
         """
         Генерация уникального реферального кода
+
+        Формат намеренно прозрачный (ref_<telegram_id>): его разбирает
+        обратно парсер реф-ссылок при регистрации, без похода в БД
         """
-        hash_object = hashlib.md5(str(telegram_id).encode())
-        return f"ref_{telegram_id}"  # Простой формат: ref_<telegram_id>
+        return f"ref_{telegram_id}"
     
     @staticmethod
     async def create_user_with_referral(
@@ -46,124 +55,117 @@ class ReferralServiceV2:
         Returns:
             tuple[User, int, str]: (пользователь, начисленные_кредиты, тип_бонуса)
         """
-        # Проверяем, существует ли пользователь
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
-        )
-        existing_user = result.scalar_one_or_none()
-        
-        if existing_user:
+        # Извлекаем referrer_id из кода (формат: ref_<telegram_id>) -
+        # чистый Python, до похода в БД. isdigit вместо try/int:
+        # мусорные коды от ботов-проб не порождают исключений
+        referrer_id = None
+        if referrer_code and referrer_code[:4] == "ref_" and referrer_code[4:].isdigit():
+            referrer_id = int(referrer_code[4:])
+
+            # Проверка: нельзя быть рефералом самого себя
+            if referrer_id == telegram_id:
+                logger.warning(f"User {telegram_id} tried to refer themselves")
+                referrer_id = None
+        elif referrer_code:
+            logger.warning(f"Invalid referrer code: {referrer_code}")
+
+        # Дубликат пользователя и существование реферера одним SELECT
+        # по уникальному индексу: IN (me, ref) вместо двух запросов,
+        # демультиплексация в Python. Полная строка гидрируется
+        # session.get'ом лишь на редкой ветке "уже зарегистрирован"
+        ids = [telegram_id] if referrer_id is None else [telegram_id, referrer_id]
+        rows = (await session.execute(
+            select(User.telegram_id, User.id).where(User.telegram_id.in_(ids))
+        )).all()
+        found = {row.telegram_id: row.id for row in rows}
+
+        existing_pk = found.get(telegram_id)
+        if existing_pk is not None:
             logger.info(f"User {telegram_id} already exists")
-            return existing_user, 0, "existing"
-        
+            return await session.get(User, existing_pk), 0, "existing"
+
+        if referrer_id is not None:
+            if referrer_id not in found:
+                logger.warning(f"Referrer {referrer_id} not found")
+                referrer_id = None
+            else:
+                logger.info(f"User {telegram_id} referred by {referrer_id}")
+
         # Генерируем реферальный код
         referral_code = ReferralServiceV2.generate_referral_code(telegram_id)
-        
-        # Извлекаем referrer_id из кода (формат: ref_<telegram_id>)
-        referrer_id = None
-        if referrer_code and referrer_code.startswith("ref_"):
-            try:
-                referrer_id = int(referrer_code.replace("ref_", ""))
-                
-                # Проверка: нельзя быть рефералом самого себя
-                if referrer_id == telegram_id:
-                    logger.warning(f"User {telegram_id} tried to refer themselves")
-                    referrer_id = None
-                else:
-                    # Проверяем, существует ли реферер
-                    result = await session.execute(
-                        select(User).where(User.telegram_id == referrer_id)
-                    )
-                    referrer = result.scalar_one_or_none()
-                    if not referrer:
-                        logger.warning(f"Referrer {referrer_id} not found")
-                        referrer_id = None
-                    else:
-                        logger.info(f"User {telegram_id} referred by {referrer_id}")
-            except ValueError:
-                logger.warning(f"Invalid referrer code: {referrer_code}")
-                referrer_id = None
-        
+
         # Создаем пользователя
+        # Бонус нового пользователя известен заранее - баланс создаётся
+        # сразу с ним, без UPSERT'а после INSERT'а
+        if referrer_id:
+            # Пользователь пришёл по реф-ссылке → 30 кредитов (вместо 20)
+            bonus_credits = REFERRAL_BONUS
+            bonus_type = "referral"
+        else:
+            # Обычный новый пользователь → 20 кредитов
+            bonus_credits = WELCOME_BONUS
+            bonus_type = "welcome"
+
         new_user = User(
             telegram_id=telegram_id,
             username=username,
             first_name=first_name,
             referral_code=referral_code,
             referred_by=referrer_id,
-            welcome_credits_granted=False,
-            referral_credits_granted=False
+            welcome_credits_granted=True,
+            referral_credits_granted=bool(referrer_id)
         )
-        session.add(new_user)
-        
-        # Создаем баланс
-        balance = Balance(
-            user_id=telegram_id,
-            credits_available=0,
-            credits_reserved=0
-        )
-        session.add(balance)
-        
-        await session.flush()
-        
-        # Начисляем бонусы
-        bonus_credits = 0
-        bonus_type = "welcome"
-        
-        if referrer_id:
-            # Пользователь пришёл по реф-ссылке → 30 кредитов (вместо 20)
-            bonus_credits = REFERRAL_BONUS
-            bonus_type = "referral"
-            
-            await BalanceService.add_credits(
-                session=session,
+
+        # Все строки регистрации (пользователь, баланс, транзакция
+        # бонуса, запись реферала) собираются заранее и уезжают одним
+        # flush'ем при commit'е - INSERT'ы в каждую таблицу батчуются
+        signup_rows = [
+            new_user,
+            Balance(
                 user_id=telegram_id,
+                credits_available=bonus_credits,
+                credits_reserved=0
+            ),
+            Transaction(
+                user_id=telegram_id,
+                transaction_type=f"{bonus_type}_bonus",
                 amount=bonus_credits,
-                reference_id=None,
-                transaction_type="referral_bonus"
+                balance_before=0,
+                balance_after=bonus_credits,
+                reference_id=None
             )
-            
+        ]
+
+        credit_entries = []
+        if referrer_id:
             # Создаём запись реферала
-            referral = Referral(
+            signup_rows.append(Referral(
                 referred_user_id=telegram_id,
                 referrer_id=referrer_id,
                 status=ReferralStatus.REGISTERED
-            )
-            session.add(referral)
-            
+            ))
+
             # Если активация НЕ требуется, сразу награждаем реферера
+            # (начисление уезжает тем же commit'ом через bulk)
             if not REFERRAL_ACTIVATION_REQUIRED:
                 await ReferralServiceV2._reward_referrer(
                     session=session,
                     referrer_id=referrer_id,
-                    referred_user_id=telegram_id
+                    referred_user_id=telegram_id,
+                    credit_entries=credit_entries
                 )
-            
-            logger.info(
-                f"Referral bonus: user {telegram_id} got {bonus_credits} credits"
-            )
-        else:
-            # Обычный новый пользователь → 20 кредитов
-            bonus_credits = WELCOME_BONUS
-            bonus_type = "welcome"
-            
-            await BalanceService.add_credits(
-                session=session,
-                user_id=telegram_id,
-                amount=bonus_credits,
-                reference_id=None,
-                transaction_type="welcome_bonus"
-            )
-            
-            logger.info(f"Welcome bonus: user {telegram_id} got {bonus_credits} credits")
-        
-        # Отмечаем, что бонусы выданы
-        new_user.welcome_credits_granted = True
-        if referrer_id:
-            new_user.referral_credits_granted = True
-        
+
+        session.add_all(signup_rows)
+
+        if credit_entries:
+            await BalanceService.add_credits_bulk(session, credit_entries)
+
         await session.commit()
-        
+
+        logger.info(
+            f"{bonus_type.capitalize()} bonus: user {telegram_id} got {bonus_credits} credits"
+        )
+
         return new_user, bonus_credits, bonus_type
     
     @staticmethod
@@ -196,18 +198,25 @@ class ReferralServiceV2:
         # Обновляем статус
         referral.status = ReferralStatus.ACTIVATED
         referral.activated_at = datetime.now()
-        
-        # Награждаем реферера
+
+        # Награждаем реферера: начисление откладывается в список и
+        # уезжает вместе со сменой статуса одним commit'ом (один
+        # fsync WAL вместо двух)
+        credit_entries = []
         rewarded = await ReferralServiceV2._reward_referrer(
             session=session,
             referrer_id=referral.referrer_id,
-            referred_user_id=user_id
+            referred_user_id=user_id,
+            credit_entries=credit_entries
         )
-        
+
         if rewarded:
             referral.status = ReferralStatus.REWARDED
             referral.rewarded_at = datetime.now()
-        
+
+        if credit_entries:
+            await BalanceService.add_credits_bulk(session, credit_entries)
+
         await session.commit()
         
         logger.info(f"Referral {user_id} activated, referrer {referral.referrer_id} rewarded: {rewarded}")
@@ -218,28 +227,44 @@ class ReferralServiceV2:
     async def _reward_referrer(
         session: AsyncSession,
         referrer_id: int,
-        referred_user_id: int
+        referred_user_id: int,
+        credit_entries: Optional[list] = None
     ) -> bool:
         """
         Награждение реферера (с проверкой лимитов)
-        
+
+        Если передан credit_entries, начисление откладывается в список
+        для add_credits_bulk (регистрация: один батч, один commit)
+
         Returns:
             bool: True если награда выдана
         """
-        # Проверяем дневной лимит наград
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        result = await session.execute(
-            select(func.count(Referral.id)).where(
-                and_(
-                    Referral.referrer_id == referrer_id,
-                    Referral.status == ReferralStatus.REWARDED,
-                    Referral.rewarded_at >= today_start
+        # Проверяем дневной лимит наград: сначала Redis-счётчик,
+        # COUNT(*) в Postgres остаётся только путём пересборки
+        # при холодном кэше
+        now = datetime.now()
+        day_key = _REFCAP_KEY.format(referrer_id=referrer_id, day=now.strftime("%Y%m%d"))
+        redis = await get_redis()
+
+        cached = await redis.get(day_key)
+        if cached is not None:
+            today_rewards = int(cached)
+        else:
+            # Начало суток считает Postgres: стабильный текст запроса
+            # (кэш prepared statement) и один источник времени для
+            # границы дня
+            result = await session.execute(
+                select(func.count(Referral.id)).where(
+                    and_(
+                        Referral.referrer_id == referrer_id,
+                        Referral.status == ReferralStatus.REWARDED,
+                        Referral.rewarded_at >= func.date_trunc("day", func.now())
+                    )
                 )
             )
-        )
-        today_rewards = result.scalar() or 0
-        
+            today_rewards = result.scalar() or 0
+            await redis.set(day_key, today_rewards, ex=_REFCAP_TTL)
+
         if today_rewards >= REFERRAL_REWARD_CAP_PER_DAY:
             logger.warning(
                 f"Referrer {referrer_id} reached daily reward cap ({REFERRAL_REWARD_CAP_PER_DAY})"
@@ -247,20 +272,28 @@ class ReferralServiceV2:
             return False
         
         # Начисляем награду рефереру
-        await BalanceService.add_credits(
-            session=session,
-            user_id=referrer_id,
-            amount=REFERRER_REWARD,
-            reference_id=referred_user_id,
-            transaction_type="referrer_bonus"
-        )
+        if credit_entries is not None:
+            credit_entries.append((referrer_id, REFERRER_REWARD, referred_user_id, "referrer_bonus"))
+        else:
+            await BalanceService.add_credits(
+                session=session,
+                user_id=referrer_id,
+                amount=REFERRER_REWARD,
+                reference_id=referred_user_id,
+                transaction_type="referrer_bonus"
+            )
         
+        # Фиксируем награду в дневном счётчике
+        await redis.incr(day_key)
+        await redis.expire(day_key, _REFCAP_TTL)
+
         logger.info(f"Referrer {referrer_id} rewarded with {REFERRER_REWARD} credits")
         
-        # Отправляем уведомление рефереру
+        # Уведомление рефереру через очередь рассылки: поход в
+        # Telegram API не задерживает транзакцию активации
         try:
-            from bot_api.bot import send_message
-            await send_message(
+            from bot_api.bot import enqueue_notify
+            await enqueue_notify(
                 referrer_id,
                 f"🎉 **Ваш реферал активировался!**\n\n"
                 f"Вы получили {REFERRER_REWARD} кредитов."
@@ -277,14 +310,43 @@ class ReferralServiceV2:
     ) -> Dict:
         """
         Получение статистики по рефералам
+
+        Весь снапшот (код, оба счётчика и сумма) собирается одним
+        запросом через scalar_subquery - 2 RTT вместо 5: снапшот и
+        список рефералов. asyncpg не умеет параллельные запросы на
+        одном соединении, поэтому объединяем в SQL, а не через gather
         """
-        # Получаем пользователя
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if not user:
+        # Код, счётчики и сумма одним снапшотом; PK пользователя в той
+        # же строке отличает "нет пользователя" от пустой статистики
+        stats = (await session.execute(
+            select(
+                select(User.id)
+                .where(User.telegram_id == telegram_id)
+                .scalar_subquery().label("user_pk"),
+                select(User.referral_code)
+                .where(User.telegram_id == telegram_id)
+                .scalar_subquery().label("referral_code"),
+                select(func.count(Referral.id))
+                .where(Referral.referrer_id == telegram_id)
+                .scalar_subquery().label("referrals_count"),
+                select(func.count(Referral.id))
+                .where(
+                    and_(
+                        Referral.referrer_id == telegram_id,
+                        Referral.status.in_([ReferralStatus.ACTIVATED, ReferralStatus.REWARDED])
+                    )
+                )
+                .scalar_subquery().label("activated_count"),
+                select(func.coalesce(func.sum(Transaction.amount), 0))
+                .where(
+                    Transaction.user_id == telegram_id,
+                    Transaction.transaction_type == "referrer_bonus"
+                )
+                .scalar_subquery().label("total_earned"),
+            )
+        )).one()
+
+        if stats.user_pk is None:
             return {
                 "referral_code": None,
                 "referrals_count": 0,
@@ -292,33 +354,7 @@ class ReferralServiceV2:
                 "total_earned": 0,
                 "referrals": []
             }
-        
-        # Считаем рефералов
-        result = await session.execute(
-            select(func.count(Referral.id)).where(Referral.referrer_id == telegram_id)
-        )
-        referrals_count = result.scalar() or 0
-        
-        # Считаем активированных
-        result = await session.execute(
-            select(func.count(Referral.id)).where(
-                and_(
-                    Referral.referrer_id == telegram_id,
-                    Referral.status.in_([ReferralStatus.ACTIVATED, ReferralStatus.REWARDED])
-                )
-            )
-        )
-        activated_count = result.scalar() or 0
-        
-        # Считаем заработанные кредиты
-        result = await session.execute(
-            select(func.sum(Transaction.amount)).where(
-                Transaction.user_id == telegram_id,
-                Transaction.transaction_type == "referrer_bonus"
-            )
-        )
-        total_earned = result.scalar() or 0
-        
+
         # Получаем список рефералов
         result = await session.execute(
             select(Referral, User).join(
@@ -342,9 +378,9 @@ class ReferralServiceV2:
         ]
         
         return {
-            "referral_code": user.referral_code,
-            "referrals_count": referrals_count,
-            "activated_count": activated_count,
-            "total_earned": total_earned,
+            "referral_code": stats.referral_code,
+            "referrals_count": stats.referrals_count,
+            "activated_count": stats.activated_count,
+            "total_earned": stats.total_earned,
             "referrals": referrals
         }
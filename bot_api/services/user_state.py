@@ -0,0 +1,78 @@
+"""
+Хранилище пользовательского состояния (промпт, референсы, настройки)
+
+Состояние живёт в Redis, а не в context.bot_data: один общий dict
+в памяти процесса не переживает рестарт и не работает при нескольких
+webhook-воркерах
+"""
+import json
+import logging
+from types import MappingProxyType
+
+from shared.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Настройки по умолчанию: MappingProxyType - один общий объект,
+# копия создаётся только при инициализации состояния
+DEFAULT_SETTINGS = MappingProxyType({
+    "temperature": 1.0,
+    "aspect_ratio": "16:9",
+    "output_image_size": "1K",
+    "seed": -1
+})
+
+_STATE_KEY = "user_state:{user_id}"
+_STATE_TTL = 7 * 86400  # неделя неактивности - состояние можно забыть
+
+
+def _default_state() -> dict:
+    """Свежее состояние пользователя"""
+    return {
+        "reference_images": [],
+        "prompt": None,
+        "settings": dict(DEFAULT_SETTINGS)
+    }
+
+
+class UserStateStore:
+    """Состояние пользователя в Redis (JSON под ключом user_state:<id>)"""
+
+    @staticmethod
+    async def get(user_id: int) -> dict:
+        """
+        Получить состояние пользователя (дефолтное, если ещё нет)
+        """
+        client = await get_redis()
+        raw = await client.get(_STATE_KEY.format(user_id=user_id))
+
+        if not raw:
+            return _default_state()
+
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"Corrupted state for user {user_id}, resetting")
+            return _default_state()
+
+    @staticmethod
+    async def set(user_id: int, state: dict):
+        """
+        Сохранить состояние пользователя
+        """
+        client = await get_redis()
+        await client.setex(
+            _STATE_KEY.format(user_id=user_id),
+            _STATE_TTL,
+            json.dumps(state)
+        )
+
+    @staticmethod
+    async def update(user_id: int, **kv) -> dict:
+        """
+        Обновить отдельные поля состояния, вернуть результат
+        """
+        state = await UserStateStore.get(user_id)
+        state.update(kv)
+        await UserStateStore.set(user_id, state)
+        return state
@@ -0,0 +1,46 @@
+"""
+Ответ методом в теле webhook-ответа
+
+Telegram позволяет вернуть один API-метод (sendMessage и т.п.) прямо
+в HTTP-ответе на webhook - ноль исходящих HTTPS-вызовов для ответа.
+Обработчик складывает ответ через queue_reply, а webhook-эндпоинт
+забирает его после process_update и отдаёт в теле ответа.
+
+ContextVar привязан к задаче обработки апдейта: блокирующие
+обработчики PTB выполняются в той же задаче, что и process_update,
+поэтому значение видно эндпоинту. Работает только для ОДНОГО ответа
+на апдейт - многошаговые отправки по-прежнему идут через reply_text
+"""
+from contextvars import ContextVar
+from typing import Optional
+
+_pending_reply: ContextVar[Optional[dict]] = ContextVar("pending_reply", default=None)
+
+
+def queue_reply(update, text: str, reply_markup=None, parse_mode: Optional[str] = None):
+    """
+    Отдать ответ на апдейт в теле webhook-ответа вместо reply_text
+    """
+    payload = {
+        "method": "sendMessage",
+        "chat_id": update.effective_chat.id,
+        "text": text
+    }
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    if parse_mode is not None:
+        payload["parse_mode"] = parse_mode
+    _pending_reply.set(payload)
+
+
+def reset_pending_reply():
+    """Сбросить отложенный ответ перед обработкой апдейта"""
+    _pending_reply.set(None)
+
+
+def pop_pending_reply() -> Optional[dict]:
+    """Забрать отложенный ответ (или None)"""
+    reply = _pending_reply.get()
+    if reply is not None:
+        _pending_reply.set(None)
+    return reply
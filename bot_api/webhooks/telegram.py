@@ -6,6 +6,7 @@ from fastapi import APIRouter, Request, HTTPException
 
 from telegram import Update
 from bot_api.bot import get_application
+from bot_api.webhook_reply import reset_pending_reply, pop_pending_reply
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +24,17 @@ async def telegram_webhook(request: Request):
         
         # Создаем Update объект
         update = Update.de_json(body, get_application().bot)
-        
+
         # Обрабатываем update
+        reset_pending_reply()
         await get_application().process_update(update)
-        
+
+        # Если обработчик отложил ответ через queue_reply - отдаём
+        # метод прямо в теле webhook-ответа, без исходящего HTTPS
+        reply = pop_pending_reply()
+        if reply is not None:
+            return reply
+
         return {"status": "ok"}
         
     except Exception as e:
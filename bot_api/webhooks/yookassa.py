@@ -2,25 +2,31 @@
 Webhook обработчик для ЮКасса
 Идемпотентная обработка уведомлений о платежах
 """
+import asyncio
 import logging
 import hmac
 import hashlib
 import json
 from datetime import datetime
+from ipaddress import ip_address, ip_network
 from typing import Optional
 from uuid import UUID
 
+import aiohttp
 from fastapi import APIRouter, Request, HTTPException, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.database import get_session, Payment, Topup
+from shared.redis_client import get_redis
 from shared.config import YOOKASSA_WEBHOOK_SECRET, YOOKASSA_SECRET_KEY, YOOKASSA_SHOP_ID
-from yookassa import Configuration, Payment as YooKassaPayment
+from bot_api.http_client import get_http_session
 
-# Настройка ЮКасса SDK
-if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_SECRET_KEY
+# Проверка платежа ходит в REST API ЮКассы напрямую через общую
+# aiohttp-сессию: соединение переиспользуется (без TCP+TLS на каждый
+# webhook), и вызов по-настоящему асинхронный - синхронный SDK
+# с его сессией-на-запрос здесь больше не нужен
+_YK_PAYMENT_URL = "https://api.yookassa.ru/v3/payments/{payment_id}"
+_YK_AUTH = aiohttp.BasicAuth(str(YOOKASSA_SHOP_ID or ""), str(YOOKASSA_SECRET_KEY or ""))
 
 # IP адреса ЮКасса (allowlist)
 YOOKASSA_IPS = [
@@ -32,6 +38,15 @@ YOOKASSA_IPS = [
     "77.75.154.128/25",
     "2a02:5180::/32"
 ]
+
+# Сети и одиночные адреса разбираются один раз при импорте:
+# на запросе остаётся только членство в уже распарсенных объектах
+_YOOKASSA_SINGLE_IPS = frozenset(
+    ip_address(x) for x in YOOKASSA_IPS if "/" not in x
+)
+_YOOKASSA_NETS = tuple(
+    ip_network(x, strict=False) for x in YOOKASSA_IPS if "/" in x
+)
 from bot_api.services.balance_service import BalanceService
 from bot_api.services.payment_service import PaymentService
 
@@ -50,23 +65,14 @@ def validate_yookassa_ip(client_ip: str) -> bool:
     Returns:
         True если IP в allowlist
     """
-    from ipaddress import ip_address, ip_network
-    
     try:
         client = ip_address(client_ip)
-        
-        for allowed_ip in YOOKASSA_IPS:
-            if "/" in allowed_ip:
-                # Подсеть
-                if client in ip_network(allowed_ip):
-                    return True
-            else:
-                # Одиночный IP
-                if str(client) == allowed_ip:
-                    return True
-        
-        return False
-    
+
+        if client in _YOOKASSA_SINGLE_IPS:
+            return True
+
+        return any(client in net for net in _YOOKASSA_NETS)
+
     except Exception as e:
         logger.error(f"Error validating IP {client_ip}: {e}")
         return False
@@ -83,19 +89,25 @@ async def verify_payment_with_api(payment_id: str) -> Optional[dict]:
         Данные платежа или None
     """
     try:
-        payment = YooKassaPayment.find_one(payment_id)
-        
-        if payment:
-            return {
-                "id": payment.id,
-                "status": payment.status,
-                "paid": payment.paid,
-                "amount": float(payment.amount.value) if payment.amount else 0,
-                "metadata": payment.metadata
-            }
-        
-        return None
-    
+        http = await get_http_session()
+        async with http.get(
+            _YK_PAYMENT_URL.format(payment_id=payment_id), auth=_YK_AUTH
+        ) as resp:
+            if resp.status != 200:
+                logger.error(
+                    f"YooKassa API returned {resp.status} for payment {payment_id}"
+                )
+                return None
+            data = await resp.json()
+
+        return {
+            "id": data.get("id"),
+            "status": data.get("status"),
+            "paid": data.get("paid"),
+            "amount": float(data["amount"]["value"]) if data.get("amount") else 0,
+            "metadata": data.get("metadata")
+        }
+
     except Exception as e:
         logger.error(f"Error verifying payment {payment_id} with API: {e}")
         return None
@@ -140,18 +152,41 @@ async def yookassa_webhook(
             )
             return {"status": "ok"}
         
-        # Дополнительная проверка через API ЮКасса
-        verified_payment = await verify_payment_with_api(payment_id)
+        # Шорт-курт для повторных доставок: ЮКасса ретраит уведомления
+        # агрессивно, SET NX в Redis отсекает дубликат до похода в API
+        # ЮКассы и открытия транзакции в Postgres. Проверка processed_at
+        # в БД остаётся авторитетным fallback'ом на случай сброса Redis
+        redis = await get_redis()
+        seen_key = f"yk:seen:{payment_id}"
+        first_delivery = await redis.set(seen_key, "1", nx=True, ex=86400)
+        if not first_delivery:
+            logger.info(f"Duplicate YooKassa webhook for payment {payment_id}, skipping")
+            return {"status": "ok"}
+
+        # Дополнительная проверка через API ЮКасса параллельно с
+        # SELECT платежа из БД: независимые I/O, миллисекундный запрос
+        # к Postgres прячется за сотнями миллисекунд похода к платёжке
+        verified_payment, payment = await asyncio.gather(
+            verify_payment_with_api(payment_id),
+            PaymentService.get_payment_by_id(session, payment_id)
+        )
         if not verified_payment or verified_payment["status"] != "succeeded":
             logger.warning(
                 f"Payment {payment_id} verification failed via API. "
                 f"Webhook status: {status}, API status: {verified_payment.get('status') if verified_payment else 'None'}"
             )
+            # Снимаем маркер, чтобы следующий ретрай прошёл проверку заново
+            await redis.delete(seen_key)
             return {"status": "ok", "message": "verification_failed"}
-        
-        # Обрабатываем платеж идемпотентно
-        await process_payment_webhook(session, payment_id, payment_data)
-        
+
+        # Обрабатываем платеж идемпотентно (строка уже выбрана выше)
+        try:
+            await process_payment_webhook(session, payment_id, payment_data, payment=payment)
+        except Exception:
+            # Обработка не удалась - маркер снимаем, ретрай доработает
+            await redis.delete(seen_key)
+            raise
+
         # ВСЕГДА возвращаем HTTP 200 (идемпотентность)
         return {"status": "ok"}
         
@@ -164,15 +199,20 @@ async def yookassa_webhook(
 async def process_payment_webhook(
     session: AsyncSession,
     payment_id: str,
-    payment_data: dict
+    payment_data: dict,
+    payment: Optional[Payment] = None
 ):
     """
     Идемпотентная обработка webhook платежа
+
+    payment можно передать готовым (webhook выбирает его параллельно
+    с проверкой через API ЮКассы) - тогда повторный SELECT не нужен
     """
     try:
-        # Получаем платеж из БД
-        payment = await PaymentService.get_payment_by_id(session, payment_id)
-        
+        # Получаем платеж из БД, если не передан вызывающим кодом
+        if payment is None:
+            payment = await PaymentService.get_payment_by_id(session, payment_id)
+
         if not payment:
             logger.error(f"Payment not found: {payment_id}")
             return
@@ -198,6 +238,7 @@ async def process_payment_webhook(
         payment.processed_at = datetime.now()
         
         # Если платеж успешен - начисляем кредиты
+        notify_text = None
         if payment.status == "succeeded":
             # Начисляем кредиты
             await BalanceService.add_credits(
@@ -207,31 +248,35 @@ async def process_payment_webhook(
                 reference_id=topup.id,
                 transaction_type="topup"
             )
-            
+
             # Обновляем статус topup
             topup.status = "paid"
             topup.paid_at = datetime.now()
-            
+
             logger.info(
                 f"Payment {payment_id} processed successfully. "
                 f"Added {topup.credits} credits to user {topup.user_id}"
             )
-            
-            # Отправляем уведомление пользователю
+
+            notify_text = (
+                f"✅ Оплата получена!\n\n"
+                f"💰 Начислено: {topup.credits} кредитов\n"
+                f"💳 Сумма: {topup.rub_amount}₽\n\n"
+                f"Проверьте баланс: /balance"
+            )
+
+        await session.commit()
+
+        # Уведомление пользователю через очередь рассылки - после
+        # commit'а, чтобы поход в Telegram API не держал транзакцию
+        # и не задерживал ответ ЮКассе
+        if notify_text:
             try:
-                from bot_api.bot import send_message
-                await send_message(
-                    topup.user_id,
-                    f"✅ Оплата получена!\n\n"
-                    f"💰 Начислено: {topup.credits} кредитов\n"
-                    f"💳 Сумма: {topup.rub_amount}₽\n\n"
-                    f"Проверьте баланс: /balance"
-                )
+                from bot_api.bot import enqueue_notify
+                await enqueue_notify(topup.user_id, notify_text)
             except Exception as e:
                 logger.error(f"Error sending notification to user {topup.user_id}: {e}")
         
-        await session.commit()
-        
     except Exception as e:
         await session.rollback()
         logger.error(f"Error processing payment webhook {payment_id}: {e}", exc_info=True)
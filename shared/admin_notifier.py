@@ -1,12 +1,22 @@
 """
 Утилита для отправки уведомлений админам
 """
+import asyncio
 import logging
 from typing import Optional
 from shared.config import ADMIN_IDS
 
 logger = logging.getLogger(__name__)
 
+# Эмодзи уровней - модульная константа, а не dict на каждый вызов
+_LEVEL_EMOJI = {
+    "info": "ℹ️",
+    "warning": "⚠️",
+    "error": "🚨",
+    "critical": "🔴",
+    "success": "✅"
+}
+
 
 async def notify_admin(message: str, level: str = "error", send_func=None):
     """
@@ -25,28 +35,24 @@ async def notify_admin(message: str, level: str = "error", send_func=None):
         logger.warning("send_func not provided, cannot send notification")
         return
     
-    emoji = {
-        "info": "ℹ️",
-        "warning": "⚠️",
-        "error": "🚨",
-        "critical": "🔴",
-        "success": "✅"
-    }.get(level.lower(), "📝")
-    
+    emoji = _LEVEL_EMOJI.get(level.lower(), "📝")
     formatted_message = f"{emoji} **{level.upper()}**\n\n{message}"
     
-    success_count = 0
+    # Рассылаем всем админам параллельно: N вызовов Telegram API
+    # занимают время одного, а не суммы всех
+    admin_ids = tuple(ADMIN_IDS)
+    results = await asyncio.gather(
+        *(send_func(admin_id, formatted_message) for admin_id in admin_ids),
+        return_exceptions=True
+    )
+
     failed_count = 0
-    
-    for admin_id in ADMIN_IDS:
-        try:
-            await send_func(admin_id, formatted_message)
-            success_count += 1
-            logger.info(f"Notification sent to admin {admin_id}")
-        except Exception as e:
+    for admin_id, result in zip(admin_ids, results):
+        if isinstance(result, BaseException):
             failed_count += 1
-            logger.error(f"Failed to notify admin {admin_id}: {e}")
-    
+            logger.error(f"Failed to notify admin {admin_id}: {result}")
+
+    success_count = len(admin_ids) - failed_count
     logger.info(f"Admin notification sent: {success_count} success, {failed_count} failed")
 
 
@@ -3,7 +3,7 @@
 """
 import os
 from pathlib import Path
-from typing import List
+from typing import FrozenSet, List
 
 # Базовые пути
 BASE_DIR = Path(__file__).parent.parent
@@ -17,12 +17,25 @@ TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 # Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_TIMEOUT = int(os.getenv("GEMINI_TIMEOUT", "600"))
+
+# Сколько генераций worker обрабатывает одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+
+# Клиентский лимит запросов к Gemini (QPM модели)
+GEMINI_RATE_LIMIT_PER_MINUTE = int(os.getenv("GEMINI_RATE_LIMIT_PER_MINUTE", "60"))
 GEMINI_MODEL = "gemini-3.0-pro-image"
 
 # PostgreSQL
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://localhost/nano_banana")
 # Railway автоматически предоставляет DATABASE_URL
 
+# Размер пула соединений - задаётся per-service через env:
+# bot-api держит больше (много конкурентных запросов), worker меньше.
+# Сумма pool_size + overflow по всем репликам должна оставаться
+# ниже max_connections Postgres с запасом на админские сессии
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
 # Redis
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 # Railway автоматически предоставляет REDIS_URL
@@ -67,9 +80,10 @@ REFERRAL_ACTIVATION_REQUIRED = True  # Реферер получает нагр
 SUPPORT_USERNAME = "Bashirov1111"
 SUPPORT_URL = f"https://t.me/{SUPPORT_USERNAME}"
 
-# Администраторы (список Telegram ID)
+# Администраторы (Telegram ID)
+# frozenset: O(1) проверка членства на каждом update
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")  # Через запятую: "123456789,987654321"
-ADMIN_IDS: List[int] = [int(id.strip()) for id in ADMIN_IDS_STR.split(",") if id.strip()]
+ADMIN_IDS: FrozenSet[int] = frozenset(int(id.strip()) for id in ADMIN_IDS_STR.split(",") if id.strip())
 
 # Валидация ADMIN_IDS
 if not ADMIN_IDS:
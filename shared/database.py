@@ -1,6 +1,8 @@
 """
 SQLAlchemy модели базы данных
 """
+import asyncio
+import json
 from datetime import datetime
 from decimal import Decimal
 from typing import Optional
@@ -9,14 +11,14 @@ import uuid
 from sqlalchemy import (
     BigInteger, Boolean, Column, DateTime, Integer, 
     Numeric, String, Text, ForeignKey, UniqueConstraint,
-    Index
+    Index, text as sqlalchemy_text
 )
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
 
-from shared.config import DATABASE_URL
+from shared.config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW
 
 # Создаем базовый класс
 Base = declarative_base()
@@ -25,19 +27,43 @@ Base = declarative_base()
 # (будет импортировано в конце файла)
 
 # Создаем async engine
+# LIFO держит "горячее" подмножество соединений (кэши на стороне PG тёплые),
+# pre-ping отключён - битые соединения отсеивает pool_recycle
 engine = create_async_engine(
     DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
     echo=False,
-    pool_pre_ping=True,
-    pool_size=20,
-    max_overflow=40
+    pool_pre_ping=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_use_lifo=True,
+    pool_recycle=1800,
+    # Кэш скомпилированного SQL на стороне SQLAlchemy: горячие запросы
+    # (счётчик активных, история, баланс) компилируются один раз
+    query_cache_size=1000,
+    # Компактная сериализация JSONB-колонок (settings, raw_payload):
+    # без пробелов-разделителей и \u-эскейпов кириллицы - меньше байт
+    # на каждую запись
+    json_serializer=lambda obj: json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":")
+    ),
+    # asyncpg: JIT на коротких OLTP-запросах только добавляет задержку,
+    # а кэши prepared statements (диалекта и самого asyncpg) снимают
+    # повторный parse+plan на стороне Postgres
+    connect_args={
+        "server_settings": {"jit": "off"},
+        "statement_cache_size": 1024,
+        "prepared_statement_cache_size": 512
+    }
 )
 
 # Создаем session maker
+# autoflush выключен: запросы внутри транзакции не триггерят
+# неявный flush перед каждым SELECT
 AsyncSessionLocal = async_sessionmaker(
     engine,
     class_=AsyncSession,
-    expire_on_commit=False
+    expire_on_commit=False,
+    autoflush=False
 )
 
 
@@ -67,11 +93,21 @@ class User(Base):
     ban_reason = Column(Text, nullable=True)
     
     # Relationships
-    balance = relationship("Balance", back_populates="user", uselist=False)
-    topups = relationship("Topup", back_populates="user")
-    generations = relationship("Generation", back_populates="user")
-    transactions = relationship("Transaction", back_populates="user")
-    referrals = relationship("User", backref="referrer", remote_side=[telegram_id])
+    # lazy="raise": неявная ленивая подгрузка в async-сессии - это
+    # скрытый I/O и N+1; нужные связи загружаются явно через
+    # selectinload/joinedload в месте запроса, остальное падает громко
+    balance = relationship("Balance", back_populates="user", uselist=False, lazy="raise")
+    topups = relationship("Topup", back_populates="user", lazy="raise")
+    generations = relationship("Generation", back_populates="user", lazy="raise")
+    transactions = relationship("Transaction", back_populates="user", lazy="raise")
+    referrals = relationship(
+        "User", backref="referrer", remote_side=[telegram_id], lazy="raise"
+    )
+
+    __table_args__ = (
+        # Частичный индекс: забаненных мало, COUNT по ним становится O(k)
+        Index('idx_user_banned', 'id', postgresql_where=(is_banned == True)),
+    )
 
 
 class Balance(Base):
@@ -85,7 +121,7 @@ class Balance(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     
     # Relationships
-    user = relationship("User", back_populates="balance")
+    user = relationship("User", back_populates="balance", lazy="raise")
     
     __table_args__ = (
         Index('idx_balance_user_id', 'user_id'),
@@ -105,12 +141,18 @@ class Topup(Base):
     paid_at = Column(DateTime, nullable=True)
     
     # Relationships
-    user = relationship("User", back_populates="topups")
-    payments = relationship("Payment", back_populates="topup")
+    user = relationship("User", back_populates="topups", lazy="raise")
+    payments = relationship("Payment", back_populates="topup", lazy="raise")
     
     __table_args__ = (
         Index('idx_topup_user_id', 'user_id'),
         Index('idx_topup_status', 'status'),
+        # Частичный индекс по неоплаченным: их мало, поиск зависших
+        # пополнений не трогает основную массу строк
+        Index(
+            'idx_topup_pending', 'created_at',
+            postgresql_where=sqlalchemy_text("status = 'created'")
+        ),
     )
 
 
@@ -129,7 +171,7 @@ class Payment(Base):
     created_at = Column(DateTime, default=func.now())
     
     # Relationships
-    topup = relationship("Topup", back_populates="payments")
+    topup = relationship("Topup", back_populates="payments", lazy="raise")
     
     __table_args__ = (
         Index('idx_payment_payment_id', 'payment_id'),
@@ -157,13 +199,35 @@ class Generation(Base):
     completed_at = Column(DateTime, nullable=True)
     
     # Relationships
-    user = relationship("User", back_populates="generations")
+    user = relationship("User", back_populates="generations", lazy="raise")
     
     __table_args__ = (
         Index('idx_generation_user_id', 'user_id'),
         Index('idx_generation_job_id', 'job_id'),
         Index('idx_generation_status', 'status'),
         Index('idx_generation_created_at', 'created_at'),
+        # Композитный индекс под "последние генерации пользователя"
+        Index('idx_generation_user_created_at', 'user_id', created_at.desc()),
+        # Частичный индекс: активных генераций мало, поиск по ним O(log k)
+        Index(
+            'idx_generation_user_active', 'user_id',
+            postgresql_where=status.in_(["pending", "processing"])
+        ),
+        # Частичный индекс под watchdog: поиск зависших processing
+        # по started_at без скана всей таблицы
+        Index(
+            'idx_gen_processing_started', 'started_at',
+            postgresql_where=sqlalchemy_text("status = 'processing'")
+        ),
+        # Частичный индекс под периодический cleanup: выборка
+        # status='completed' AND completed_at < X AND image_url IS NOT NULL
+        # идёт по индексу только подходящих строк вместо скана таблицы
+        Index(
+            'idx_gen_cleanup', 'completed_at',
+            postgresql_where=sqlalchemy_text(
+                "status = 'completed' AND image_url IS NOT NULL"
+            )
+        ),
     )
 
 
@@ -181,7 +245,7 @@ class Transaction(Base):
     created_at = Column(DateTime, default=func.now())
     
     # Relationships
-    user = relationship("User", back_populates="transactions")
+    user = relationship("User", back_populates="transactions", lazy="raise")
     
     __table_args__ = (
         Index('idx_transaction_user_id', 'user_id'),
@@ -207,10 +271,52 @@ class UserSession(Base):
 
 # ========== Функции для работы с БД ==========
 
+# Агрегаты по рефералам для админских сводок/лидербордов:
+# терпят минуты устаревания, поэтому считаются заранее в
+# materialized view и освежаются периодически из cleanup-сервиса.
+# Уникальный индекс обязателен для REFRESH ... CONCURRENTLY
+_REFERRER_STATS_MV_DDL = (
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS mv_referrer_stats AS
+    SELECT
+        referrer_id,
+        count(*) AS total,
+        count(*) FILTER (WHERE status = 'ACTIVATED') AS activated,
+        count(*) FILTER (WHERE status = 'REWARDED') AS rewarded
+    FROM referrals
+    GROUP BY referrer_id
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_referrer_stats_referrer
+    ON mv_referrer_stats (referrer_id)
+    """,
+)
+
+REFRESH_REFERRER_STATS_SQL = (
+    "REFRESH MATERIALIZED VIEW CONCURRENTLY mv_referrer_stats"
+)
+
+
 async def init_db():
     """Инициализация базы данных"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for ddl in _REFERRER_STATS_MV_DDL:
+            await conn.execute(sqlalchemy_text(ddl))
+
+
+async def warm_db_pool(connections: int = 10):
+    """
+    Прогреть пул соединений при старте
+
+    Параллельно открывает несколько соединений и выполняет SELECT 1 -
+    TCP+auth рукопожатия оплачиваются на старте, а не первым запросом
+    """
+    async def _warm():
+        async with engine.connect() as conn:
+            await conn.execute(sqlalchemy_text("SELECT 1"))
+
+    await asyncio.gather(*[_warm() for _ in range(connections)])
 
 
 async def get_session() -> AsyncSession:
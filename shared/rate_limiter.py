@@ -0,0 +1,74 @@
+"""
+Redis-backed лимитер скользящего окна для внешних API
+"""
+import logging
+import time
+import uuid
+from typing import Optional
+
+from shared.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Скользящее окно на ZSET, атомарно в одном Lua-вызове:
+# выкидываем события старше окна, считаем оставшиеся и, если лимит
+# не выбран, регистрируем новое событие
+# KEYS[1] - ключ окна
+# ARGV[1] - текущее время (секунды)
+# ARGV[2] - лимит событий в окне
+# ARGV[3] - ширина окна (секунды)
+# ARGV[4] - уникальный член для ZADD
+_SLIDING_WINDOW_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, tonumber(ARGV[1]) - tonumber(ARGV[3]))
+local n = redis.call('ZCARD', KEYS[1])
+if n < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class SlidingWindowLimiter:
+    """
+    Клиентский rate limiter: N событий на скользящее окно
+
+    Ставится перед походом во внешний API, чтобы не узнавать о 429
+    постфактум, сжигая round-trip и бюджет ретраев
+    """
+
+    def __init__(self, key: str, limit: int, window: int):
+        """
+        Args:
+            key: Ключ окна в Redis
+            limit: Максимум событий в окне
+            window: Ширина окна в секундах
+        """
+        self.key = key
+        self.limit = limit
+        self.window = window
+        self._script = None
+
+    @property
+    def retry_after(self) -> float:
+        """Средний интервал между слотами - разумная пауза перед повтором"""
+        return self.window / max(self.limit, 1)
+
+    async def acquire(self) -> bool:
+        """
+        Занять слот в окне
+
+        Returns:
+            True если слот получен, False если лимит выбран
+        """
+        client = await get_redis()
+
+        if self._script is None:
+            self._script = client.register_script(_SLIDING_WINDOW_LUA)
+
+        allowed = await self._script(
+            keys=[self.key],
+            args=[time.time(), self.limit, self.window, uuid.uuid4().hex]
+        )
+        return bool(allowed)
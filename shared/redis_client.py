@@ -1,6 +1,7 @@
 """
 Redis клиент для очередей и кэширования
 """
+import asyncio
 import logging
 import json
 from typing import Optional, Any
@@ -10,6 +11,12 @@ from shared.config import REDIS_URL
 
 logger = logging.getLogger(__name__)
 
+
+def _dumps(data: Any) -> str:
+    """Компактная сериализация для Redis: без пробелов-разделителей
+    и \\u-эскейпов кириллицы - меньше байт на каждый payload"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
 # Глобальный Redis клиент
 _redis_client: Optional[redis.Redis] = None
 
@@ -51,22 +58,68 @@ class RedisQueue:
     def __init__(self, queue_name: str):
         self.queue_name = queue_name
         self.redis_client = None
-    
+        # Микробатчинг enqueue: задачи, пришедшие в одном тике
+        # event loop'а, уезжают одним вариативным RPUSH
+        self._pending: list = []
+        self._flush_task: Optional[asyncio.Task] = None
+
     async def _get_client(self):
         if not self.redis_client:
             self.redis_client = await get_redis()
         return self.redis_client
-    
+
     async def enqueue(self, data: dict) -> str:
         """
         Добавить задачу в очередь
+
+        Конкурентные enqueue одного тика коалесцируются в один
+        RPUSH key v1 v2 ...: один round-trip вместо N, без
+        дополнительной задержки для одиночных задач
         """
-        client = await self._get_client()
-        job_data = json.dumps(data)
-        await client.rpush(self.queue_name, job_data)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((_dumps(data), fut))
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+        await fut
         logger.info(f"Enqueued job to {self.queue_name}: {data.get('job_id')}")
         return data.get('job_id')
+
+    async def _flush_pending(self):
+        """Сбросить накопленные enqueue одним вариативным RPUSH"""
+        # Уступаем тик, чтобы соседние enqueue успели добавиться в батч
+        await asyncio.sleep(0)
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                client = await self._get_client()
+                await client.rpush(self.queue_name, *[payload for payload, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_result(None)
     
+    async def enqueue_many(self, items: list) -> int:
+        """
+        Добавить пачку задач одним round-trip'ом
+
+        Для заранее известного списка задач (рассылки, переочередь
+        после рестарта) pipeline без MULTI дешевле, чем цикл enqueue:
+        команды уезжают одним пакетом
+        """
+        if not items:
+            return 0
+
+        client = await self._get_client()
+        await client.rpush(self.queue_name, *[_dumps(item) for item in items])
+        logger.info(f"Enqueued {len(items)} jobs to {self.queue_name}")
+        return len(items)
+
     async def dequeue(self, timeout: int = 0) -> Optional[dict]:
         """
         Получить задачу из очереди (блокирующая операция)
@@ -125,13 +178,78 @@ class RedisCache:
         client = await self._get_client()
         
         if isinstance(value, (dict, list)):
-            value = json.dumps(value)
+            value = _dumps(value)
         
         if ttl:
             await client.setex(key, ttl, value)
         else:
             await client.set(key, value)
     
+    async def mget(self, keys: list) -> dict:
+        """
+        Получить несколько значений одним round-trip'ом
+
+        Returns:
+            dict {key: value} только по найденным ключам
+        """
+        if not keys:
+            return {}
+
+        client = await self._get_client()
+        values = await client.mget(keys)
+
+        result = {}
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            try:
+                result[key] = json.loads(value)
+            except json.JSONDecodeError:
+                result[key] = value
+        return result
+
+    async def mset(self, mapping: dict, ttl: Optional[int] = None):
+        """
+        Установить несколько значений одним pipeline'ом
+
+        С ttl каждый ключ уходит отдельным SETEX, но все команды
+        уезжают одним пакетом без транзакции
+        """
+        if not mapping:
+            return
+
+        client = await self._get_client()
+        encoded = {
+            key: _dumps(value) if isinstance(value, (dict, list)) else value
+            for key, value in mapping.items()
+        }
+
+        if ttl:
+            async with client.pipeline(transaction=False) as pipe:
+                for key, value in encoded.items():
+                    pipe.setex(key, ttl, value)
+                await pipe.execute()
+        else:
+            await client.mset(encoded)
+
+    async def set_if_absent(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
+        """
+        Записать значение, только если ключа ещё нет
+
+        Атомарный SET NX [EX] одним round-trip'ом вместо пары
+        exists + set с гонкой между ними
+
+        Returns:
+            True если запись произошла (ключа не было)
+        """
+        client = await self._get_client()
+
+        if isinstance(value, (dict, list)):
+            value = _dumps(value)
+
+        result = await client.set(key, value, nx=True, ex=ttl)
+        return bool(result)
+
     async def delete(self, key: str):
         """
         Удалить значение из кэша
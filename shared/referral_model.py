@@ -29,4 +29,10 @@ class Referral(Base):
     __table_args__ = (
         Index('idx_referral_referrer_status', 'referrer_id', 'status'),
         Index('idx_referral_user', 'referred_user_id'),
+        # Покрывает проверку дневного лимита наград (referrer_id +
+        # status=rewarded + rewarded_at >= начало суток) index-only сканом
+        Index(
+            'idx_referral_referrer_status_rewarded_at',
+            'referrer_id', 'status', 'rewarded_at'
+        ),
     )
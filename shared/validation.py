@@ -2,6 +2,8 @@
 Утилиты для валидации входных данных
 """
 import logging
+import os
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Tuple
 from PIL import Image
@@ -13,6 +15,42 @@ logger = logging.getLogger(__name__)
 # Максимальная длина промпта
 MAX_PROMPT_LENGTH = 1000
 
+# Магические байты поддерживаемых форматов: формат определяется по
+# заголовку файла, без декодирования содержимого
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+_JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+# Таблица для str.translate: управляющие символы C0 (кроме \t \n \r)
+# и диапазон C1 выбрасываются одним C-проходом по строке вместо
+# Python-цикла с isprintable() на каждый символ
+_CTRL_TABLE = dict.fromkeys(
+    i for i in range(0x20) if i not in (0x09, 0x0A, 0x0D)
+)
+_CTRL_TABLE.update(dict.fromkeys(range(0x7F, 0xA0)))
+
+# Допустимые настройки генерации - наборы и тексты ошибок собираются
+# один раз при импорте
+_VALID_RATIOS = ("1:1", "16:9", "9:16", "4:3", "3:4")
+_VALID_RATIOS_SET = frozenset(_VALID_RATIOS)
+_MSG_BAD_RATIO = f"❌ Некорректное соотношение сторон. Доступны: {', '.join(_VALID_RATIOS)}"
+
+_VALID_SIZES = ("1K", "2K", "4K")
+_VALID_SIZES_SET = frozenset(_VALID_SIZES)
+_MSG_BAD_SIZE = f"❌ Некорректный размер изображения. Доступны: {', '.join(_VALID_SIZES)}"
+
+
+def _sniff_image_header(header: bytes) -> bool:
+    """Проверить сигнатуру PNG/JPEG/WebP по первым байтам файла"""
+    if header.startswith(_PNG_MAGIC):
+        return True
+    if header.startswith(_JPEG_MAGIC):
+        return True
+    # WebP: RIFF <size> WEBP
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return True
+    return False
+
 
 class ValidationError(Exception):
     """Ошибка валидации"""
@@ -38,37 +76,64 @@ def validate_prompt(prompt: str) -> Tuple[bool, str]:
     return True, ""
 
 
-def validate_image_file(file_path: str) -> Tuple[bool, str]:
+@lru_cache(maxsize=1024)
+def _validate_image_cached(file_path: str, mtime: float, size: int) -> Tuple[bool, str]:
     """
-    Валидация файла изображения
-    
-    Args:
-        file_path: Путь к файлу
-        
-    Returns:
-        (valid, error_message)
+    Проверка размера и формата с кэшем по (путь, mtime, размер)
+
+    Один и тот же референс часто используется в нескольких генерациях -
+    повторная валидация берётся из кэша; при изменении файла mtime/size
+    меняют ключ, и файл проверяется заново
     """
-    path = Path(file_path)
-    
-    # Проверка существования
-    if not path.exists():
-        return False, f"❌ Файл не найден: {file_path}"
-    
     # Проверка размера
-    file_size_mb = path.stat().st_size / (1024 * 1024)
+    file_size_mb = size / (1024 * 1024)
     if file_size_mb > MAX_IMAGE_SIZE_MB:
         return False, f"❌ Изображение слишком большое! Максимум {MAX_IMAGE_SIZE_MB} MB (у вас {file_size_mb:.1f} MB)"
-    
-    # Проверка формата
+
+    # Проверка формата: сигнатура по первым байтам плюс ленивый
+    # разбор заголовка через PIL. Раньше здесь был img.verify(),
+    # который декодирует весь файл - O(пикселей) на каждую загрузку;
+    # для валидации хватает заголовка и вменяемых размеров
     try:
-        img = Image.open(path)
-        img.verify()
+        with open(file_path, "rb") as f:
+            header = f.read(32)
+
+        if not _sniff_image_header(header):
+            return False, "❌ Некорректный формат изображения: поддерживаются PNG, JPEG, WebP"
+
+        with Image.open(file_path) as img:
+            # draft() для JPEG пропускает полный DCT-декод
+            img.draft("RGB", (256, 256))
+            width, height = img.size
+
+        if width <= 0 or height <= 0:
+            return False, "❌ Некорректный формат изображения: нулевые размеры"
+
     except Exception as e:
         return False, f"❌ Некорректный формат изображения: {str(e)}"
-    
+
     return True, ""
 
 
+def validate_image_file(file_path: str) -> Tuple[bool, str]:
+    """
+    Валидация файла изображения
+
+    Args:
+        file_path: Путь к файлу
+
+    Returns:
+        (valid, error_message)
+    """
+    # Один stat() на файл: и проверка существования, и ключ кэша
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return False, f"❌ Файл не найден: {file_path}"
+
+    return _validate_image_cached(file_path, st.st_mtime, st.st_size)
+
+
 def validate_reference_images(image_paths: List[str]) -> Tuple[bool, str]:
     """
     Валидация списка референсных изображений
@@ -114,15 +179,13 @@ def validate_generation_settings(settings: dict) -> Tuple[bool, str]:
     
     # Соотношение сторон
     aspect_ratio = settings.get("aspect_ratio", "16:9")
-    valid_ratios = ["1:1", "16:9", "9:16", "4:3", "3:4"]
-    if aspect_ratio not in valid_ratios:
-        return False, f"❌ Некорректное соотношение сторон. Доступны: {', '.join(valid_ratios)}"
-    
+    if aspect_ratio not in _VALID_RATIOS_SET:
+        return False, _MSG_BAD_RATIO
+
     # Размер изображения
     output_size = settings.get("output_image_size", "1K")
-    valid_sizes = ["1K", "2K", "4K"]
-    if output_size not in valid_sizes:
-        return False, f"❌ Некорректный размер изображения. Доступны: {', '.join(valid_sizes)}"
+    if output_size not in _VALID_SIZES_SET:
+        return False, _MSG_BAD_SIZE
     
     # Seed
     seed = settings.get("seed", -1)
@@ -145,8 +208,8 @@ def sanitize_prompt(prompt: str) -> str:
     Returns:
         Очищенный промпт
     """
-    # Удаляем управляющие символы
-    sanitized = "".join(char for char in prompt if char.isprintable() or char.isspace())
+    # Удаляем управляющие символы одним str.translate
+    sanitized = prompt.translate(_CTRL_TABLE)
     
     # Удаляем множественные пробелы
     sanitized = " ".join(sanitized.split())
@@ -3,13 +3,16 @@ Cleanup сервис для удаления старых изображений
 """
 import asyncio
 import logging
+import os
 from datetime import datetime, timedelta
 from pathlib import Path
 
-from sqlalchemy import select
+from sqlalchemy import delete, select, update, text as sqlalchemy_text
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from shared.database import AsyncSessionLocal, Generation
+from shared.database import (
+    AsyncSessionLocal, Generation, REFRESH_REFERRER_STATS_SQL, engine
+)
 from shared.config import IMAGE_TTL_DAYS, CLEANUP_INTERVAL, DATA_DIR
 
 logger = logging.getLogger(__name__)
@@ -18,6 +21,20 @@ logger = logging.getLogger(__name__)
 IMAGES_DIR = DATA_DIR / "images"
 REFS_DIR = DATA_DIR / "references"
 
+# Удаления идут через пул тредов пачками: unlink - блокирующий
+# syscall, последовательный цикл по тысячам файлов замораживает
+# event loop на всё время очистки
+_UNLINK_CONCURRENCY = 32
+
+
+def _unlink_if_exists(path_str: str) -> bool:
+    """Удалить файл, если он существует (блокирующий вызов для to_thread)"""
+    path = Path(path_str)
+    if path.exists():
+        path.unlink()
+        return True
+    return False
+
 
 class CleanupService:
     """
@@ -63,9 +80,12 @@ class CleanupService:
         # 2. Очистка старых референсов
         deleted_refs = await self.cleanup_old_references()
         
-        # 3. Очистка старых генераций из БД (опционально)
+        # 3. Освежаем агрегаты по рефералам
+        await self.refresh_referrer_stats()
+
+        # 4. Очистка старых генераций из БД (опционально)
         # deleted_generations = await self.cleanup_old_generations()
-        
+
         logger.info(
             f"🧹 Cleanup completed: "
             f"images={deleted_images}, refs={deleted_refs}"
@@ -80,32 +100,51 @@ class CleanupService:
             ttl_threshold = datetime.now() - timedelta(days=IMAGE_TTL_DAYS)
             
             async with AsyncSessionLocal() as session:
-                # Находим старые генерации с изображениями
-                result = await session.execute(
-                    select(Generation).where(
+                # Только id и путь: полные ORM-объекты ради unlink'а
+                # и обнуления колонки не нужны. Строки идут потоком
+                # через серверный курсор порциями по 500 - большой
+                # бэклог не материализуется в память целиком
+                result = await session.stream(
+                    select(Generation.id, Generation.image_url).where(
                         Generation.status == "completed",
                         Generation.completed_at < ttl_threshold,
                         Generation.image_url.isnot(None)
-                    )
+                    ).execution_options(yield_per=500)
                 )
-                old_generations = result.scalars().all()
-                
-                for generation in old_generations:
-                    try:
-                        image_path = Path(generation.image_url)
-                        
-                        if image_path.exists():
-                            image_path.unlink()
-                            deleted_count += 1
-                            logger.debug(f"Deleted old image: {image_path}")
-                        
-                        # Обнуляем image_url в БД
-                        generation.image_url = None
-                    
-                    except Exception as e:
-                        logger.error(f"Error deleting image {generation.image_url}: {e}")
-                
-                await session.commit()
+
+                # Unlink'и уходят в пул тредов параллельно (с лимитом),
+                # event loop не блокируется на каждом syscall'е
+                sem = asyncio.Semaphore(_UNLINK_CONCURRENCY)
+
+                async def _unlink_one(gen_id, image_url):
+                    async with sem:
+                        try:
+                            removed = await asyncio.to_thread(_unlink_if_exists, image_url)
+                        except Exception as e:
+                            logger.error(f"Error deleting image {image_url}: {e}")
+                            return None
+                        if removed:
+                            logger.debug(f"Deleted old image: {image_url}")
+                        return gen_id, removed
+
+                cleared_ids = []
+                async for chunk in result.partitions(500):
+                    results = await asyncio.gather(
+                        *(_unlink_one(gen_id, image_url) for gen_id, image_url in chunk)
+                    )
+                    cleared_ids.extend(r[0] for r in results if r is not None)
+                    deleted_count += sum(1 for r in results if r is not None and r[1])
+
+                # Обнуляем image_url одним UPDATE по списку id вместо
+                # изменения каждой ORM-строки по отдельности
+                if cleared_ids:
+                    await session.execute(
+                        update(Generation)
+                        .where(Generation.id.in_(cleared_ids))
+                        .values(image_url=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await session.commit()
             
             logger.info(f"🧹 Deleted {deleted_count} old images")
             return deleted_count
@@ -125,20 +164,40 @@ class CleanupService:
             if not REFS_DIR.exists():
                 return 0
             
-            for ref_file in REFS_DIR.iterdir():
-                if not ref_file.is_file():
-                    continue
-                
-                # Проверяем время модификации файла
-                file_mtime = datetime.fromtimestamp(ref_file.stat().st_mtime)
-                
-                if file_mtime < ttl_threshold:
+            # Сначала собираем кандидатов, потом удаляем их пачкой
+            # через пул тредов. os.scandir вместо iterdir + stat:
+            # DirEntry.stat() берётся из кэша getdents - один syscall
+            # на файл вместо двух; порог сравнивается как epoch-число,
+            # без datetime на каждую итерацию
+            threshold_ts = ttl_threshold.timestamp()
+
+            def _scan_stale():
+                """Блокирующий обход каталога (для to_thread)"""
+                stale = []
+                with os.scandir(REFS_DIR) as entries:
+                    for entry in entries:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        if entry.stat().st_mtime < threshold_ts:
+                            stale.append(Path(entry.path))
+                return stale
+
+            candidates = await asyncio.to_thread(_scan_stale)
+
+            sem = asyncio.Semaphore(_UNLINK_CONCURRENCY)
+
+            async def _unlink_ref(path):
+                async with sem:
                     try:
-                        ref_file.unlink()
-                        deleted_count += 1
-                        logger.debug(f"Deleted old reference: {ref_file}")
+                        await asyncio.to_thread(path.unlink)
+                        logger.debug(f"Deleted old reference: {path}")
+                        return True
                     except Exception as e:
-                        logger.error(f"Error deleting reference {ref_file}: {e}")
+                        logger.error(f"Error deleting reference {path}: {e}")
+                        return False
+
+            results = await asyncio.gather(*(_unlink_ref(p) for p in candidates))
+            deleted_count = sum(results)
             
             logger.info(f"🧹 Deleted {deleted_count} old references")
             return deleted_count
@@ -147,6 +206,25 @@ class CleanupService:
             logger.error(f"Error in cleanup_old_references: {e}", exc_info=True)
             return 0
     
+    async def refresh_referrer_stats(self):
+        """
+        Освежить materialized view с агрегатами по рефералам
+
+        CONCURRENTLY не блокирует читателей view; сами агрегаты
+        терпят устаревание на интервал cleanup'а.
+
+        REFRESH ... CONCURRENTLY нельзя выполнять внутри транзакции,
+        поэтому идём мимо сессии - по соединению в режиме AUTOCOMMIT
+        """
+        try:
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                await conn.execute(sqlalchemy_text(REFRESH_REFERRER_STATS_SQL))
+            logger.info("🧹 Refreshed mv_referrer_stats")
+
+        except Exception as e:
+            logger.error(f"Error refreshing mv_referrer_stats: {e}", exc_info=True)
+
     async def cleanup_old_generations(self, days: int = 90) -> int:
         """
         Удалить записи генераций старше N дней (опционально)
@@ -158,19 +236,16 @@ class CleanupService:
             ttl_threshold = datetime.now() - timedelta(days=days)
             
             async with AsyncSessionLocal() as session:
+                # Один DELETE на стороне БД вместо загрузки строк
+                # в Python и удаления по одной
                 result = await session.execute(
-                    select(Generation).where(
-                        Generation.created_at < ttl_threshold
-                    )
+                    delete(Generation)
+                    .where(Generation.created_at < ttl_threshold)
+                    .execution_options(synchronize_session=False)
                 )
-                old_generations = result.scalars().all()
-                
-                for generation in old_generations:
-                    await session.delete(generation)
-                
                 await session.commit()
-                
-                deleted_count = len(old_generations)
+
+                deleted_count = result.rowcount or 0
                 logger.info(f"🧹 Deleted {deleted_count} old generation records")
                 return deleted_count
         
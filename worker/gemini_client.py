@@ -3,6 +3,8 @@ Gemini API клиент для генерации изображений
 """
 import logging
 import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Tuple
 from pathlib import Path
 import base64
@@ -17,6 +19,41 @@ from worker.gemini_error_handler import get_error_handler, GeminiAPIError
 
 logger = logging.getLogger(__name__)
 
+# Отдельный пул под PIL: decode/resize/encode - CPU-тяжёлые вызовы,
+# держащие GIL. В общем executor'е они конкурировали бы с вызовами
+# Gemini API; свой пул размером в число ядер декодирует несколько
+# изображений параллельно, не замораживая event loop
+_IMG_POOL = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 4,
+    thread_name_prefix="pil"
+)
+
+# Свой пул и под блокирующие вызовы Gemini SDK: дефолтный executor
+# делится с DNS-резолвингом и прочими to_thread-вызовами процесса,
+# долгий запрос генерации не должен их вытеснять
+_GEMINI_POOL = ThreadPoolExecutor(
+    max_workers=8,
+    thread_name_prefix="gemini"
+)
+
+# Единственный экземпляр клиента на процесс (см. get_gemini_client)
+_gemini_client: Optional["GeminiClient"] = None
+
+
+def get_gemini_client(on_error_callback=None) -> "GeminiClient":
+    """
+    Получить общий экземпляр GeminiClient
+
+    Клиент держит HTTP-соединения и error handler - пересоздавать
+    его на каждую задачу незачем
+    """
+    global _gemini_client
+
+    if _gemini_client is None:
+        _gemini_client = GeminiClient(on_error_callback=on_error_callback)
+
+    return _gemini_client
+
 
 class GeminiClient:
     """Клиент для работы с Gemini API"""
@@ -27,7 +64,8 @@ class GeminiClient:
         self.error_handler = get_error_handler(
             max_retries=3,
             retry_delay=5,
-            on_error_callback=on_error_callback
+            on_error_callback=on_error_callback,
+            bucket_key=(GEMINI_API_KEY, self.model)
         )
         logger.info(f"Gemini client initialized with model: {self.model}")
     
@@ -35,30 +73,37 @@ class GeminiClient:
         self,
         prompt: str,
         reference_images: List[str],
-        settings: dict
-    ) -> Tuple[Optional[bytes], Optional[str], Optional[int]]:
+        settings: dict,
+        output_path: str
+    ) -> Tuple[Optional[str], Optional[str], Optional[int]]:
         """
         Генерация изображения через Gemini API
-        
+
         Args:
             prompt: Текстовый промпт
             reference_images: Список путей к референсным изображениям
             settings: Настройки генерации
-        
+            output_path: Куда сохранить результат
+
         Returns:
-            (image_data, error, seed)
+            (image_path, error, seed)
         """
         try:
             logger.info(f"Starting generation with prompt: '{prompt[:100]}...'")
             
-            # Подготовка референсных изображений
+            # Подготовка референсных изображений - параллельно через
+            # пул PIL-тредов: N референсов грузятся за время самого
+            # тяжёлого, а не за сумму всех
+            results = await asyncio.gather(
+                *(self._load_image(p) for p in reference_images),
+                return_exceptions=True
+            )
             reference_parts = []
-            for img_path in reference_images:
-                try:
-                    img_data = await self._load_image(img_path)
+            for img_path, img_data in zip(reference_images, results):
+                if isinstance(img_data, BaseException):
+                    logger.error(f"Error loading reference image {img_path}: {img_data}")
+                else:
                     reference_parts.append(img_data)
-                except Exception as e:
-                    logger.error(f"Error loading reference image {img_path}: {e}")
             
             if not reference_parts:
                 return None, "NO_REFERENCE_IMAGES", None
@@ -77,10 +122,10 @@ class GeminiClient:
             
             # Генерация с retry логикой
             async def _generate():
-                loop = asyncio.get_event_loop()
+                loop = asyncio.get_running_loop()
                 return await asyncio.wait_for(
                     loop.run_in_executor(
-                        None,
+                        _GEMINI_POOL,
                         lambda: self.client.models.generate_images(
                             model=self.model,
                             prompt=contents,
@@ -110,12 +155,14 @@ class GeminiClient:
             if hasattr(generated_image, 'generation_seed'):
                 seed = generated_image.generation_seed
             
-            # Конвертируем изображение в bytes
-            image_data = await self._image_to_bytes(generated_image.image)
-            
+            # Пишем результат сразу на диск: без BytesIO-буфера и
+            # промежуточного bytes-объекта - для 4K PNG это десятки
+            # мегабайт пиковой памяти на каждую конкурентную задачу
+            await self._image_to_file(generated_image.image, output_path)
+
             logger.info(f"Generation completed successfully. Seed: {seed}")
-            
-            return image_data, None, seed
+
+            return output_path, None, seed
             
         except asyncio.TimeoutError:
             logger.error(f"Generation timeout after {GEMINI_TIMEOUT}s")
@@ -125,36 +172,57 @@ class GeminiClient:
             logger.error(f"Error during generation: {e}", exc_info=True)
             return None, str(e), None
     
-    async def _load_image(self, image_path: str) -> bytes:
+    @staticmethod
+    def _load_image_sync(image_path: str) -> bytes:
         """
-        Загрузка изображения
+        Загрузка и оптимизация изображения (блокирующий вызов для _IMG_POOL)
         """
         path = Path(image_path)
-        
+
         if not path.exists():
             raise FileNotFoundError(f"Image not found: {image_path}")
-        
+
         # Открываем и оптимизируем изображение
         img = Image.open(path)
-        
+
         # Конвертируем в RGB если нужно
         if img.mode != 'RGB':
             img = img.convert('RGB')
-        
+
         # Оптимизируем размер (макс 2048x2048)
         max_size = 2048
         if img.width > max_size or img.height > max_size:
             img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        # Конвертируем в bytes
+
+        # Референсы уходят в Gemini как JPEG quality=90: PNG с
+        # optimize=True гонял zlib на максимуме на каждый файл, а JPEG
+        # для фотографических референсов в разы меньше и кодируется
+        # на порядок быстрее
         buffer = BytesIO()
-        img.save(buffer, format='PNG', optimize=True)
+        img.save(buffer, format='JPEG', quality=90)
         return buffer.getvalue()
-    
-    async def _image_to_bytes(self, image: Image.Image) -> bytes:
+
+    async def _load_image(self, image_path: str) -> bytes:
         """
-        Конвертация PIL Image в bytes
+        Загрузка изображения через пул PIL-тредов
         """
-        buffer = BytesIO()
-        image.save(buffer, format='PNG')
-        return buffer.getvalue()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _IMG_POOL, self._load_image_sync, image_path
+        )
+
+    @staticmethod
+    def _image_to_file_sync(image: Image.Image, output_path: str):
+        """
+        Сохранение PIL Image на диск (блокирующий вызов для _IMG_POOL)
+        """
+        image.save(output_path, format='PNG')
+
+    async def _image_to_file(self, image: Image.Image, output_path: str):
+        """
+        Сохранение PIL Image на диск через пул PIL-тредов
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            _IMG_POOL, self._image_to_file_sync, image, output_path
+        )
@@ -3,6 +3,7 @@
 """
 import asyncio
 import logging
+import random
 from typing import Optional, Callable
 from datetime import datetime, timedelta
 
@@ -34,6 +35,39 @@ class NetworkError(GeminiAPIError):
     pass
 
 
+# Типизированные исключения SDK и транспорта распознаются по имени
+# класса - один поиск в словаре точнее и дешевле разбора сообщения
+_ERROR_TYPES = {
+    "ResourceExhausted": QuotaExceededError,
+    "TooManyRequests": RateLimitError,
+    "PermissionDenied": InvalidAPIKeyError,
+    "Unauthenticated": InvalidAPIKeyError,
+    "Unauthorized": InvalidAPIKeyError,
+    "TimeoutError": NetworkError,
+    "TimeoutException": NetworkError,
+    "ClientConnectorError": NetworkError,
+    "ConnectionError": NetworkError,
+}
+
+# Таблица классификации ошибок: собирается один раз при импорте,
+# порядок важен - первое совпадение выигрывает
+_ERROR_KEYWORDS = (
+    ("429", RateLimitError),
+    ("rate limit", RateLimitError),
+    ("too many requests", RateLimitError),
+    ("quota", QuotaExceededError),
+    ("limit exceeded", QuotaExceededError),
+    ("api key", InvalidAPIKeyError),
+    ("unauthorized", InvalidAPIKeyError),
+    ("401", InvalidAPIKeyError),
+    ("connection", NetworkError),
+    ("timeout", NetworkError),
+    ("network", NetworkError),
+    ("unreachable", NetworkError),
+    ("dns", NetworkError),
+)
+
+
 class GeminiErrorHandler:
     """
     Обработчик ошибок Gemini API с retry логикой
@@ -43,12 +77,27 @@ class GeminiErrorHandler:
         self,
         max_retries: int = 3,
         retry_delay: int = 5,
+        max_delay: int = 30,
+        jitter: float = 0.5,
         on_error_callback: Optional[Callable] = None
     ):
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
         self.on_error_callback = on_error_callback
         self.quota_exceeded_until: Optional[datetime] = None
+
+    def _backoff(self, attempt: int) -> float:
+        """
+        Экспоненциальная задержка с джиттером и потолком
+
+        Без джиттера несколько воркеров, словивших 429 одновременно,
+        ретраят в такт и снова сталкиваются; случайная добавка
+        рассинхронизирует их
+        """
+        base = min(self.max_delay, self.retry_delay * (2 ** attempt))
+        return base * (1 + random.uniform(0, self.jitter))
     
     async def execute_with_retry(self, func: Callable, *args, **kwargs):
         """
@@ -75,7 +124,7 @@ class GeminiErrorHandler:
         
         for attempt in range(self.max_retries):
             try:
-                logger.info(f"Attempt {attempt + 1}/{self.max_retries}")
+                logger.info("Attempt %d/%d", attempt + 1, self.max_retries)
                 result = await func(*args, **kwargs)
                 
                 # Успех - сбрасываем quota_exceeded_until
@@ -90,14 +139,14 @@ class GeminiErrorHandler:
                 error_type = self._classify_error(e)
                 
                 logger.error(
-                    f"Attempt {attempt + 1} failed: {error_type.__name__}: {str(e)}"
+                    "Attempt %d failed: %s: %s", attempt + 1, error_type.__name__, e
                 )
                 
                 # Обрабатываем разные типы ошибок
                 if error_type == RateLimitError:
                     # Rate limit - ждём дольше
-                    wait_time = self.retry_delay * (2 ** attempt)  # Exponential backoff
-                    logger.warning(f"Rate limit hit, waiting {wait_time}s")
+                    wait_time = self._backoff(attempt)
+                    logger.warning("Rate limit hit, waiting %.1fs", wait_time)
                     await asyncio.sleep(wait_time)
                     continue
                 
@@ -130,20 +179,21 @@ class GeminiErrorHandler:
                 elif error_type == NetworkError:
                     # Network error - ретраим с задержкой
                     if attempt < self.max_retries - 1:
-                        wait_time = self.retry_delay
-                        logger.warning(f"Network error, retrying in {wait_time}s")
+                        wait_time = self._backoff(attempt)
+                        logger.warning("Network error, retrying in %.1fs", wait_time)
                         await asyncio.sleep(wait_time)
                         continue
-                
+
                 else:
                     # Неизвестная ошибка
                     if attempt < self.max_retries - 1:
-                        logger.warning(f"Unknown error, retrying in {self.retry_delay}s")
-                        await asyncio.sleep(self.retry_delay)
+                        wait_time = self._backoff(attempt)
+                        logger.warning("Unknown error, retrying in %.1fs", wait_time)
+                        await asyncio.sleep(wait_time)
                         continue
         
         # Все попытки исчерпаны
-        logger.error(f"All {self.max_retries} attempts failed")
+        logger.error("All %d attempts failed", self.max_retries)
         
         if self.on_error_callback:
             await self.on_error_callback(
@@ -163,49 +213,45 @@ class GeminiErrorHandler:
         Returns:
             Тип ошибки
         """
+        # Быстрый путь: типизированное исключение SDK/транспорта
+        by_type = _ERROR_TYPES.get(type(error).__name__)
+        if by_type is not None:
+            return by_type
+
+        # Fallback: разбор текста для нетипизированных ошибок
         error_str = str(error).lower()
-        
-        # Rate limit
-        if "429" in error_str or "rate limit" in error_str or "too many requests" in error_str:
-            return RateLimitError
-        
-        # Quota exceeded
-        if "quota" in error_str or "limit exceeded" in error_str:
-            return QuotaExceededError
-        
-        # Invalid API key
-        if "api key" in error_str or "unauthorized" in error_str or "401" in error_str:
-            return InvalidAPIKeyError
-        
-        # Network errors
-        if any(keyword in error_str for keyword in [
-            "connection", "timeout", "network", "unreachable", "dns"
-        ]):
-            return NetworkError
-        
+
+        for keyword, error_type in _ERROR_KEYWORDS:
+            if keyword in error_str:
+                return error_type
+
         # Неизвестная ошибка
         return GeminiAPIError
 
 
-# Глобальный экземпляр
-_error_handler: Optional[GeminiErrorHandler] = None
+# Реестр обработчиков по (ключ API, модель): quota_exceeded_until -
+# состояние конкретной пары, исчерпание квоты на одном ключе не должно
+# останавливать вызовы через другой ключ или модель
+_handlers: dict = {}
 
 
 def get_error_handler(
     max_retries: int = 3,
     retry_delay: int = 5,
-    on_error_callback: Optional[Callable] = None
+    on_error_callback: Optional[Callable] = None,
+    bucket_key: tuple = ("default", "default")
 ) -> GeminiErrorHandler:
     """
-    Получить глобальный error handler
+    Получить error handler для пары (ключ API, модель)
     """
-    global _error_handler
-    
-    if _error_handler is None:
-        _error_handler = GeminiErrorHandler(
+    handler = _handlers.get(bucket_key)
+
+    if handler is None:
+        handler = GeminiErrorHandler(
             max_retries=max_retries,
             retry_delay=retry_delay,
             on_error_callback=on_error_callback
         )
-    
-    return _error_handler
+        _handlers[bucket_key] = handler
+
+    return handler
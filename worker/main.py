@@ -12,8 +12,8 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from shared.database import AsyncSessionLocal, init_db
 from shared.redis_client import generation_queue, close_redis
-from shared.config import LOG_LEVEL, LOG_FORMAT, DATA_DIR
-from worker.gemini_client import GeminiClient
+from shared.config import LOG_LEVEL, LOG_FORMAT, DATA_DIR, WORKER_CONCURRENCY
+from worker.gemini_client import get_gemini_client
 from worker.tasks import process_generation
 from worker.watchdog import Watchdog
 from worker.cleanup import CleanupService
@@ -35,9 +35,17 @@ class Worker:
     
     def __init__(self):
         self.running = False
-        self.gemini_client = GeminiClient()
+        self.gemini_client = get_gemini_client()
         self.watchdog = Watchdog(check_interval=60)
         self.cleanup_service = CleanupService()
+        # Задачи обрабатываются конкурентно, но не больше
+        # WORKER_CONCURRENCY одновременно: пока Gemini отвечает на одну
+        # генерацию, worker берёт из очереди следующие
+        self.sem = asyncio.Semaphore(WORKER_CONCURRENCY)
+        self.inflight = set()
+        # Сигнал остановки: прерывает длинный BLPOP, не дожидаясь
+        # его таймаута
+        self._stop_event = asyncio.Event()
     
     async def start(self):
         """Запуск worker"""
@@ -51,49 +59,117 @@ class Worker:
         # Запуск watchdog и cleanup в фоне
         asyncio.create_task(self.watchdog.start())
         asyncio.create_task(self.cleanup_service.start())
+        asyncio.create_task(self._report_queue_depth())
         logger.info("✅ Watchdog and Cleanup services started")
         
-        # Основной цикл обработки
+        # Основной цикл обработки. BLPOP блокируется надолго (30s) -
+        # в простое worker не жжёт CPU на перезаходах; при ошибках
+        # Redis пауза растёт экспоненциально до 5s, чтобы не долбить
+        # сокет во время сбоя
+        error_delay = 1
         while self.running:
+            # Слот берём до dequeue: при заполненной обойме worker
+            # не вытягивает бэклог очереди в память
+            await self.sem.acquire()
             try:
-                # Получаем задачу из очереди (блокирующая операция с таймаутом)
-                job_data = await generation_queue.dequeue(timeout=5)
-                
-                if job_data:
-                    logger.info(f"📥 Received job: {job_data.get('job_id')}")
-                    
-                    # Обрабатываем задачу
-                    await process_generation(
-                        job_data=job_data,
-                        gemini_client=self.gemini_client
-                    )
-                
+                # Получаем задачу из очереди (блокирующий BLPOP,
+                # прерываемый сигналом остановки)
+                job_data = await self._dequeue_or_stop()
+                error_delay = 1
+
+                if not job_data:
+                    self.sem.release()
+                    continue
+
+                logger.info(f"📥 Received job: {job_data.get('job_id')}")
+
+                # Обрабатываем задачу в фоне, слот освободит _run_job
+                task = asyncio.create_task(self._run_job(job_data))
+                self.inflight.add(task)
+                task.add_done_callback(self.inflight.discard)
+
             except KeyboardInterrupt:
+                self.sem.release()
                 logger.info("Received interrupt signal, shutting down...")
                 self.running = False
                 break
-            
+
             except Exception as e:
+                self.sem.release()
                 logger.error(f"Error in worker loop: {e}", exc_info=True)
-                await asyncio.sleep(1)
-        
+                await asyncio.sleep(error_delay)
+                error_delay = min(error_delay * 2, 5)
+
         # Cleanup
         await self.cleanup()
+
+    async def _report_queue_depth(self):
+        """
+        Периодически логировать глубину очереди
+
+        Рост глубины при занятых слотах - сигнал к масштабированию
+        воркеров (bot-api сам перестаёт принимать задачи на лимите
+        очереди ещё на admission-проверке)
+        """
+        while self.running:
+            try:
+                depth = await generation_queue.size()
+                in_use = len(self.inflight)
+                logger.info(f"📊 Queue depth: {depth}, jobs in flight: {in_use}")
+            except Exception as e:
+                logger.error(f"Error reporting queue depth: {e}")
+            await asyncio.sleep(60)
+
+    async def _dequeue_or_stop(self):
+        """
+        Забрать задачу из очереди или вернуть None при остановке
+        """
+        dequeue_task = asyncio.create_task(generation_queue.dequeue(timeout=30))
+        stop_task = asyncio.create_task(self._stop_event.wait())
+
+        done, pending = await asyncio.wait(
+            {dequeue_task, stop_task},
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+
+        if dequeue_task in done:
+            return dequeue_task.result()
+        return None
+
+    async def _run_job(self, job_data):
+        """Обработать одну задачу и вернуть слот конкурентности"""
+        try:
+            await process_generation(
+                job_data=job_data,
+                gemini_client=self.gemini_client
+            )
+        except Exception as e:
+            logger.error(f"Error processing job {job_data.get('job_id')}: {e}", exc_info=True)
+        finally:
+            self.sem.release()
     
     async def cleanup(self):
         """Очистка ресурсов"""
         logger.info("🧹 Cleaning up...")
-        
+
+        # Дожидаемся начатых генераций
+        if self.inflight:
+            logger.info(f"Waiting for {len(self.inflight)} in-flight jobs...")
+            await asyncio.gather(*self.inflight, return_exceptions=True)
+
         # Останавливаем watchdog и cleanup
         self.watchdog.stop()
         self.cleanup_service.stop()
-        
+
         await close_redis()
         logger.info("✅ Worker stopped")
     
     def stop(self):
         """Остановка worker"""
         self.running = False
+        self._stop_event.set()
 
 
 async def main():
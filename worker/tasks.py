@@ -1,14 +1,18 @@
 """
 Задачи обработки генераций
 """
+import asyncio
 import logging
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import Dict
 import uuid
 
 from shared.database import AsyncSessionLocal, Generation
-from shared.config import GENERATION_COST, DATA_DIR
+from shared.config import GENERATION_COST, DATA_DIR, GEMINI_RATE_LIMIT_PER_MINUTE
+from shared.rate_limiter import SlidingWindowLimiter
+from shared.redis_client import generation_queue
 from bot_api.services.balance_service import BalanceService
 from worker.gemini_client import GeminiClient
 
@@ -18,6 +22,43 @@ logger = logging.getLogger(__name__)
 IMAGES_DIR = DATA_DIR / "images"
 IMAGES_DIR.mkdir(exist_ok=True)
 
+# Клиентский лимитер перед Gemini: общий на всех воркеров через Redis.
+# Дешевле придержать задачу здесь, чем получить 429 и жечь бюджет
+# ретраев с экспоненциальными паузами
+_gemini_limiter = SlidingWindowLimiter(
+    "rate:gemini:global",
+    limit=GEMINI_RATE_LIMIT_PER_MINUTE,
+    window=60
+)
+
+# Тексты ошибок генерации - модульная константа, а не dict на каждый вызов
+_ERROR_MESSAGES = {
+    "SAFETY": "⚠️ Запрос заблокирован фильтром безопасности.\n\nПопробуйте изменить промпт.",
+    "NO_IMAGE": "⚠️ Модель не смогла сгенерировать изображение.\n\nПопробуйте:\n- Упростить промпт\n- Использовать другие референсы\n- Изменить настройки",
+    "TIMEOUT": "⏱ Превышено время ожидания генерации.\n\nПопробуйте позже.",
+    "NO_REFERENCE_IMAGES": "❌ Не удалось загрузить референсные изображения.\n\nПроверьте качество загруженных фото."
+}
+
+
+def _drop_page_cache(path: str):
+    """
+    Выбросить файл из страничного кэша (блокирующий вызов для to_thread)
+
+    Сгенерированный PNG читается ровно один раз - при отправке в
+    Telegram; после этого его страницы только вытесняют из кэша
+    более полезные данные
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
 
 async def process_generation(job_data: Dict, gemini_client: GeminiClient):
     """
@@ -29,15 +70,44 @@ async def process_generation(job_data: Dict, gemini_client: GeminiClient):
     reference_images = job_data.get("reference_images", [])
     settings = job_data.get("settings", {})
     
-    logger.info(f"Processing generation {generation_id} for user {user_id}")
-    
+    # Проверяем клиентский лимит Gemini до каких-либо изменений в БД:
+    # при отказе задача просто возвращается в очередь
+    if not await _gemini_limiter.acquire():
+        logger.warning(
+            "Gemini rate limit saturated, requeueing generation %s", generation_id
+        )
+        await asyncio.sleep(_gemini_limiter.retry_after)
+        await generation_queue.enqueue(job_data)
+        return
+
+    logger.info("Processing generation %s for user %s", generation_id, user_id)
+
+    # repr всего payload'а дорог - собираем его только когда DEBUG
+    # реально включён
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Job payload: %r", job_data)
+
+    # UUID разбирается один раз: повторный парсинг в других ветках
+    # не нужен, а битый id отбрасывается до открытия сессии
+    try:
+        gen_uuid = (
+            uuid.UUID(generation_id)
+            if isinstance(generation_id, str) else generation_id
+        )
+    except (ValueError, TypeError):
+        logger.error("Invalid generation id in job: %r", generation_id)
+        return
+
     async with AsyncSessionLocal() as session:
+        # Ссылка видна и в аварийной ветке: повторный session.get
+        # на пути ошибки не нужен
+        generation = None
         try:
             # Получаем генерацию из БД
-            generation = await session.get(Generation, uuid.UUID(generation_id))
-            
+            generation = await session.get(Generation, gen_uuid)
+
             if not generation:
-                logger.error(f"Generation not found: {generation_id}")
+                logger.error("Generation not found: %s", generation_id)
                 return
             
             # Обновляем статус на "processing"
@@ -54,15 +124,18 @@ async def process_generation(job_data: Dict, gemini_client: GeminiClient):
                     "Это может занять до 10 минут."
                 )
             except Exception as e:
-                logger.error(f"Error sending start notification: {e}")
+                logger.error("Error sending start notification: %s", e)
             
-            # Генерация через Gemini
-            image_data, error, seed = await gemini_client.generate_image(
+            # Генерация через Gemini: результат пишется сразу на диск,
+            # без промежуточного bytes-буфера в памяти
+            image_path = IMAGES_DIR / f"{generation_id}.png"
+            image_path, error, seed = await gemini_client.generate_image(
                 prompt=prompt,
                 reference_images=reference_images,
-                settings=settings
+                settings=settings,
+                output_path=str(image_path)
             )
-            
+
             if error:
                 # Ошибка генерации - возвращаем кредиты
                 await handle_generation_error(
@@ -77,19 +150,26 @@ async def process_generation(job_data: Dict, gemini_client: GeminiClient):
                     session=session,
                     generation=generation,
                     user_id=user_id,
-                    image_data=image_data,
+                    image_path=image_path,
                     seed=seed
                 )
         
         except Exception as e:
-            logger.error(f"Critical error processing generation {generation_id}: {e}", exc_info=True)
+            logger.error(
+                "Critical error processing generation %s: %s",
+                generation_id, e, exc_info=True
+            )
             
             # Возвращаем кредиты при критической ошибке
             try:
+                # Транзакция могла остаться в аварийном состоянии
+                await session.rollback()
+
                 await BalanceService.release_credits(session, user_id, GENERATION_COST)
-                
-                generation = await session.get(Generation, uuid.UUID(generation_id))
-                if generation:
+
+                # Переиспользуем уже загруженный объект вместо
+                # повторного SELECT
+                if generation is not None:
                     generation.status = "failed"
                     generation.error = str(e)
                     generation.completed_at = datetime.now()
@@ -102,7 +182,7 @@ async def process_generation(job_data: Dict, gemini_client: GeminiClient):
                     f"Кредиты возвращены на баланс."
                 )
             except Exception as cleanup_error:
-                logger.error(f"Error during cleanup: {cleanup_error}")
+                logger.error("Error during cleanup: %s", cleanup_error)
 
 
 async def handle_generation_error(
@@ -114,7 +194,7 @@ async def handle_generation_error(
     """
     Обработка ошибки генерации
     """
-    logger.warning(f"Generation {generation.id} failed: {error}")
+    logger.warning("Generation %s failed: %s", generation.id, error)
     
     # Возвращаем кредиты
     await BalanceService.release_credits(session, user_id, GENERATION_COST)
@@ -126,14 +206,7 @@ async def handle_generation_error(
     await session.commit()
     
     # Формируем сообщение об ошибке
-    error_messages = {
-        "SAFETY": "⚠️ Запрос заблокирован фильтром безопасности.\n\nПопробуйте изменить промпт.",
-        "NO_IMAGE": "⚠️ Модель не смогла сгенерировать изображение.\n\nПопробуйте:\n- Упростить промпт\n- Использовать другие референсы\n- Изменить настройки",
-        "TIMEOUT": "⏱ Превышено время ожидания генерации.\n\nПопробуйте позже.",
-        "NO_REFERENCE_IMAGES": "❌ Не удалось загрузить референсные изображения.\n\nПроверьте качество загруженных фото."
-    }
-    
-    error_msg = error_messages.get(error, f"❌ Ошибка: {error}")
+    error_msg = _ERROR_MESSAGES.get(error, f"❌ Ошибка: {error}")
     
     # Отправляем уведомление пользователю
     try:
@@ -143,36 +216,33 @@ async def handle_generation_error(
             f"{error_msg}\n\n💰 Кредиты возвращены на баланс."
         )
     except Exception as e:
-        logger.error(f"Error sending error notification: {e}")
+        logger.error("Error sending error notification: %s", e)
 
 
 async def handle_generation_success(
     session,
     generation: Generation,
     user_id: int,
-    image_data: bytes,
+    image_path: str,
     seed: int
 ):
     """
     Обработка успешной генерации
     """
-    logger.info(f"Generation {generation.id} completed successfully")
-    
-    # Списываем кредиты
+    logger.info("Generation %s completed successfully", generation.id)
+
+    # Списываем кредиты, не коммитя: списание и смена статуса
+    # генерации уезжают одной транзакцией - один fsync WAL вместо двух
     await BalanceService.commit_credits(
         session=session,
         user_id=user_id,
         amount=GENERATION_COST,
-        reference_id=generation.id
+        reference_id=generation.id,
+        commit=False
     )
-    
-    # Сохраняем изображение
-    image_filename = f"{generation.id}.png"
-    image_path = IMAGES_DIR / image_filename
-    
-    with open(image_path, "wb") as f:
-        f.write(image_data)
-    
+
+    # Изображение уже сохранено клиентом Gemini напрямую на диск
+
     # Обновляем генерацию
     generation.status = "completed"
     generation.image_url = str(image_path)
@@ -188,7 +258,7 @@ async def handle_generation_success(
         from bot_api.services.referral_service_v2 import ReferralServiceV2
         await ReferralServiceV2.activate_referral(session, user_id)
     except Exception as e:
-        logger.error(f"Error activating referral: {e}")
+        logger.error("Error activating referral: %s", e)
     
     # Отправляем результат пользователю (ВСЕГДА КАК ФАЙЛ)
     try:
@@ -205,4 +275,7 @@ async def handle_generation_success(
             filename=f"nano_banana_{generation.id}.png"
         )
     except Exception as e:
-        logger.error(f"Error sending result to user: {e}")
+        logger.error("Error sending result to user: %s", e)
+
+    # После отправки файл больше не нужен в страничном кэше
+    await asyncio.to_thread(_drop_page_cache, str(image_path))
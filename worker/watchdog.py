@@ -3,10 +3,10 @@ Watchdog для мониторинга и очистки зависших ген
 """
 import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
 
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
 
 from shared.database import AsyncSessionLocal, Generation
 from shared.config import GENERATION_TIMEOUT
@@ -28,20 +28,26 @@ class Watchdog:
         """
         self.check_interval = check_interval
         self.running = False
+
+    # Сколько зависших строк забирает один заход цикла
+    _BATCH_SIZE = 100
     
     async def start(self):
         """Запуск watchdog"""
         self.running = True
         logger.info("🐕 Watchdog started")
         
+        # Интервал отсчитывается по монотонным часам от начала тика:
+        # длительность самой проверки не накапливается в дрейф
         while self.running:
+            tick_start = time.monotonic()
             try:
                 await self.check_stuck_generations()
-                await asyncio.sleep(self.check_interval)
-            
             except Exception as e:
-                logger.error(f"Error in watchdog loop: {e}", exc_info=True)
-                await asyncio.sleep(self.check_interval)
+                logger.error("Error in watchdog loop: %s", e, exc_info=True)
+
+            elapsed = time.monotonic() - tick_start
+            await asyncio.sleep(max(0.0, self.check_interval - elapsed))
     
     def stop(self):
         """Остановка watchdog"""
@@ -51,79 +57,116 @@ class Watchdog:
     async def check_stuck_generations(self):
         """
         Проверить и очистить зависшие генерации
+
+        Зависшие строки обрабатываются пачками по _BATCH_SIZE под
+        FOR UPDATE SKIP LOCKED: тик ограничен по объёму, а несколько
+        экземпляров watchdog не дерутся за одни и те же строки.
+        Смена статуса и возвраты кредитов (сгруппированные по
+        пользователю) коммитятся одной транзакцией на пачку: строки
+        становятся failed только вместе со своими возвратами, при
+        ошибке пачка откатывается и будет подобрана следующим тиком.
+        Уведомления уходят параллельно после commit'а
         """
+        refunds = {}
+
         async with AsyncSessionLocal() as session:
             try:
+                # Одна метка времени на тик: и порог, и completed_at
+                now = datetime.now()
+
                 # Находим генерации в статусе 'processing' старше GENERATION_TIMEOUT
-                timeout_threshold = datetime.now() - timedelta(seconds=GENERATION_TIMEOUT)
-                
-                result = await session.execute(
-                    select(Generation).where(
-                        Generation.status == "processing",
-                        Generation.started_at < timeout_threshold
+                timeout_threshold = now - timedelta(seconds=GENERATION_TIMEOUT)
+
+                while True:
+                    rows = (await session.execute(
+                        select(Generation.id, Generation.user_id, Generation.cost).where(
+                            Generation.status == "processing",
+                            Generation.started_at < timeout_threshold
+                        )
+                        .order_by(Generation.started_at)
+                        .limit(self._BATCH_SIZE)
+                        .with_for_update(skip_locked=True)
+                    )).all()
+
+                    if not rows:
+                        break
+
+                    logger.warning("Found %d stuck generations", len(rows))
+
+                    # Возвраты кредитов: суммируем по пользователю, один
+                    # вызов (один UPDATE баланса) на пользователя
+                    batch_refunds = {}
+                    for row in rows:
+                        batch_refunds[row.user_id] = (
+                            batch_refunds.get(row.user_id, 0) + row.cost
+                        )
+
+                    # Один UPDATE по всей пачке вместо мутации каждой строки
+                    await session.execute(
+                        update(Generation)
+                        .where(Generation.id.in_([row.id for row in rows]))
+                        .values(
+                            status="failed",
+                            error=f"TIMEOUT: Generation exceeded {GENERATION_TIMEOUT}s limit",
+                            completed_at=now
+                        )
+                        .execution_options(synchronize_session=False)
                     )
-                )
-                stuck_generations = result.scalars().all()
-                
-                if not stuck_generations:
-                    return
-                
-                logger.warning(f"Found {len(stuck_generations)} stuck generations")
-                
-                # Обрабатываем каждую зависшую генерацию
-                for generation in stuck_generations:
-                    await self.handle_stuck_generation(session, generation)
-                
-                await session.commit()
-                
+
+                    for user_id, amount in batch_refunds.items():
+                        await BalanceService.release_credits(
+                            session=session,
+                            user_id=user_id,
+                            amount=amount,
+                            commit=False
+                        )
+
+                    await session.commit()
+
+                    for user_id, amount in batch_refunds.items():
+                        refunds[user_id] = refunds.get(user_id, 0) + amount
+                        logger.info(
+                            "Released %s credits for stuck generations of user %s",
+                            amount, user_id
+                        )
+
+                    if len(rows) < self._BATCH_SIZE:
+                        break
+
             except Exception as e:
                 await session.rollback()
-                logger.error(f"Error checking stuck generations: {e}", exc_info=True)
-    
-    async def handle_stuck_generation(self, session: AsyncSession, generation: Generation):
-        """
-        Обработать зависшую генерацию
-        """
-        try:
-            logger.warning(
-                f"Handling stuck generation: {generation.id} "
-                f"(user={generation.user_id}, started={generation.started_at})"
-            )
-            
-            # Обновляем статус на 'failed'
-            generation.status = "failed"
-            generation.error = f"TIMEOUT: Generation exceeded {GENERATION_TIMEOUT}s limit"
-            generation.completed_at = datetime.now()
-            
-            # Возвращаем кредиты пользователю
-            await BalanceService.release_credits(
-                session=session,
-                user_id=generation.user_id,
-                amount=generation.cost
-            )
-            
-            logger.info(
-                f"Released {generation.cost} credits for stuck generation {generation.id}"
-            )
-            
-            # Уведомляем пользователя
+                logger.error("Error checking stuck generations: %s", e, exc_info=True)
+
+            if not refunds:
+                return
+
+            # Уведомления - параллельно, ошибки не валят обработку
             try:
                 from bot_api.bot import send_message
-                await send_message(
-                    generation.user_id,
-                    f"⏱ Генерация превысила лимит времени ({GENERATION_TIMEOUT // 60} минут)\n\n"
-                    f"Статус: Отменена\n"
-                    f"💰 Кредиты возвращены: {generation.cost}\n\n"
-                    f"Попробуйте:\n"
-                    f"• Упростить промпт\n"
-                    f"• Использовать меньше референсов\n"
-                    f"• Попробовать позже"
+                results = await asyncio.gather(
+                    *(
+                        send_message(
+                            user_id,
+                            f"⏱ Генерация превысила лимит времени ({GENERATION_TIMEOUT // 60} минут)\n\n"
+                            f"Статус: Отменена\n"
+                            f"💰 Кредиты возвращены: {amount}\n\n"
+                            f"Попробуйте:\n"
+                            f"• Упростить промпт\n"
+                            f"• Использовать меньше референсов\n"
+                            f"• Попробовать позже"
+                        )
+                        for user_id, amount in refunds.items()
+                    ),
+                    return_exceptions=True
                 )
+                for (user_id, _), result in zip(refunds.items(), results):
+                    if isinstance(result, BaseException):
+                        logger.error(
+                            "Error sending stuck notification to user %s: %s",
+                            user_id, result
+                        )
             except Exception as e:
-                logger.error(f"Error sending notification for stuck generation: {e}")
-        
-        except Exception as e:
-            logger.error(f"Error handling stuck generation {generation.id}: {e}", exc_info=True)
+                logger.error("Error sending notifications for stuck generations: %s", e)
 
 
 async def run_watchdog():